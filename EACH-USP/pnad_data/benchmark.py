@@ -0,0 +1,132 @@
+"""Benchmark of the replicate-weight estimates against a loop-based reference, on synthetic PNAD.
+
+    python benchmark.py --rows 300000 --quarters 2
+
+Synthetic quarters are written and converted to Parquet, then every domain is
+estimated by survey_estimates (matrix products, domains in parallel) and by a
+pandas groupby-apply that loops over the replicate weights. Both must agree.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from main import convert
+from pnad_reader import PARTITION_COLUMNS
+from survey_estimates import (GIG_INDICATORS, WEIGHT, estimate_dataset, open_dataset,
+                              replicate_columns, source_columns, variable_values)
+from synthetic_pnad import write_synthetic_pnad
+
+
+def reference_estimate(frame, weight_column, indicator):
+    """Estimate one indicator of one domain under one weight column, the textbook way."""
+    _, kind, variable, argument = indicator
+    weights = frame[weight_column]
+    if variable is None:
+        return weights.sum()
+    values = pd.Series(variable_values(frame, variable), index=frame.index)
+    if kind == "quantile":
+        valid = values.notna()
+        ordered = pd.DataFrame({"value": values[valid], "weight": weights[valid]}).sort_values(
+            "value", kind="stable")
+        share = ordered["weight"].cumsum() / ordered["weight"].sum()
+        return ordered["value"].iloc[min(int((share < argument).sum()), len(ordered) - 1)]
+    if kind == "ratio":
+        denominator = pd.Series(variable_values(frame, argument), index=frame.index)
+    else:
+        denominator = pd.Series(1.0, index=frame.index)
+    valid = values.notna() & denominator.notna()
+    numerator = (values[valid] * weights[valid]).sum()
+    return numerator if kind == "total" else numerator / (denominator[valid] * weights[valid]).sum()
+
+
+def reference_estimates(frame, indicators=GIG_INDICATORS, by=PARTITION_COLUMNS, weight=WEIGHT):
+    """Estimate every domain with a groupby-apply looping over indicators and replicate weights."""
+    replicates = replicate_columns(frame.columns, weight)
+
+    def estimate_group(group):
+        rows = []
+        for indicator in indicators:
+            estimate = reference_estimate(group, weight, indicator)
+            thetas = np.array([reference_estimate(group, column, indicator)
+                               for column in replicates])
+            se = np.sqrt(((thetas - estimate) ** 2).sum() / (len(replicates) - 1))
+            rows.append({"indicator": indicator[0], "estimate": estimate, "se": se})
+        return pd.DataFrame(rows)
+
+    return (frame.groupby(list(by), observed=True)
+            .apply(estimate_group, include_groups=False)
+            .reset_index(level=list(range(len(by))))
+            .reset_index(drop=True))
+
+
+def compare(estimates, reference, by=PARTITION_COLUMNS):
+    """Return the largest relative difference of estimates and standard errors to the reference."""
+    keys = list(by) + ["indicator"]
+    merged = estimates.merge(reference, on=keys, suffixes=("", "_reference"))
+    if len(merged) != len(reference):
+        raise ValueError(f"{len(merged)} of {len(reference)} reference estimates matched")
+    differences = {}
+    for column in ["estimate", "se"]:
+        scale = np.maximum(np.abs(merged[f"{column}_reference"]), 1e-12)
+        differences[column] = float(np.nanmax(np.abs(merged[column] - merged[f"{column}_reference"])
+                                              / scale))
+    return differences
+
+
+def run(work_dir, n_rows, n_quarters, n_replicates, workers, tolerance=1e-9):
+    shutil.rmtree(work_dir, ignore_errors=True)
+    dataset_dir = os.path.join(work_dir, "parquet")
+    for quarter in range(1, n_quarters + 1):
+        dictionary_path, data_path = write_synthetic_pnad(
+            os.path.join(work_dir, "raw"), n_rows=n_rows, quarter=quarter,
+            n_replicates=n_replicates, seed=quarter)
+        convert(dictionary_path, [data_path], dataset_dir)
+
+    timings = {}
+    start = time.perf_counter()
+    serial = estimate_dataset(dataset_dir, max_workers=1)
+    timings["vectorized, 1 worker"] = time.perf_counter() - start
+    start = time.perf_counter()
+    estimates = estimate_dataset(dataset_dir, max_workers=workers)
+    timings[f"vectorized, {workers or os.cpu_count()} workers"] = time.perf_counter() - start
+    pd.testing.assert_frame_equal(serial, estimates)
+
+    columns = list(PARTITION_COLUMNS) + [WEIGHT] + source_columns(GIG_INDICATORS)
+    frame = open_dataset(dataset_dir).to_table().to_pandas()
+    frame = frame[columns + replicate_columns(frame.columns)]
+    start = time.perf_counter()
+    reference = reference_estimates(frame)
+    timings["loop reference"] = time.perf_counter() - start
+
+    differences = compare(estimates, reference)
+    print(f"{len(frame)} gig workers, {frame.groupby(list(PARTITION_COLUMNS)).ngroups} domains, "
+          f"{len(replicate_columns(frame.columns))} replicate weights")
+    for name, seconds in timings.items():
+        print(f"{name:<28} {seconds:8.3f}s  x{timings['loop reference'] / seconds:.1f}")
+    print(f"max relative difference: estimate {differences['estimate']:.2e}, "
+          f"se {differences['se']:.2e}")
+    return max(differences.values()) <= tolerance
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--rows", type=int, default=300_000, help="People per quarter.")
+    arg_parser.add_argument("--quarters", type=int, default=2)
+    arg_parser.add_argument("--replicates", type=int, default=200)
+    arg_parser.add_argument("--workers", type=int, default=None)
+    arg_parser.add_argument("--work-dir", default="benchmark_data")
+    args = arg_parser.parse_args()
+    if not run(args.work_dir, args.rows, args.quarters, args.replicates, args.workers):
+        print("Estimates differ from the reference", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""Shared fixtures of the tests: synthetic quarters in the IBGE fixed-width layout."""
+
+import pytest
+
+from pnad_reader import read_sas_dictionary
+from synthetic_pnad import write_synthetic_pnad
+
+
+@pytest.fixture
+def synthetic_quarter(tmp_path):
+    """
+    Write a small synthetic quarter and return (fields, data_path).
+
+    The 2,000 records carry two replicate weights; about 6% of them are gig workers.
+    """
+    dictionary_path, data_path = write_synthetic_pnad(str(tmp_path), n_rows=2000, n_replicates=2,
+                                                      chunksize=700, seed=7)
+    return read_sas_dictionary(dictionary_path), data_path
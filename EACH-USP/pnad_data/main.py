@@ -0,0 +1,98 @@
+"""Convert PNAD Contínua quarterly microdata into Parquet partitioned by year, quarter and UF.
+
+    python main.py convert --dictionary input_PNADC_trimestral.txt PNADC_012024.txt --out parquet
+    python main.py synthetic --rows 1000000 --out synthetic
+    python main.py estimate parquet --out estimates_uf.csv
+    python main.py estimate parquet --by Ano Trimestre --out estimates_brasil.csv
+"""
+
+import argparse
+
+from pnad_reader import GIG_WORK_FILTERS, PARTITION_COLUMNS, FixedWidthReader, read_sas_dictionary
+from survey_estimates import estimate_dataset
+from synthetic_pnad import write_synthetic_pnad
+
+# Variables kept by default: design (strata, PSUs, weights), demographics and work
+DEFAULT_COLUMNS = [
+    "Ano", "Trimestre", "UF", "UPA", "Estrato", "V1008", "V1022", "V1028",
+    "V2007", "V2009", "V4010", "V4012", "V4019", "VD4016", "VD4031",
+]
+
+
+def convert(dictionary_path, data_paths, out_dir, columns=None, gig_only=True,
+            replicate_weights=True, chunk_rows=250_000):
+    """
+    Convert quarterly microdata files into one partitioned Parquet dataset.
+
+    Parameters:
+    - dictionary_path: str. IBGE SAS input dictionary of the files.
+    - data_paths: list[str]. Fixed-width quarterly files.
+    - out_dir: str. Root of the Parquet dataset.
+    - columns: list[str] or None. Variables kept; DEFAULT_COLUMNS when None.
+    - gig_only: bool. Keep only gig workers (GIG_WORK_FILTERS) instead of every person.
+    - replicate_weights: bool. Also keep the replicate weights V1028001...
+    - chunk_rows: int. Records decoded at a time.
+    """
+    fields = read_sas_dictionary(dictionary_path)
+    names = [field.name for field in fields]
+    columns = list(columns or [name for name in DEFAULT_COLUMNS if name in names])
+    if replicate_weights:
+        columns += [name for name in names if name.startswith("V1028") and len(name) == 8]
+    total = 0
+    for data_path in data_paths:
+        reader = FixedWidthReader(data_path, fields, columns=columns,
+                                  filters=GIG_WORK_FILTERS if gig_only else None,
+                                  chunk_rows=chunk_rows)
+        total += reader.write_parquet(out_dir)
+    return total
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="Convert microdata files to Parquet.")
+    convert_parser.add_argument("data_paths", nargs="+")
+    convert_parser.add_argument("--dictionary", required=True)
+    convert_parser.add_argument("--out", default="parquet")
+    convert_parser.add_argument("--columns", nargs="+", default=None)
+    convert_parser.add_argument("--all-people", action="store_true",
+                                help="Keep every person instead of gig workers only.")
+    convert_parser.add_argument("--no-replicate-weights", action="store_true")
+    convert_parser.add_argument("--chunk-rows", type=int, default=250_000)
+
+    synthetic_parser = subparsers.add_parser("synthetic", help="Write a synthetic quarter.")
+    synthetic_parser.add_argument("--rows", type=int, default=100_000)
+    synthetic_parser.add_argument("--year", type=int, default=2024)
+    synthetic_parser.add_argument("--quarter", type=int, default=1)
+    synthetic_parser.add_argument("--replicates", type=int, default=200)
+    synthetic_parser.add_argument("--out", default="synthetic")
+
+    estimate_parser = subparsers.add_parser(
+        "estimate", help="Estimate gig-worker indicators with replicate-weight errors.")
+    estimate_parser.add_argument("dataset")
+    estimate_parser.add_argument("--by", nargs="+", default=list(PARTITION_COLUMNS))
+    estimate_parser.add_argument("--gig-filter", action="store_true",
+                                 help="Keep gig workers only, for datasets of every person.")
+    estimate_parser.add_argument("--workers", type=int, default=None)
+    estimate_parser.add_argument("--out", default="estimates.csv")
+    args = arg_parser.parse_args()
+
+    if args.command == "convert":
+        convert(args.dictionary, args.data_paths, args.out, columns=args.columns,
+                gig_only=not args.all_people, replicate_weights=not args.no_replicate_weights,
+                chunk_rows=args.chunk_rows)
+    elif args.command == "estimate":
+        estimates = estimate_dataset(args.dataset, by=args.by,
+                                     filters=GIG_WORK_FILTERS if args.gig_filter else None,
+                                     max_workers=args.workers)
+        estimates.to_csv(args.out, index=False)
+        print(f"Wrote {len(estimates)} estimates to {args.out}")
+    else:
+        write_synthetic_pnad(args.out, n_rows=args.rows, year=args.year, quarter=args.quarter,
+                             n_replicates=args.replicates)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""Streaming reader of PNAD Contínua fixed-width microdata, driven by the IBGE input dictionary."""
+
+import glob
+import mmap
+import os
+import re
+from dataclasses import dataclass
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Occupation codes (COD, variable V4010) of app drivers and couriers
+GIG_OCCUPATION_CODES = {
+    "8321": "Condutores de motocicletas",
+    "8322": "Condutores de automóveis, táxis e caminhonetes",
+    "9621": "Mensageiros, carregadores de bagagens e entregadores de encomendas",
+}
+# Position in the occupation (V4012) of gig workers: own-account workers
+GIG_POSITION_CODES = {
+    "6": "Conta própria",
+}
+GIG_WORK_FILTERS = {"V4010": list(GIG_OCCUPATION_CODES), "V4012": list(GIG_POSITION_CODES)}
+
+PARTITION_COLUMNS = ("Ano", "Trimestre", "UF")
+
+# One SAS input statement line: @0001 Ano $4. /* Ano de referência */
+_INPUT_LINE = re.compile(r"@\s*(\d+)\s+(\w+)\s+(\$?)\s*(\d+)\.(\d*)\s*(?:/\*\s*(.*?)\s*\*/)?")
+
+_SPACE, _ZERO, _NINE, _POINT = ord(" "), ord("0"), ord("9"), ord(".")
+
+
+@dataclass
+class FieldSpec:
+    """
+    A column of the fixed-width layout.
+
+    Parameters:
+    - name: str. Variable name, e.g. "V4010".
+    - start: int. 0-based byte offset in the record.
+    - width: int. Width in bytes.
+    - kind: str. "str" for character fields, "int" or "float" for numeric ones.
+    - decimals: int. Implied decimals of numeric fields written without a decimal point.
+    - label: str. Description from the dictionary.
+    """
+
+    name: str
+    start: int
+    width: int
+    kind: str
+    decimals: int = 0
+    label: str = ""
+
+
+def parse_sas_dictionary(text, float_width=10):
+    """
+    Parse the @position name [$]width.[decimals] lines of a SAS input statement.
+
+    Numeric fields with implied decimals or at least float_width bytes wide
+    (the survey weights) are read as float, other numeric fields as int.
+
+    Parameters:
+    - text: str. Content of the IBGE input dictionary (input_PNADC_trimestral.txt).
+    - float_width: int. Width from which numeric fields are read as float.
+    """
+    fields = []
+    for match in _INPUT_LINE.finditer(text):
+        position, name, is_char, width, decimals, label = match.groups()
+        width = int(width)
+        decimals = int(decimals or 0)
+        if is_char:
+            kind = "str"
+        elif decimals or width >= float_width:
+            kind = "float"
+        else:
+            kind = "int"
+        fields.append(FieldSpec(name, int(position) - 1, width, kind, decimals, label or ""))
+    if not fields:
+        raise ValueError("No @position name width. field found in the dictionary")
+    return fields
+
+
+def read_sas_dictionary(path, encoding="latin-1", float_width=10):
+    """Read and parse an IBGE SAS input dictionary file (see parse_sas_dictionary)."""
+    with open(path, encoding=encoding) as f:
+        return parse_sas_dictionary(f.read(), float_width=float_width)
+
+
+def _strip(block):
+    """Return the fields of a (rows, width) byte block as stripped fixed-width byte strings."""
+    raw = np.ascontiguousarray(block).view(f"S{block.shape[1]}").ravel()
+    return np.char.strip(raw)
+
+
+def decode_int(block):
+    """
+    Decode right-aligned unsigned integers from a (rows, width) byte block.
+
+    Returns (values, null) where null marks blank fields. Fields with any
+    other byte than digits and leading spaces are parsed as floats and must
+    hold whole numbers.
+    """
+    is_digit = (block >= _ZERO) & (block <= _NINE)
+    is_space = block == _SPACE
+    null = is_space.all(axis=1)
+    irregular = ~(is_digit | is_space)
+    # A space after a digit means a left-aligned or embedded blank
+    irregular[:, 1:] |= is_space[:, 1:] & is_digit[:, :-1]
+    if irregular.any():
+        values, null = decode_float(block)
+        if not np.array_equal(values[~null], np.round(values[~null])):
+            raise ValueError("Integer field holds fractional values; read it as float")
+        return np.where(null, 0, values).astype(np.int64), null
+    powers = 10 ** np.arange(block.shape[1] - 1, -1, -1, dtype=np.int64)
+    values = (np.where(is_digit, block - _ZERO, 0).astype(np.int64)) @ powers
+    return values, null
+
+
+def decode_float(block, decimals=0):
+    """
+    Decode numbers from a (rows, width) byte block, returning (values, null).
+
+    Fields without a decimal point are divided by 10**decimals, as SAS
+    reads a w.d informat. Right-aligned digits with the point in the same
+    column on every row, as IBGE writes weights, are decoded with one
+    matrix-vector product; anything else is parsed field by field.
+    """
+    block = np.ascontiguousarray(block)
+    width = block.shape[1]
+    is_digit = (block >= _ZERO) & (block <= _NINE)
+    is_space = block == _SPACE
+    is_point = block == _POINT
+    null = is_space.all(axis=1)
+    values = np.full(len(block), np.nan)
+    if null.all():
+        return values, null
+
+    point_columns = np.nonzero(is_point.any(axis=0))[0]
+    point = point_columns[0] if len(point_columns) == 1 else width
+    regular = (len(point_columns) <= 1 and width <= 15
+               and not (~(is_digit | is_space | is_point)).any()
+               and not (is_space[:, 1:] & ~is_space[:, :-1]).any()
+               and (point == width or (is_point[:, point] | null).all()))
+    if regular:
+        # Each digit weighs 10 ** (digits to its right); the point column weighs 0
+        positions = np.arange(width)
+        exponents = width - 1 - positions - ((positions < point) & (point < width))
+        weights = np.where(positions == point, 0.0, 10.0 ** exponents)
+        fraction_digits = width - 1 - point if point < width else decimals
+        mantissa = np.where(is_digit, block - _ZERO, 0).astype(np.float64) @ weights
+        values[~null] = mantissa[~null] / 10.0 ** fraction_digits
+        return values, null
+
+    values[~null] = _strip(block[~null]).astype(np.float64)
+    if decimals:
+        values[~null & ~is_point.any(axis=1)] /= 10 ** decimals
+    return values, null
+
+
+def decode_str(block, encoding="latin-1"):
+    """Decode a (rows, width) byte block into stripped strings, returning (values, null)."""
+    raw = _strip(block)
+    return np.char.decode(raw, encoding), raw == b""
+
+
+def decode_field(block, field):
+    """Return the pyarrow array of a field decoded from its (rows, width) byte block."""
+    if field.kind == "str":
+        values, null = decode_str(block)
+        return pa.array(values, type=pa.string(), mask=null)
+    if field.kind == "int":
+        values, null = decode_int(block)
+        return pa.array(values, type=pa.int64(), mask=null)
+    values, null = decode_float(block, field.decimals)
+    return pa.array(values, type=pa.float64(), mask=null)
+
+
+class FixedWidthReader:
+    """
+    Bounded-memory reader of a fixed-width file, decoding chunks of records with numpy.
+
+    The file is memory-mapped and read chunk_rows records at a time as a
+    (rows, record length) byte matrix, without copying. Filters are evaluated
+    on the raw bytes of their columns first; only the matching records are
+    copied and only the selected columns decoded, each with one vectorized
+    slice of the matrix.
+
+    Parameters:
+    - path: str. Fixed-width file (one record per line).
+    - fields: list[FieldSpec]. Layout, e.g. from read_sas_dictionary.
+    - columns: list[str] or None. Columns to materialize; every field when None.
+    - filters: dict or None. {column: codes}; a record is kept when every
+      column's stripped value is one of its codes, e.g. GIG_WORK_FILTERS.
+    - chunk_rows: int. Records decoded at a time.
+    """
+
+    def __init__(self, path, fields, columns=None, filters=None, chunk_rows=250_000):
+        self.path = path
+        self.fields = {field.name: field for field in fields}
+        self.columns = list(columns) if columns is not None else list(self.fields)
+        self.filters = {name: [str(code).encode("latin-1") for code in codes]
+                        for name, codes in (filters or {}).items()}
+        unknown = (set(self.columns) | set(self.filters)) - set(self.fields)
+        if unknown:
+            raise KeyError(f"Columns not in the dictionary: {sorted(unknown)}")
+        self.chunk_rows = chunk_rows
+        self.rows_read = 0
+        self.rows_kept = 0
+
+    def _layout(self, mm):
+        newline = mm.find(b"\n")
+        if newline < 0:
+            raise ValueError(f"{self.path} has no line break; expected one record per line")
+        record_length = newline + 1
+        terminator = 2 if newline > 0 and mm[newline - 1] == ord("\r") else 1
+        data_length = record_length - terminator
+        too_short = [name for name in dict.fromkeys([*self.columns, *self.filters])
+                     if self.fields[name].start + self.fields[name].width > data_length]
+        if too_short:
+            raise ValueError(f"Records are {data_length} bytes, shorter than the fields "
+                             f"{too_short[:5]}; is this the right dictionary?")
+        return record_length, terminator
+
+    def _chunk_table(self, records):
+        mask = np.ones(len(records), dtype=bool)
+        for name, codes in self.filters.items():
+            field = self.fields[name]
+            values = _strip(records[:, field.start:field.start + field.width])
+            mask &= np.isin(values, codes)
+        selected = records[mask] if not mask.all() else records
+        self.rows_read += len(records)
+        self.rows_kept += len(selected)
+        return pa.table({name: decode_field(selected[:, field.start:field.start + field.width],
+                                            field)
+                         for name, field in ((name, self.fields[name]) for name in self.columns)})
+
+    def iter_tables(self):
+        """Yield one pyarrow.Table per chunk with the selected columns of the matching records."""
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                record_length, terminator = self._layout(mm)
+                n_records, remainder = divmod(size, record_length)
+                if remainder and remainder != record_length - terminator:
+                    raise ValueError(f"{self.path} is not fixed-width: {size} bytes is not a "
+                                     f"multiple of the {record_length}-byte records")
+                data = np.frombuffer(mm, dtype=np.uint8, count=n_records * record_length)
+                matrix = data.reshape(n_records, record_length)
+                records = None
+                released = 0
+                for start in range(0, n_records, self.chunk_rows):
+                    records = matrix[start:start + self.chunk_rows]
+                    if (records[:, -1] != ord("\n")).any():
+                        bad = start + int(np.argmax(records[:, -1] != ord("\n")))
+                        raise ValueError(f"Record {bad} of {self.path} is not "
+                                         f"{record_length} bytes long")
+                    yield self._chunk_table(records)
+                    # Drop the pages of decoded records so resident memory stays bounded
+                    end = (start + len(records)) * record_length // mmap.PAGESIZE * mmap.PAGESIZE
+                    if hasattr(mm, "madvise") and end > released:
+                        mm.madvise(mmap.MADV_DONTNEED, released, end - released)
+                        released = end
+                del matrix, data, records
+                if remainder:
+                    # Last record without a line break
+                    last = np.frombuffer(mm[n_records * record_length:] + b"\n" * terminator,
+                                         dtype=np.uint8).reshape(1, record_length)
+                    yield self._chunk_table(last)
+
+    def read(self):
+        """Return every matching record as one pyarrow.Table."""
+        tables = list(self.iter_tables())
+        if not tables:
+            return pa.table({name: pa.array([], type=_arrow_type(self.fields[name]))
+                             for name in self.columns})
+        return pa.concat_tables(tables)
+
+    def write_parquet(self, out_dir, partition_columns=PARTITION_COLUMNS,
+                      buffer_bytes=256 * 1024 ** 2):
+        """
+        Write the matching records as Parquet partitioned by partition_columns.
+
+        Files are named after the input file, so each quarter's file can be
+        converted into the same dataset; converting a file again replaces
+        its previous output. Decoded chunks are buffered up to buffer_bytes
+        so heavy filtering does not produce many tiny files.
+
+        Returns the number of rows written.
+
+        Parameters:
+        - out_dir: str. Root of the Hive-partitioned dataset (Ano=2024/Trimestre=1/UF=35/...).
+        - partition_columns: list[str]. Partition columns, materialized even if not selected.
+        - buffer_bytes: int. Size of the decoded rows buffered before each write.
+        """
+        missing = [name for name in partition_columns if name not in self.columns]
+        self.columns += missing
+        file_tag = re.sub(r"\W+", "_", os.path.splitext(os.path.basename(self.path))[0])
+        for stale in glob.glob(os.path.join(out_dir, "**", f"{file_tag}-*.parquet"),
+                               recursive=True):
+            os.remove(stale)
+
+        partitioning = ds.partitioning(
+            pa.schema([(name, _arrow_type(self.fields[name])) for name in partition_columns]),
+            flavor="hive")
+        buffered = []
+        buffered_rows = 0
+        buffered_bytes = 0
+        written = 0
+        part = 0
+
+        def flush():
+            ds.write_dataset(pa.concat_tables(buffered), out_dir, format="parquet",
+                             partitioning=partitioning,
+                             basename_template=f"{file_tag}-{part:05d}-{{i}}.parquet",
+                             existing_data_behavior="overwrite_or_ignore")
+
+        for table in self.iter_tables():
+            if table.num_rows == 0:
+                continue
+            buffered.append(table)
+            buffered_rows += table.num_rows
+            buffered_bytes += table.nbytes
+            if buffered_bytes >= buffer_bytes:
+                flush()
+                written += buffered_rows
+                part += 1
+                buffered, buffered_rows, buffered_bytes = [], 0, 0
+        if buffered:
+            flush()
+            written += buffered_rows
+        print(f"Wrote {written} of {self.rows_read} records from {self.path} to {out_dir}")
+        return written
+
+
+def _arrow_type(field):
+    return {"str": pa.string(), "int": pa.int64(), "float": pa.float64()}[field.kind]
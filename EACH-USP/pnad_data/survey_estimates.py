@@ -0,0 +1,266 @@
+"""Survey-weighted PNAD estimates, with variances from the bootstrap replicate weights.
+
+Every estimate is computed for the full-sample weight and all replicate weights
+at once: the (rows, 1 + R) weight matrix of a domain is multiplied by the
+stacked indicator variables, so a domain costs one matrix product (plus one
+sort per quantile) instead of a pass per replicate.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from pnad_reader import PARTITION_COLUMNS
+
+WEIGHT = "V1028"
+
+
+def informal(frame):
+    """Own-account workers whose business has no CNPJ (V4019 = 2); missing when not asked."""
+    return frame["V4019"].map({"1": 0.0, "2": 1.0}).astype(float)
+
+
+def monthly_hours(frame):
+    """Usual weekly hours (VD4031) over an average month."""
+    return frame["VD4031"] * 52 / 12
+
+
+# Variables derived from the microdata: name -> (function, source columns)
+DERIVED_VARIABLES = {
+    "informal": (informal, ["V4019"]),
+    "horas_mes": (monthly_hours, ["VD4031"]),
+}
+
+# (name, kind, variable, argument) of each indicator. kind is "total", "mean",
+# "ratio" (argument: denominator variable) or "quantile" (argument: probability);
+# a total without variable counts people.
+GIG_INDICATORS = [
+    ("trabalhadores", "total", None, None),
+    ("renda_media", "mean", "VD4016", None),
+    ("renda_mediana", "quantile", "VD4016", 0.5),
+    ("horas_media", "mean", "VD4031", None),
+    ("renda_por_hora", "ratio", "VD4016", "horas_mes"),
+    ("informalidade", "mean", "informal", None),
+]
+
+
+def replicate_columns(names, weight=WEIGHT):
+    """Return the replicate weight columns (V1028001, V1028002, ...) among names, in order."""
+    return sorted(name for name in names
+                  if name.startswith(weight) and len(name) == len(weight) + 3
+                  and name[len(weight):].isdigit())
+
+
+def indicator_variables(indicators):
+    """Return the variables read or derived by a list of indicators."""
+    variables = []
+    for _, kind, variable, argument in indicators:
+        for name in (variable, argument if kind == "ratio" else None):
+            if name is not None and name not in variables:
+                variables.append(name)
+    return variables
+
+
+def source_columns(indicators):
+    """Return the microdata columns needed to compute a list of indicators."""
+    columns = []
+    for variable in indicator_variables(indicators):
+        for name in DERIVED_VARIABLES[variable][1] if variable in DERIVED_VARIABLES else [variable]:
+            if name not in columns:
+                columns.append(name)
+    return columns
+
+
+def variable_values(frame, variable):
+    """Return a variable of frame as float64, NaN where it is missing."""
+    if variable in DERIVED_VARIABLES:
+        values = DERIVED_VARIABLES[variable][0](frame)
+    else:
+        values = frame[variable]
+    return pd.to_numeric(values, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def weighted_quantiles(values, weights, q):
+    """
+    Return the q-quantile of values under each weight column.
+
+    The quantile is the smallest value whose cumulative weight reaches q of
+    the total, computed for every column with one sort and one cumulative sum.
+
+    Parameters:
+    - values: np.ndarray. (rows,) values, without missing ones.
+    - weights: np.ndarray. (rows, columns) weights.
+    - q: float. Probability in [0, 1].
+    """
+    if len(values) == 0:
+        return np.full(weights.shape[1], np.nan)
+    order = np.argsort(values, kind="stable")
+    cumulative = np.cumsum(weights[order], axis=0)
+    targets = q * cumulative[-1]
+    positions = np.minimum((cumulative < targets).sum(axis=0), len(values) - 1)
+    result = values[order][positions]
+    result[cumulative[-1] <= 0] = np.nan
+    return result
+
+
+def replicate_estimates(frame, weights, indicators):
+    """
+    Return the (indicators, 1 + R) estimates of one domain under every weight column.
+
+    Totals, means and ratios share one product: their numerators and
+    denominators, zeroed where the variable is missing, are stacked into a
+    (rows, 2 * indicators) matrix and multiplied by the weights.
+
+    Parameters:
+    - frame: pd.DataFrame. Rows of the domain.
+    - weights: np.ndarray. (rows, 1 + R) full-sample weight followed by its replicates.
+    - indicators: list[tuple]. (name, kind, variable, argument), as GIG_INDICATORS.
+    """
+    n_rows = len(frame)
+    values = {variable: variable_values(frame, variable)
+              for variable in indicator_variables(indicators)}
+    ones = np.ones(n_rows)
+    estimates = np.full((len(indicators), weights.shape[1]), np.nan)
+
+    linear = [i for i, indicator in enumerate(indicators) if indicator[1] != "quantile"]
+    if linear:
+        stacked = np.zeros((n_rows, 2 * len(linear)))
+        for column, i in enumerate(linear):
+            _, kind, variable, argument = indicators[i]
+            numerator = ones if variable is None else values[variable]
+            denominator = {"total": None, "mean": ones, "ratio": values.get(argument)}[kind]
+            valid = ~np.isnan(numerator)
+            if denominator is not None:
+                valid &= ~np.isnan(denominator)
+            stacked[valid, 2 * column] = numerator[valid]
+            stacked[valid, 2 * column + 1] = 1.0 if denominator is None else denominator[valid]
+        sums = stacked.T @ weights
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = sums[0::2] / sums[1::2]
+        for column, i in enumerate(linear):
+            estimates[i] = sums[2 * column] if indicators[i][1] == "total" else ratios[column]
+
+    for i, (_, kind, variable, argument) in enumerate(indicators):
+        if kind == "quantile":
+            valid = ~np.isnan(values[variable])
+            estimates[i] = weighted_quantiles(values[variable][valid], weights[valid], argument)
+    return estimates
+
+
+def summarize_replicates(estimates, mse=True):
+    """
+    Return (estimate, standard error) per row of (indicators, 1 + R) replicate estimates.
+
+    The bootstrap variance is sum((theta_r - center) ** 2) / (R - 1), centered
+    on the full-sample estimate when mse, else on the mean of the replicates.
+    """
+    estimate = estimates[:, 0]
+    replicates = estimates[:, 1:]
+    center = estimate if mse else replicates.mean(axis=1)
+    variance = ((replicates - center[:, None]) ** 2).sum(axis=1) / max(replicates.shape[1] - 1, 1)
+    return estimate, np.sqrt(variance)
+
+
+def estimate_frame(frame, indicators=GIG_INDICATORS, weight=WEIGHT, mse=True, confidence_z=1.96):
+    """
+    Return the estimates of one domain as a DataFrame with one row per indicator.
+
+    Columns: indicator, estimate, se, cv, ci_low, ci_high and n, the sample
+    rows with the indicator's variables present.
+
+    Parameters:
+    - frame: pd.DataFrame. Rows of the domain, with the weight and its replicates.
+    - indicators: list[tuple]. (name, kind, variable, argument), as GIG_INDICATORS.
+    - weight: str. Full-sample weight column; replicates are weight + "001".. .
+    - mse: bool. Center the replicate variance on the full-sample estimate.
+    - confidence_z: float. Normal quantile of the confidence interval (1.96 for 95%).
+    """
+    columns = [weight] + replicate_columns(frame.columns, weight)
+    weights = frame[columns].to_numpy(dtype=np.float64)
+    estimate, se = summarize_replicates(replicate_estimates(frame, weights, indicators), mse=mse)
+    counts = []
+    for _, kind, variable, argument in indicators:
+        present = np.ones(len(frame), dtype=bool)
+        for name in (variable, argument if kind == "ratio" else None):
+            if name is not None:
+                present &= ~np.isnan(variable_values(frame, name))
+        counts.append(int(present.sum()))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cv = se / np.abs(estimate)
+    return pd.DataFrame({
+        "indicator": [indicator[0] for indicator in indicators],
+        "estimate": estimate,
+        "se": se,
+        "cv": cv,
+        "ci_low": estimate - confidence_z * se,
+        "ci_high": estimate + confidence_z * se,
+        "n": counts,
+    })
+
+
+def open_dataset(path):
+    """Open a Parquet dataset written by FixedWidthReader.write_parquet, partitions as strings."""
+    partitioning = ds.partitioning(pa.schema([(name, pa.string()) for name in PARTITION_COLUMNS]),
+                                   flavor="hive")
+    return ds.dataset(path, format="parquet", partitioning=partitioning)
+
+
+def _filter_expression(values, filters=None):
+    """Return the dataset filter selecting a domain (column -> value) and the filters (column -> codes)."""
+    expression = None
+    conditions = [ds.field(name) == value for name, value in values.items()]
+    conditions += [ds.field(name).isin(codes) for name, codes in (filters or {}).items()]
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def estimate_dataset(path, indicators=GIG_INDICATORS, by=PARTITION_COLUMNS, filters=None,
+                     weight=WEIGHT, mse=True, max_workers=None):
+    """
+    Estimate indicators for every domain of a Parquet dataset, domains in parallel.
+
+    Each domain (e.g. one UF in one quarter) is read on its own, with only the
+    columns the indicators need, so memory holds at most max_workers domains
+    at a time however many quarters the dataset has. Domains run in a thread
+    pool: Parquet decoding and the matrix products release the GIL.
+
+    Returns a DataFrame with the by columns followed by estimate_frame's columns.
+
+    Parameters:
+    - path: str. Root of the dataset written by main.py convert.
+    - indicators: list[tuple]. (name, kind, variable, argument), as GIG_INDICATORS.
+    - by: list[str]. Columns defining the domains; ("Ano", "Trimestre") for Brazil.
+    - filters: dict or None. Column -> accepted codes restricting the rows, e.g.
+      GIG_WORK_FILTERS on a dataset converted with every person.
+    - weight: str. Full-sample weight column.
+    - mse: bool. Center the replicate variance on the full-sample estimate.
+    - max_workers: int or None. Domains estimated at once; the CPU count when None.
+    """
+    dataset = open_dataset(path)
+    by = list(by)
+    columns = list(dict.fromkeys(
+        by + [weight] + replicate_columns(dataset.schema.names, weight) + source_columns(indicators)))
+    keys = dataset.to_table(columns=by, filter=_filter_expression({}, filters))
+    domains = keys.group_by(by).aggregate([]).sort_by([(name, "ascending") for name in by])
+    domains = domains.to_pylist()
+
+    def estimate_domain(values):
+        frame = dataset.to_table(columns=columns,
+                                 filter=_filter_expression(values, filters)).to_pandas()
+        result = estimate_frame(frame, indicators, weight=weight, mse=mse)
+        for position, name in enumerate(by):
+            result.insert(position, name, values[name])
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        results = list(executor.map(estimate_domain, domains))
+    print(f"Estimated {len(indicators)} indicators for {len(domains)} domains of {path}")
+    if not results:
+        return pd.DataFrame(columns=by + ["indicator", "estimate", "se", "cv",
+                                          "ci_low", "ci_high", "n"])
+    return pd.concat(results, ignore_index=True)
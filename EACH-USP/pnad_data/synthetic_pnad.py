@@ -0,0 +1,143 @@
+"""Synthetic PNAD Contínua microdata and input dictionary, in the IBGE fixed-width layout."""
+
+import os
+
+import numpy as np
+
+UF_CODES = ["11", "12", "13", "14", "15", "16", "17", "21", "22", "23", "24", "25", "26", "27",
+            "28", "29", "31", "32", "33", "35", "41", "42", "43", "50", "51", "52", "53"]
+
+# (name, width, is_char, decimals, label) of the generated variables, in file order
+SYNTHETIC_LAYOUT = [
+    ("Ano", 4, True, 0, "Ano de referência"),
+    ("Trimestre", 1, True, 0, "Trimestre de referência"),
+    ("UF", 2, True, 0, "Unidade da Federação"),
+    ("UPA", 9, True, 0, "Unidade Primária de Amostragem"),
+    ("Estrato", 7, True, 0, "Estrato"),
+    ("V1008", 2, True, 0, "Número de seleção do domicílio"),
+    ("V1022", 1, True, 0, "Situação do domicílio"),
+    ("V1028", 15, False, 0, "Peso do domicílio e das pessoas com calibração"),
+    ("V2007", 1, True, 0, "Sexo"),
+    ("V2009", 3, False, 0, "Idade do morador na data de referência"),
+    ("V4010", 4, True, 0, "Código da ocupação (cargo ou função)"),
+    ("V4012", 1, True, 0, "Posição na ocupação"),
+    ("V4019", 1, True, 0, "Esse negócio/empresa era registrado no CNPJ?"),
+    ("VD4016", 8, False, 0, "Rendimento mensal habitual do trabalho principal"),
+    ("VD4031", 3, False, 0, "Horas habitualmente trabalhadas por semana em todos os trabalhos"),
+]
+
+_OCCUPATIONS = np.array([b"8321", b"8322", b"9621", b"5120", b"2521", b"7411", b"    "])
+_OCCUPATION_SHARES = [0.02, 0.03, 0.01, 0.3, 0.2, 0.24, 0.2]
+
+
+def synthetic_layout(n_replicates=200):
+    """Return SYNTHETIC_LAYOUT followed by the bootstrap replicate weights V1028001.."""
+    replicates = [(f"V1028{r:03d}", 15, False, 0, f"Peso replicado {r}")
+                  for r in range(1, n_replicates + 1)]
+    return SYNTHETIC_LAYOUT + replicates
+
+
+def sas_dictionary_text(layout):
+    """Return a SAS input statement, as published by IBGE, for a layout."""
+    lines = ["input"]
+    position = 1
+    for name, width, is_char, decimals, label in layout:
+        informat = f"{'$' if is_char else ''}{width}.{decimals or ''}"
+        lines.append(f"@{position:04d} {name:<12} {informat:<6} /* {label} */")
+        position += width
+    lines.append(";")
+    return "\n".join(lines) + "\n"
+
+
+def _digits(values, width):
+    """Return right-aligned, zero-padded decimal digits of non-negative integers as (n, width) bytes."""
+    values = np.asarray(values, dtype=np.int64)
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return ((values[:, None] // powers) % 10 + ord("0")).astype(np.uint8)
+
+
+def _fixed_point(values, width, decimals=6):
+    """Return non-negative floats as (n, width) bytes like "00000182.328712"."""
+    scaled = np.round(np.asarray(values) * 10 ** decimals).astype(np.int64)
+    digits = _digits(scaled, width - 1)
+    point = np.full((len(digits), 1), ord("."), dtype=np.uint8)
+    return np.hstack([digits[:, :-decimals], point, digits[:, -decimals:]])
+
+
+def _chunk(rng, n_rows, year, quarter, n_replicates, first_upa):
+    n_households = max(1, n_rows // 3)
+    household = np.sort(rng.integers(0, n_households, n_rows))
+    upa_index = household // 4
+    n_upas = int(upa_index.max()) + 1
+    upa = first_upa + upa_index
+    uf = rng.choice(len(UF_CODES), n_upas)[upa_index]
+    stratum = (uf + 11) * 100 + upa_index % 20
+    weight = rng.gamma(4.0, 250.0, n_households)[household]
+    occupation = rng.choice(len(_OCCUPATIONS), n_rows, p=_OCCUPATION_SHARES)
+    position = np.where(occupation < 3, rng.choice([3, 6], n_rows, p=[0.3, 0.7]),
+                        rng.integers(1, 8, n_rows))
+    working = _OCCUPATIONS[occupation] != b"    "
+    # CNPJ registration is asked of employers (5) and own-account workers (6)
+    registered = rng.choice([1, 2], n_rows, p=[0.3, 0.7])
+    income = np.where(working, rng.lognormal(7.6, 0.7, n_rows), 0)
+    hours = np.where(working, np.clip(rng.normal(42, 10, n_rows), 1, 120), 0)
+
+    columns = {
+        "Ano": _digits(np.full(n_rows, year), 4),
+        "Trimestre": _digits(np.full(n_rows, quarter), 1),
+        "UF": np.frombuffer("".join(UF_CODES).encode("ascii"), dtype=np.uint8).reshape(-1, 2)[uf],
+        "UPA": _digits(upa, 9),
+        "Estrato": _digits(stratum, 7),
+        "V1008": _digits(household % 14 + 1, 2),
+        "V1022": _digits(rng.choice([1, 2], n_rows, p=[0.85, 0.15]), 1),
+        "V1028": _fixed_point(weight, 15),
+        "V2007": _digits(rng.integers(1, 3, n_rows), 1),
+        "V2009": _digits(rng.integers(14, 80, n_rows), 3),
+        "V4010": np.frombuffer(_OCCUPATIONS.tobytes(), dtype=np.uint8).reshape(-1, 4)[occupation],
+        "V4012": np.where(working[:, None], _digits(position, 1), ord(" ")).astype(np.uint8),
+        "V4019": np.where((working & np.isin(position, [5, 6]))[:, None],
+                          _digits(registered, 1), ord(" ")).astype(np.uint8),
+        "VD4016": np.where(working[:, None], _digits(income, 8), ord(" ")).astype(np.uint8),
+        "VD4031": np.where(working[:, None], _digits(hours, 3), ord(" ")).astype(np.uint8),
+    }
+    # Bootstrap replicates: each primary sampling unit drawn 0..k times, per replicate
+    draws = rng.poisson(1.0, (n_upas, n_replicates))
+    replicate_weights = weight[:, None] * draws[upa_index]
+    for r in range(n_replicates):
+        columns[f"V1028{r + 1:03d}"] = _fixed_point(replicate_weights[:, r], 15)
+    newline = np.full((n_rows, 1), ord("\n"), dtype=np.uint8)
+    return np.hstack(list(columns.values()) + [newline]), first_upa + n_upas
+
+
+def write_synthetic_pnad(out_dir, n_rows=100_000, year=2024, quarter=1, n_replicates=200,
+                         chunksize=100_000, seed=42):
+    """
+    Write a synthetic quarterly microdata file and its SAS input dictionary.
+
+    Returns (dictionary_path, data_path). About 6% of the people work in
+    gig occupations (V4010 8321/8322/9621), mostly on their own account.
+
+    Parameters:
+    - out_dir: str. Output directory.
+    - n_rows: int. People (records) generated.
+    - year, quarter: int. Reference period written in Ano and Trimestre.
+    - n_replicates: int. Replicate weights V1028001.. written after the layout.
+    - chunksize: int. Records generated and written at a time.
+    - seed: int. Random seed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    layout = synthetic_layout(n_replicates)
+    dictionary_path = os.path.join(out_dir, "input_PNADC_trimestral.txt")
+    with open(dictionary_path, "w", encoding="latin-1") as f:
+        f.write(sas_dictionary_text(layout))
+
+    rng = np.random.default_rng(seed)
+    data_path = os.path.join(out_dir, f"PNADC_{quarter:02d}{year}.txt")
+    next_upa = 110000001
+    with open(data_path, "wb") as f:
+        for start in range(0, n_rows, chunksize):
+            records, next_upa = _chunk(rng, min(chunksize, n_rows - start), year, quarter,
+                                       n_replicates, next_upa)
+            records.tofile(f)
+    print(f"Wrote {n_rows} synthetic PNAD records to {data_path}")
+    return dictionary_path, data_path
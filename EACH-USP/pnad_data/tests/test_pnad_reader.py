@@ -0,0 +1,91 @@
+"""FixedWidthReader decodes the same values as pandas.read_fwf."""
+
+import numpy as np
+import pandas as pd
+
+from pnad_reader import GIG_WORK_FILTERS, PARTITION_COLUMNS, FixedWidthReader
+from survey_estimates import open_dataset
+
+
+def read_fwf(fields, path, usecols=None):
+    """Read a fixed-width file with pandas from the same layout, character fields as strings."""
+    fields = [field for field in fields if usecols is None or field.name in usecols]
+    return pd.read_fwf(path, colspecs=[(field.start, field.start + field.width) for field in fields],
+                       names=[field.name for field in fields], header=None,
+                       dtype={field.name: str for field in fields if field.kind == "str"},
+                       encoding="latin-1")
+
+
+def assert_columns_equal(table, expected, fields):
+    kinds = {field.name: field.kind for field in fields}
+    assert table.column_names == list(expected.columns)
+    assert table.num_rows == len(expected)
+    for name in table.column_names:
+        values = table.column(name).to_pylist()
+        reference = [None if pd.isna(value) else value for value in expected[name]]
+        if kinds[name] == "float":
+            assert [value is None for value in values] == [value is None for value in reference]
+            np.testing.assert_allclose([value for value in values if value is not None],
+                                       [value for value in reference if value is not None],
+                                       rtol=1e-12, err_msg=name)
+        else:
+            assert values == reference, name
+
+
+def test_every_column_matches_read_fwf(synthetic_quarter):
+    fields, data_path = synthetic_quarter
+
+    table = FixedWidthReader(data_path, fields, chunk_rows=300).read()
+
+    expected = read_fwf(fields, data_path)
+    # Blank fields (V4012, V4019, VD4016 of people without work) are nulls in both readers
+    assert expected["VD4016"].isna().any()
+    assert_columns_equal(table, expected, fields)
+
+
+def test_filters_match_read_fwf_selection(synthetic_quarter):
+    fields, data_path = synthetic_quarter
+    columns = ["UF", "V1028", "V4010", "V4012", "VD4016"]
+
+    reader = FixedWidthReader(data_path, fields, columns=columns, filters=GIG_WORK_FILTERS,
+                              chunk_rows=300)
+    table = reader.read()
+
+    expected = read_fwf(fields, data_path, usecols=columns)
+    expected = expected[expected["V4010"].isin(GIG_WORK_FILTERS["V4010"])
+                        & expected["V4012"].isin(GIG_WORK_FILTERS["V4012"])]
+    assert 0 < len(expected) < 2000
+    assert (reader.rows_read, reader.rows_kept) == (2000, len(expected))
+    assert_columns_equal(table, expected.reset_index(drop=True), fields)
+
+
+def test_last_record_without_line_break(synthetic_quarter, tmp_path):
+    fields, data_path = synthetic_quarter
+    trimmed_path = str(tmp_path / "PNADC_trimmed.txt")
+    with open(data_path, "rb") as f:
+        content = f.read()
+    with open(trimmed_path, "wb") as f:
+        f.write(content.rstrip(b"\n"))
+
+    columns = ["UPA", "V1028", "V2009"]
+    table = FixedWidthReader(trimmed_path, fields, columns=columns, chunk_rows=300).read()
+
+    assert_columns_equal(table, read_fwf(fields, data_path, usecols=columns), fields)
+
+
+def test_parquet_output_is_partitioned_and_replaced_on_rerun(synthetic_quarter, tmp_path):
+    fields, data_path = synthetic_quarter
+    out_dir = str(tmp_path / "parquet")
+    columns = ["UPA", "V1028", "V4010"]
+
+    for _ in range(2):
+        written = FixedWidthReader(data_path, fields, columns=columns, filters=GIG_WORK_FILTERS,
+                                   chunk_rows=300).write_parquet(out_dir, buffer_bytes=1)
+
+    dataset = open_dataset(out_dir).to_table()
+    expected = FixedWidthReader(data_path, fields, columns=columns + list(PARTITION_COLUMNS),
+                                filters=GIG_WORK_FILTERS).read()
+    assert dataset.num_rows == written == expected.num_rows
+    # Rows are grouped by partition, so compare them in a fixed order
+    keys = [(name, "ascending") for name in ["UF", "UPA", "V1028"]]
+    assert dataset.select(expected.column_names).sort_by(keys).equals(expected.sort_by(keys))
@@ -0,0 +1,118 @@
+import functools
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+@functools.lru_cache(maxsize=None)
+def get_bqstorage_client():
+    """Return the shared BigQuery Storage Read API client, or None if the library is not installed."""
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        print("google-cloud-bigquery-storage is not installed; fetching results over REST")
+        return None
+    return bigquery_storage.BigQueryReadClient()
+
+
+def list_array_to_matrix(array, dtype=np.float32, out=None):
+    """
+    Return a (len(array), dim) array of a pyarrow list array of equal-length vectors.
+
+    The flat child values are viewed without copying when their type already
+    is dtype; otherwise they are converted in one pass. Null or empty lists
+    are not allowed.
+
+    Parameters:
+    - array: pyarrow.ListArray or pyarrow.ChunkedArray of lists.
+    - dtype: numpy dtype of the result.
+    - out: np.ndarray or None. (len(array), dim) array to convert into instead of
+      allocating one.
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks() if array.num_chunks != 1 else array.chunk(0)
+    if len(array) == 0:
+        return np.empty((0, 0), dtype=dtype)
+    if array.null_count:
+        raise ValueError(f"{array.null_count} vectors are null")
+    offsets = array.offsets.to_numpy()
+    lengths = np.diff(offsets)
+    dim = int(lengths[0])
+    if dim == 0 or (lengths != dim).any():
+        raise ValueError(f"Vectors must have one non-zero length, got {np.unique(lengths)}")
+    # Sliced arrays share the child buffer of their parent; take only this slice's values
+    values = array.values.slice(offsets[0], offsets[-1] - offsets[0])
+    flat = values.to_numpy(zero_copy_only=False).reshape(len(array), dim)
+    if out is None:
+        return np.asarray(flat, dtype=dtype)
+    np.copyto(out, flat, casting="same_kind")
+    return out
+
+
+def batches_to_vectors(batches, vector_column, columns, total_rows=None, dtype=np.float32):
+    """
+    Return (DataFrame of the other columns, (n, dim) vector matrix) of Arrow record batches.
+
+    Each batch's REPEATED FLOAT64 column is written straight into one
+    preallocated contiguous matrix; no Python list per row is ever built.
+
+    Parameters:
+    - batches: iterable of pyarrow.RecordBatch.
+    - vector_column: str. Name of the vector column.
+    - columns: list[str]. Every column name, used when there are no rows.
+    - total_rows: int or None. Number of rows, if known, to allocate the matrix once.
+    - dtype: numpy dtype of the matrix.
+    """
+    matrix = None
+    others = []
+    filled = 0
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        vectors = batch.column(vector_column)
+        if matrix is None:
+            dim = len(vectors[0])
+            matrix = np.empty((total_rows or batch.num_rows, dim), dtype=dtype)
+        if filled + batch.num_rows > len(matrix):
+            # total_rows is unknown for some results; grow geometrically
+            grown = np.empty((max(2 * len(matrix), filled + batch.num_rows), matrix.shape[1]),
+                             dtype=dtype)
+            grown[:filled] = matrix[:filled]
+            matrix = grown
+        list_array_to_matrix(vectors, dtype=dtype, out=matrix[filled:filled + batch.num_rows])
+        filled += batch.num_rows
+        others.append(batch.drop_columns([vector_column]))
+
+    if matrix is None:
+        return (pd.DataFrame(columns=[name for name in columns if name != vector_column]),
+                np.empty((0, 0), dtype=dtype))
+    print(f"Fetched {filled} vectors of dimension {matrix.shape[1]} "
+          f"({matrix[:filled].nbytes / 1e6:.1f} MB)")
+    return pa.Table.from_batches(others).to_pandas(), matrix[:filled]
+
+
+def fetch_vectors(client, query, vector_column, bqstorage_client=None, dtype=np.float32,
+                  cache=None):
+    """
+    Run a query and return (DataFrame of the other columns, (n, dim) vector matrix).
+
+    Results are streamed as Arrow record batches, through the Storage Read API
+    when bqstorage_client is given, and converted by batches_to_vectors.
+
+    Parameters:
+    - client: bigquery.Client. Client running the query.
+    - query: str. Query selecting vector_column (ARRAY<FLOAT64>) and other columns.
+    - vector_column: str. Name of the vector column.
+    - bqstorage_client: BigQueryReadClient or None. Streams results in parallel when set.
+    - dtype: numpy dtype of the matrix.
+    - cache: query_cache.QueryResultCache or None. Serves unchanged results from local disk.
+    """
+    if cache is not None:
+        table = cache.query_arrow(query, bqstorage_client=bqstorage_client)
+        return batches_to_vectors(table.to_batches(), vector_column, table.column_names,
+                                  total_rows=table.num_rows, dtype=dtype)
+    rows = client.query(query).result()
+    return batches_to_vectors(rows.to_arrow_iterable(bqstorage_client=bqstorage_client),
+                              vector_column, [field.name for field in rows.schema],
+                              total_rows=rows.total_rows, dtype=dtype)
@@ -0,0 +1,243 @@
+"""Token-budgeted digests of news articles, cached by content hash.
+
+Every classification prompt about an article used to carry its full content.
+An article within the token budget is kept whole; a longer one is split into
+overlapping chunks and reduced to the sentences of each chunk that best cover
+the article and the label questions, so the digest spans the whole piece
+instead of being truncated at its end. Digests are computed locally, once per
+distinct content, and reused by every prompt.
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import pandas as pd
+
+from instrumentation import estimate_tokens
+
+# Bump when the digest algorithm changes, so cached digests are recomputed
+DIGEST_VERSION = 1
+
+# End of a sentence (with its closing quotes) before a capitalized word, or a line break
+_SENTENCE_END = re.compile(r"[.!?…][\"'”’)\]]*\s+(?=[\"'“‘(\[]?[A-Z0-9])|\n+")
+# A period ending one of these (or an initial) does not end the sentence
+_ABBREVIATION = re.compile(r"(?:\b(?:Mr|Ms|Mrs|Dr|Jr|Sr|St|Prof|Gov|Sen|Rep|Inc|Corp|Co|vs|No)"
+                           r"|\b[A-Za-z]|\b(?:[a-zA-Z]\.)+[a-zA-Z])\.$")
+_WORD = re.compile(r"\w+")
+_STOPWORDS = {
+    "about", "article", "describe", "does", "from", "have", "like", "mention", "more", "such",
+    "suggest", "that", "their", "there", "these", "they", "this", "toward", "were", "what",
+    "when", "which", "with", "would",
+}
+
+
+def content_hash(content):
+    """Return the cache key part identifying an article's content."""
+    return hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+
+
+def label_keywords(labels):
+    """Return the content words of the label questions (e.g. ARTICLE_LABELS), lowercased."""
+    words = set()
+    for question in labels.values():
+        words.update(word for word in _WORD.findall(question.lower())
+                     if len(word) > 3 and word not in _STOPWORDS)
+    return words
+
+
+def split_sentences(text):
+    """Split text into sentences (and paragraphs), without empty ones."""
+    text = text or ""
+    pieces, start = [], 0
+    for match in _SENTENCE_END.finditer(text):
+        end = match.start() + len(match.group().rstrip())
+        pieces.append(text[start:end])
+        start = match.end()
+    pieces.append(text[start:])
+
+    sentences = []
+    for piece in pieces:
+        piece = piece.strip()
+        if not piece:
+            continue
+        if sentences and _ABBREVIATION.search(sentences[-1]) and "\n" not in sentences[-1]:
+            sentences[-1] = f"{sentences[-1]} {piece}"
+        else:
+            sentences.append(piece)
+    return sentences
+
+
+def _split_long_sentence(sentence, max_tokens):
+    words = sentence.split()
+    pieces, piece = [], []
+    for word in words:
+        if piece and estimate_tokens(" ".join(piece + [word])) > max_tokens:
+            pieces.append(" ".join(piece))
+            piece = []
+        piece.append(word)
+    if piece:
+        pieces.append(" ".join(piece))
+    return pieces
+
+
+def chunk_text(text, chunk_tokens=512, overlap_tokens=64):
+    """
+    Split text into chunks of at most chunk_tokens, cut at sentence boundaries.
+
+    Each chunk starts with the last sentences of the previous one, up to
+    overlap_tokens, so a statement spanning a boundary is seen whole by one
+    chunk. Sentences longer than a chunk are cut at word boundaries.
+
+    Returns a list of chunks, each a list of sentences.
+    """
+    sentences = []
+    for sentence in split_sentences(text):
+        sentences += (_split_long_sentence(sentence, chunk_tokens)
+                      if estimate_tokens(sentence) > chunk_tokens else [sentence])
+
+    chunks, chunk, chunk_size = [], [], 0
+    for sentence in sentences:
+        size = estimate_tokens(sentence) + 1
+        if chunk and chunk_size + size > chunk_tokens:
+            chunks.append(chunk)
+            overlap, overlap_size = [], 0
+            for previous in reversed(chunk):
+                previous_size = estimate_tokens(previous) + 1
+                if overlap_size + previous_size > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += previous_size
+            chunk, chunk_size = overlap, overlap_size
+            if chunk_size + size > chunk_tokens:
+                chunk, chunk_size = [], 0
+        chunk.append(sentence)
+        chunk_size += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def digest_text(text, budget_tokens=400, chunk_tokens=512, overlap_tokens=64, keywords=()):
+    """
+    Return (digest, chunks) of a text: itself if within budget_tokens, else its best sentences.
+
+    Each chunk gets a share of the budget proportional to its size and keeps
+    its highest-scoring sentences that fit. A sentence scores the mean document
+    frequency of its words (log-scaled, so it is central to the article)
+    plus one per label keyword it contains. Selected sentences are joined
+    in article order; a sentence repeated by the chunk overlap is kept once.
+
+    Parameters:
+    - text: str. Article content.
+    - budget_tokens: int. Estimated tokens the digest may use.
+    - chunk_tokens, overlap_tokens: int. Chunking of long texts, as chunk_text.
+    - keywords: set[str]. Lowercased words to favor, e.g. label_keywords(ARTICLE_LABELS).
+    """
+    if estimate_tokens(text) <= budget_tokens:
+        return text, 1
+    chunks = chunk_text(text, chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens)
+    frequencies = Counter(_WORD.findall(text.lower()))
+
+    def score(sentence):
+        words = _WORD.findall(sentence.lower())
+        if not words:
+            return 0.0
+        centrality = sum(math.log1p(frequencies[word]) for word in words) / len(words)
+        return centrality + sum(word in keywords for word in set(words))
+
+    chunk_sizes = [sum(estimate_tokens(sentence) + 1 for sentence in chunk) for chunk in chunks]
+    total_size = sum(chunk_sizes)
+    order, selected = {}, set()
+    position = 0
+    unused = 0.0
+    for chunk, chunk_size in zip(chunks, chunk_sizes):
+        # Sentences of the overlap keep the position they had in the previous chunk
+        for sentence in chunk:
+            if sentence not in order:
+                order[sentence] = position
+                position += 1
+        # Budget a chunk could not use (its sentences were too long) passes to the next
+        share = budget_tokens * chunk_size / total_size + unused
+        used = 0
+        for sentence in sorted(chunk, key=score, reverse=True):
+            size = estimate_tokens(sentence) + 1
+            if sentence in selected or used + size > share:
+                continue
+            selected.add(sentence)
+            used += size
+        unused = share - used
+    if not selected:
+        # Every sentence is over budget: keep the start of the best one
+        best = max(order, key=score)
+        return " ".join(_split_long_sentence(best, budget_tokens)[:1]), len(chunks)
+    digest = " ".join(sorted(selected, key=order.get))
+    return digest, len(chunks)
+
+
+class DigestCache:
+    """
+    Article digests stored in a JSON file, keyed by content hash and digest settings.
+
+    Parameters:
+    - path: str. JSON file holding the digests.
+    - budget_tokens, chunk_tokens, overlap_tokens: int. Digest settings, as digest_text.
+    - keywords: set[str]. Label keywords favored by the digests.
+    """
+
+    def __init__(self, path, budget_tokens=400, chunk_tokens=512, overlap_tokens=64, keywords=()):
+        self.path = path
+        self.budget_tokens = budget_tokens
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.keywords = set(keywords)
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        settings = json.dumps([DIGEST_VERSION, budget_tokens, chunk_tokens, overlap_tokens,
+                               sorted(self.keywords)])
+        self._settings_hash = hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+
+    def key(self, content):
+        return f"{self._settings_hash}:{content_hash(content)}"
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def digest_articles(self, article_names, contents):
+        """
+        Return the digest of every article, computing only the ones not cached.
+
+        Returns a DataFrame with article_name, content_hash, digest,
+        content_tokens, digest_tokens, chunks and cached (whether the digest
+        came from the cache). Entries of other settings or contents are
+        dropped, so the file only holds digests still in use.
+        """
+        rows = []
+        used = {}
+        for article_name, content in zip(article_names, contents):
+            key = self.key(content)
+            entry = self.entries.get(key)
+            cached = entry is not None
+            if not cached:
+                digest, chunks = digest_text(content, budget_tokens=self.budget_tokens,
+                                             chunk_tokens=self.chunk_tokens,
+                                             overlap_tokens=self.overlap_tokens,
+                                             keywords=self.keywords)
+                entry = {"digest": digest, "chunks": chunks,
+                         "content_tokens": estimate_tokens(content),
+                         "digest_tokens": estimate_tokens(digest)}
+            used[key] = entry
+            rows.append({"article_name": article_name, "content_hash": key.split(":", 1)[1],
+                         **entry, "cached": cached})
+        self.entries = used
+        return pd.DataFrame(rows, columns=["article_name", "content_hash", "digest", "chunks",
+                                           "content_tokens", "digest_tokens", "cached"])
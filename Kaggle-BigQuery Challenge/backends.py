@@ -0,0 +1,268 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+from queries import DRIVER_METRICS_WINDOWS, get_drivers_aggregates_query
+
+DRIVER_COLUMNS = ["Driver_ID", "Age", "City", "Experience_Years", "Average_Rating"]
+RIDE_COLUMNS = ["Ride_ID", "Driver_ID", "Date", "Duration_min", "Fare"]
+
+DRIVERS_METRICS_COLUMNS = [
+    "driver_ID",
+    "Age",
+    "City",
+    "Experience_Years",
+    "Average_Rating",
+    "active_days",
+    "total_rides_all_days",
+    "max_rides",
+    "avg_rides",
+    "min_fare",
+    "max_fare",
+    "stddev_fare",
+    "total_duration_min_all_days",
+]
+
+
+def _round_half_away(values, decimals=2):
+    """Round like BigQuery ROUND, which rounds halves away from zero."""
+    scale = 10 ** decimals
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5) / scale
+
+
+def _parse_dates(values, date_format):
+    """Parse a column of date strings, converting each distinct value only once."""
+    categories = values.astype("category").cat
+    parsed = pd.to_datetime(categories.categories, format=date_format).to_numpy()
+    codes = categories.codes.to_numpy()
+    return np.where(codes >= 0, parsed[codes], np.datetime64("NaT"))
+
+
+def _aggregate_ride_chunk(chunk, date_format):
+    """Reduce a chunk of rides to partial per-driver, per-day sums."""
+    chunk = chunk[chunk["Driver_ID"].notna()]
+    if date_format is not None:
+        chunk = chunk.assign(Date=_parse_dates(chunk["Date"], date_format))
+    chunk = chunk.assign(fare_sq=chunk["Fare"] * chunk["Fare"])
+    return chunk.groupby(["Driver_ID", "Date"], dropna=False, sort=False).agg(
+        total_rides=("Ride_ID", "count"),
+        fare_sum=("Fare", "sum"),
+        fare_sum_sq=("fare_sq", "sum"),
+        fare_count=("Fare", "count"),
+        duration_sum=("Duration_min", "sum"),
+        duration_count=("Duration_min", "count"),
+    )
+
+
+def aggregate_rides_by_day(rides, chunksize=2_000_000, date_format="%m/%d/%Y"):
+    """
+    Aggregate rides per driver and day, streaming the input in chunks.
+
+    Parameters:
+    - rides: str or pandas.DataFrame. Path to a rides CSV or an in-memory frame.
+    - chunksize: int. Number of CSV rows parsed per batch.
+    - date_format: str or None. strptime format of the Date column, None if already parsed.
+    """
+    if isinstance(rides, pd.DataFrame):
+        chunks = [rides[RIDE_COLUMNS]]
+    else:
+        chunks = pd.read_csv(
+            rides,
+            usecols=RIDE_COLUMNS,
+            dtype={"Ride_ID": "float64", "Driver_ID": "float64", "Date": "category",
+                   "Duration_min": "float64", "Fare": "float64"},
+            chunksize=chunksize,
+        )
+
+    partials = [_aggregate_ride_chunk(chunk, date_format) for chunk in chunks]
+    daily = pd.concat(partials).groupby(level=["Driver_ID", "Date"], dropna=False, sort=False).sum()
+    daily = daily.reset_index()
+    daily["Driver_ID"] = daily["Driver_ID"].astype("int64")
+    return daily
+
+
+def compute_drivers_metrics(drivers, daily_rides):
+    """
+    Reproduce the summary_drivers -> drivers_metrics aggregation of queries.py.
+
+    Parameters:
+    - drivers: pandas.DataFrame. Drivers table with at least DRIVER_COLUMNS.
+    - daily_rides: pandas.DataFrame. Output of aggregate_rides_by_day.
+    """
+    # Grouping keys of both SQL levels are encoded as integers once, on the small drivers table
+    drivers = drivers[DRIVER_COLUMNS].reset_index(drop=True)
+    metrics_keys = ["Driver_ID", "Age", "City", "Experience_Years"]
+    drivers["metrics_key"] = drivers.groupby(metrics_keys, dropna=False, sort=False).ngroup()
+    drivers["summary_key"] = drivers.groupby(DRIVER_COLUMNS, dropna=False, sort=False).ngroup()
+    summary_to_metrics = drivers.groupby("summary_key")["metrics_key"].first().to_numpy()
+
+    merged = drivers[["Driver_ID", "summary_key"]].merge(daily_rides, on="Driver_ID", how="left")
+    merged[["total_rides", "fare_count", "duration_count"]] = (
+        merged[["total_rides", "fare_count", "duration_count"]].fillna(0)
+    )
+
+    # summary_drivers: one row per driver attributes and ride date
+    summary = merged.groupby(["summary_key", "Date"], dropna=False, sort=False).agg(
+        total_rides=("total_rides", "sum"),
+        fare_sum=("fare_sum", "sum"),
+        fare_count=("fare_count", "sum"),
+        duration_sum=("duration_sum", "sum"),
+        duration_count=("duration_count", "sum"),
+    ).reset_index()
+    summary["total_fare"] = _round_half_away(
+        summary["fare_sum"].where(summary["fare_count"] > 0)
+    )
+    summary["total_duration_min"] = summary["duration_sum"].where(summary["duration_count"] > 0)
+    summary["metrics_key"] = summary_to_metrics[summary["summary_key"].to_numpy()]
+
+    # drivers_metrics: lifetime statistics over the per-day rows
+    grouped = summary.groupby("metrics_key", sort=False)
+    metrics = grouped.agg(
+        active_days=("Date", "nunique"),
+        total_rides_all_days=("total_rides", "sum"),
+        max_rides=("total_rides", "max"),
+        avg_rides=("total_rides", "mean"),
+        min_fare=("total_fare", "min"),
+        max_fare=("total_fare", "max"),
+        stddev_fare=("total_fare", "std"),
+    )
+    metrics["total_duration_min_all_days"] = grouped["total_duration_min"].sum(min_count=1)
+    attributes = drivers.groupby("metrics_key", sort=False).agg(
+        **{column: (column, "first") for column in DRIVER_COLUMNS}
+    )
+    metrics = attributes.join(metrics).reset_index(drop=True)
+    metrics = metrics.rename(columns={"Driver_ID": "driver_ID"})
+    metrics[["total_rides_all_days", "max_rides"]] = (
+        metrics[["total_rides_all_days", "max_rides"]].astype("int64")
+    )
+    return metrics[DRIVERS_METRICS_COLUMNS]
+
+
+def compute_driver_window_metrics(daily_rides, as_of, windows=None):
+    """
+    Reproduce get_driver_window_metrics_query of queries.py over the daily aggregates.
+
+    Parameters:
+    - daily_rides: pandas.DataFrame. Output of aggregate_rides_by_day.
+    - as_of: str or datetime-like. Last day of the rolling windows (inclusive).
+    - windows: dict or None. Column suffix -> window length in days (None for
+      lifetime); DRIVER_METRICS_WINDOWS by default.
+    """
+    daily = daily_rides.assign(day_fare=_round_half_away(
+        daily_rides["fare_sum"].where(daily_rides["fare_count"] > 0)))
+    as_of = pd.Timestamp(as_of)
+    metrics = pd.DataFrame(index=pd.Index(daily["Driver_ID"].unique(), name="Driver_ID"))
+    for suffix, days in (windows or DRIVER_METRICS_WINDOWS).items():
+        window = daily
+        if days is not None:
+            first = as_of - pd.Timedelta(days=days - 1)
+            window = daily[(daily["Date"] >= first) & (daily["Date"] <= as_of)]
+        grouped = window.groupby("Driver_ID", sort=False)
+        sums = grouped[["total_rides", "fare_sum", "fare_sum_sq", "fare_count",
+                        "duration_sum"]].sum(min_count=1)
+        fare_count = sums["fare_count"].where(sums["fare_count"] > 0)
+        variance = (sums["fare_sum_sq"] - sums["fare_sum"] ** 2 / fare_count) / (fare_count - 1)
+        metrics[f"rides_{suffix}"] = sums["total_rides"]
+        metrics[f"active_days_{suffix}"] = grouped["Date"].nunique()
+        metrics[f"total_fare_{suffix}"] = _round_half_away(sums["fare_sum"])
+        metrics[f"avg_ride_fare_{suffix}"] = sums["fare_sum"] / fare_count
+        metrics[f"stddev_ride_fare_{suffix}"] = np.sqrt(variance.where(fare_count > 1).clip(lower=0))
+        metrics[f"stddev_daily_fare_{suffix}"] = grouped["day_fare"].std()
+        metrics[f"total_duration_min_{suffix}"] = sums["duration_sum"]
+        counts = [f"rides_{suffix}", f"active_days_{suffix}"]
+        metrics[counts] = metrics[counts].fillna(0).astype("int64")
+    return metrics.reset_index().rename(columns={"Driver_ID": "driver_ID"})
+
+
+class MetricsBackend(ABC):
+    """Engine that computes the numeric drivers_metrics columns."""
+
+    name = None
+
+    @abstractmethod
+    def drivers_metrics(self):
+        """Return a DataFrame with DRIVERS_METRICS_COLUMNS, one row per driver."""
+
+
+class BigQueryMetricsBackend(MetricsBackend):
+    """Run the aggregation remotely as a BigQuery job."""
+
+    name = "bigquery"
+
+    def __init__(self, client, project_id, dataset_id):
+        self.client = client
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+
+    def drivers_metrics(self):
+        query = get_drivers_aggregates_query(project_id=self.project_id,
+                                             dataset_id=self.dataset_id)
+        df = self.client.query(query).result().to_dataframe()
+        return df[DRIVERS_METRICS_COLUMNS]
+
+
+class LocalMetricsBackend(MetricsBackend):
+    """
+    Run the aggregation in-process over the local CSV exports.
+
+    The rides are reduced to driver x day aggregates once, shared by
+    drivers_metrics and driver_window_metrics.
+    """
+
+    name = "local"
+
+    def __init__(self, drivers_path, rides_path, chunksize=2_000_000, date_format="%m/%d/%Y"):
+        self.drivers_path = drivers_path
+        self.rides_path = rides_path
+        self.chunksize = chunksize
+        self.date_format = date_format
+        self._daily_rides = None
+
+    def daily_rides(self):
+        """Return the driver x day aggregates of the rides export, computed on first use."""
+        if self._daily_rides is None:
+            self._daily_rides = aggregate_rides_by_day(self.rides_path,
+                                                       chunksize=self.chunksize,
+                                                       date_format=self.date_format)
+        return self._daily_rides
+
+    def drivers_metrics(self):
+        drivers = pd.read_csv(self.drivers_path, usecols=DRIVER_COLUMNS)
+        return compute_drivers_metrics(drivers, self.daily_rides())
+
+    def driver_window_metrics(self, as_of=None, windows=None):
+        """
+        Return the metrics of get_driver_window_metrics_query, computed locally.
+
+        Parameters:
+        - as_of: str, datetime-like or None. Last day of the rolling windows;
+          the last ride date of the export when None.
+        - windows: dict or None. Column suffix -> window length in days, as
+          compute_driver_window_metrics.
+        """
+        daily = self.daily_rides()
+        if as_of is None:
+            as_of = daily["Date"].max()
+        return compute_driver_window_metrics(daily, as_of, windows=windows)
+
+
+METRICS_BACKENDS = {
+    BigQueryMetricsBackend.name: BigQueryMetricsBackend,
+    LocalMetricsBackend.name: LocalMetricsBackend,
+}
+
+
+def get_metrics_backend(name, **kwargs):
+    """
+    Instantiate a metrics backend by name.
+
+    Parameters:
+    - name: str. One of METRICS_BACKENDS ("bigquery" or "local").
+    - kwargs: Constructor arguments of the selected backend.
+    """
+    try:
+        backend_cls = METRICS_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown metrics backend '{name}'. Choose from {sorted(METRICS_BACKENDS)}")
+    return backend_cls(**kwargs)
@@ -0,0 +1,362 @@
+"""End-to-end benchmark of the drivers pipeline on synthetic data, with local stand-ins.
+
+Every stage of main.py is timed against an in-process equivalent, so runs are
+repeatable and free: staging replaces the load jobs, the local metrics backend
+replaces the aggregation and window metrics queries, rule-based reasons and tags
+replace the Gemini calls and a hashing embedder replaces the Vertex AI embedding
+model. The similarity index is also checked for recall@k against exact search. Results are appended to a JSON-lines history and compared with the
+previous run at the same scale.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from backends import LocalMetricsBackend
+from embedding_store import EmbeddingStore
+from article_digests import DigestCache
+from near_duplicates import NearDuplicateIndex
+from prescoring import StressPrescorer
+from projection import project_embeddings
+from similarity import ExactIndex, IVFIndex, benchmark_index
+from staging import stage_csv_to_parquet
+from synthetic_data import write_dataset
+from tags import TagMatrix, TagVocabulary, compose_driver_vectors
+
+
+def hashing_embed(texts, dim=256):
+    """Embed texts as normalized bags of hashed tokens; a stand-in for the embedding model."""
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for token in text.lower().replace(",", " ").split():
+            vectors[row, zlib.crc32(token.encode("utf-8")) % dim] += 1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def synthetic_articles(n_articles, duplicate_share=0.3, words=400, seed=42):
+    """
+    Return (article ids, texts, original article ids) of stories and syndicated copies.
+
+    A copy repeats an earlier story with a byline, a footer and one word in
+    200 replaced.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"word{i}" for i in range(20_000)], dtype=object)
+    stories = []
+    ids, texts, originals = [], [], []
+    for i in range(n_articles):
+        if stories and rng.random() < duplicate_share:
+            original, story = stories[int(rng.integers(len(stories)))]
+            tokens = story.split()
+            for position in rng.integers(0, len(tokens), len(tokens) // 200):
+                tokens[position] = str(rng.choice(vocabulary))
+            text = "By Wire Service " + " ".join(tokens) + " Read more on our site"
+        else:
+            sentences = rng.choice(vocabulary, (words // 20, 20))
+            original = f"article{i}"
+            text = " ".join(" ".join(sentence).capitalize() + "." for sentence in sentences)
+            stories.append((original, text))
+        ids.append(f"article{i}")
+        texts.append(text)
+        originals.append(original)
+    return ids, texts, originals
+
+
+def stand_in_reasons(metrics):
+    """
+    Derive a stress reason and tags per driver from its metrics, in place of the LLM.
+
+    Returns a DataFrame with driver_ID, stress_reason and stress_report_tags.
+    """
+    rules = [
+        ("long hours", metrics["avg_rides"] > metrics["avg_rides"].quantile(0.75)),
+        ("low pay", metrics["min_fare"] < metrics["min_fare"].quantile(0.25)),
+        ("unpredictable income", metrics["stddev_fare"] > metrics["stddev_fare"].quantile(0.75)),
+        ("burnout", metrics["active_days"] > metrics["active_days"].quantile(0.9)),
+        ("low rating pressure", metrics["Average_Rating"] < 4.0),
+    ]
+    tags = pd.Series("", index=metrics.index)
+    for tag, mask in rules:
+        tags = tags.where(~mask, tags + ", " + tag)
+    tags = tags.str.lstrip(", ").replace("", "no stress")
+    text = (metrics[["avg_rides", "active_days", "City", "min_fare", "max_fare"]].round(1)
+            .astype(str).fillna("n/a"))
+    reasons = ("Drives " + text["avg_rides"] + " rides a day over " + text["active_days"]
+               + " days in " + text["City"] + " with fares from " + text["min_fare"]
+               + " to " + text["max_fare"] + "; " + tags)
+    return pd.DataFrame({"driver_ID": metrics["driver_ID"],
+                         "stress_reason": reasons,
+                         "stress_report_tags": tags})
+
+
+# Seconds each module may take to import in a fresh interpreter; scheduled short jobs
+# pay this on every start, so heavy libraries must stay out of these import paths
+IMPORT_TIME_BUDGETS = {
+    "cli": 0.2,
+    "main": 2.0,
+}
+
+
+def measure_import_seconds(module, repeats=5):
+    """Return the best wall time of importing module in a fresh interpreter, in seconds."""
+    code = (f"import time; start = time.perf_counter(); import {module}; "
+            f"print(time.perf_counter() - start)")
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(float(output.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def check_import_times(budgets=None, repeats=5):
+    """
+    Measure the import time of every module of budgets and return those over budget.
+
+    Returns {module: {"seconds": ..., "budget": ...}} of the modules too slow to import.
+    """
+    budgets = IMPORT_TIME_BUDGETS if budgets is None else budgets
+    over_budget = {}
+    for module, budget in budgets.items():
+        seconds = measure_import_seconds(module, repeats=repeats)
+        print(f"[benchmark] import {module}: {seconds:.3f}s (budget {budget:.1f}s)")
+        if seconds > budget:
+            over_budget[module] = {"seconds": round(seconds, 3), "budget": budget}
+    return over_budget
+
+
+def _built(index, ids, vectors):
+    index.add(ids, vectors)
+    return index
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(drivers_schema, rides_schema, n_drivers=10_000, n_rides=1_000_000,
+                  work_dir="cache/benchmark", chunksize=1_000_000, n_landmarks=5000,
+                  n_articles=5000, n_queries=1000, k=10, seed=42, keep_data=False):
+    """
+    Generate a dataset, time every stage on it and return the result record.
+
+    Parameters:
+    - drivers_schema, rides_schema: list[bigquery.SchemaField]. Schemas used by staging.
+    - n_drivers: int. Synthetic drivers.
+    - n_rides: int. Synthetic rides.
+    - work_dir: str. Directory for generated data, staged Parquet and caches.
+    - chunksize: int. Rides generated per chunk.
+    - n_landmarks: int. Landmarks of the t-SNE projection.
+    - n_articles: int. Synthetic news articles deduplicated (about 30% syndicated
+      copies), then digested.
+    - n_queries: int. Driver embeddings queried against the similarity index.
+    - k: int. Neighbours per query when measuring the index's recall.
+    - seed: int. Random seed of the generator.
+    - keep_data: bool. Keep work_dir after the run.
+    """
+    stages = {}
+    similarity = None
+
+    def timed(name, func, rows_of=len):
+        start = time.perf_counter()
+        result = func()
+        stages[name] = {
+            "seconds": round(time.perf_counter() - start, 4),
+            "rows": rows_of(result) if rows_of else None,
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+        }
+        print(f"[benchmark] {name}: {stages[name]['seconds']:.2f}s")
+        return result
+
+    data_dir = os.path.join(work_dir, "data")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    try:
+        drivers_path, rides_path = timed(
+            "generate",
+            lambda: write_dataset(data_dir, n_drivers, n_rides, chunksize=chunksize, seed=seed),
+            rows_of=lambda _: n_rides)
+
+        timed("load_drivers",
+              lambda: stage_csv_to_parquet(drivers_path, drivers_schema,
+                                           os.path.join(work_dir, "staging", "drivers.parquet")),
+              rows_of=lambda _: n_drivers)
+        timed("load_rides",
+              lambda: stage_csv_to_parquet(rides_path, rides_schema,
+                                           os.path.join(work_dir, "staging", "rides.parquet")),
+              rows_of=lambda _: n_rides)
+
+        backend = LocalMetricsBackend(drivers_path, rides_path)
+        metrics = timed("metrics_aggregation", backend.drivers_metrics)
+        timed("window_metrics", backend.driver_window_metrics)
+        timed("prescoring", lambda: StressPrescorer().triage(metrics))
+        reasons = timed("tagging", lambda: stand_in_reasons(metrics))
+
+        store = EmbeddingStore(os.path.join(work_dir, "embeddings"))
+        texts = reasons["stress_reason"].tolist()
+        X = timed("embedding", lambda: store.embed(texts, "hashing-256", hashing_embed))
+        timed("embedding_cached", lambda: store.embed(texts, "hashing-256", hashing_embed))
+
+        ids = reasons["driver_ID"].to_numpy()
+        exact = ExactIndex()
+        exact.add(ids, X)
+        index = timed("similarity_index",
+                      lambda: _built(IVFIndex(n_lists=max(1, int(np.sqrt(len(X))))), ids, X))
+        queries = X[np.random.default_rng(seed).choice(len(X), min(n_queries, len(X)),
+                                                       replace=False)]
+        similarity = timed("similarity_query",
+                           lambda: benchmark_index(index, exact, queries, k=k),
+                           rows_of=lambda r: r["queries"])
+
+        vocabulary = TagVocabulary()
+        matrix = timed("tag_normalization",
+                       lambda: TagMatrix.from_tag_strings(ids, reasons["stress_report_tags"],
+                                                          vocabulary),
+                       rows_of=lambda m: m.shape[0])
+        timed("tag_embedding",
+              lambda: compose_driver_vectors(matrix, store.embed(vocabulary.labels, "hashing-256",
+                                                                 hashing_embed)))
+        labels = np.array(vocabulary.labels + [None], dtype=object)[matrix.first_tags()]
+        projection_dir = os.path.join(work_dir, "projections")
+        timed("projection", lambda: project_embeddings(ids, X, labels=labels,
+                                                       cache_dir=projection_dir,
+                                                       n_landmarks=n_landmarks))
+        timed("projection_cached", lambda: project_embeddings(ids, X, labels=labels,
+                                                              cache_dir=projection_dir,
+                                                              n_landmarks=n_landmarks))
+
+        article_ids, article_texts, originals = synthetic_articles(n_articles, seed=seed)
+        clusters = timed("article_dedupe",
+                         lambda: NearDuplicateIndex().add_many(article_ids, article_texts))
+        found = clusters["canonical_article_name"].to_numpy()
+        expected = np.array(originals, dtype=object)
+        print(f"[benchmark] article_dedupe: {clusters['canonical_article_name'].nunique()} of "
+              f"{n_articles} articles scored, {np.mean(found == expected):.1%} clustered "
+              f"with their original")
+
+        scored = clusters["article_name"] == clusters["canonical_article_name"]
+        scored_ids = clusters["article_name"][scored].tolist()
+        scored_texts = [text for text, keep in zip(article_texts, scored) if keep]
+        digest_cache = DigestCache(os.path.join(work_dir, "article_digests.json"), budget_tokens=400)
+        digests = timed("article_digests",
+                        lambda: digest_cache.digest_articles(scored_ids, scored_texts))
+        timed("article_digests_cached",
+              lambda: digest_cache.digest_articles(scored_ids, scored_texts))
+        saved = int(digests["content_tokens"].sum() - digests["digest_tokens"].sum())
+        print(f"[benchmark] article_digests: {saved} of {int(digests['content_tokens'].sum())} "
+              f"prompt tokens saved per scoring run")
+    finally:
+        if not keep_data:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "run_at": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "scale": {"drivers": n_drivers, "rides": n_rides, "landmarks": n_landmarks,
+                  "articles": n_articles, "queries": n_queries},
+        "stages": stages,
+        "similarity": similarity,
+        "total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 4),
+    }
+
+
+def load_results(results_path):
+    """Return every recorded benchmark result, oldest first."""
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_results(result, baseline, tolerance=0.25, min_seconds=0.5):
+    """
+    Return the stages of result slower than baseline by more than tolerance.
+
+    Stages faster than min_seconds in both runs are ignored as noise.
+    """
+    regressions = {}
+    for name, stage in result["stages"].items():
+        previous = baseline["stages"].get(name)
+        if previous is None or max(stage["seconds"], previous["seconds"]) < min_seconds:
+            continue
+        ratio = stage["seconds"] / max(previous["seconds"], 1e-9)
+        if ratio > 1 + tolerance:
+            regressions[name] = {"baseline_seconds": previous["seconds"],
+                                 "seconds": stage["seconds"], "ratio": round(ratio, 2)}
+    return regressions
+
+
+def record_result(result, results_path, tolerance=0.25):
+    """Compare result with the last run at the same scale, then append it to the history."""
+    previous = [r for r in load_results(results_path) if r["scale"] == result["scale"]]
+    regressions = {}
+    if previous:
+        baseline = previous[-1]
+        regressions = compare_results(result, baseline, tolerance=tolerance)
+        print(f"Compared with {baseline['run_at']} (commit {baseline['commit']}): "
+              f"{len(regressions)} regressions")
+        for name, regression in regressions.items():
+            print(f"  {name}: {regression['baseline_seconds']:.2f}s -> "
+                  f"{regression['seconds']:.2f}s (x{regression['ratio']})")
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    with open(results_path, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--drivers", type=int, default=10_000)
+    arg_parser.add_argument("--rides", type=int, default=1_000_000)
+    arg_parser.add_argument("--chunksize", type=int, default=1_000_000)
+    arg_parser.add_argument("--landmarks", type=int, default=5000)
+    arg_parser.add_argument("--articles", type=int, default=5000)
+    arg_parser.add_argument("--queries", type=int, default=1000)
+    arg_parser.add_argument("--work-dir", default="cache/benchmark")
+    arg_parser.add_argument("--results", default="benchmarks/results.jsonl")
+    arg_parser.add_argument("--tolerance", type=float, default=0.25)
+    arg_parser.add_argument("--keep-data", action="store_true")
+    arg_parser.add_argument("--imports", action="store_true",
+                            help="Only check import times against IMPORT_TIME_BUDGETS.")
+    args = arg_parser.parse_args()
+
+    if args.imports:
+        raise SystemExit(1 if check_import_times() else 0)
+
+    from parameters import drivers_data_schema, rides_data_schema
+
+    result = run_benchmark(drivers_data_schema, rides_data_schema,
+                           n_drivers=args.drivers, n_rides=args.rides,
+                           work_dir=args.work_dir, chunksize=args.chunksize,
+                           n_landmarks=args.landmarks, n_articles=args.articles,
+                           n_queries=args.queries,
+                           keep_data=args.keep_data)
+    regressions = record_result(result, args.results, tolerance=args.tolerance)
+    raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
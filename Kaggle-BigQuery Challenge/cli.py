@@ -0,0 +1,159 @@
+"""Run the drivers pipeline, or one part of it, from the command line.
+
+    python cli.py load                      # upload the drivers and rides CSVs
+    python cli.py metrics --force           # rebuild the metrics marts
+    python cli.py metrics --metrics-backend local  # numeric metrics from the CSVs, no BigQuery
+    python cli.py --marts-mode table tags   # settings come from flags or env
+    python cli.py --news-scoring true news  # dedupe and score the news articles
+    python cli.py similar 1001 -k 5         # drivers closest to one, from the index
+    python cli.py run                       # every stage
+
+Only the standard library is imported until a subcommand runs; main.py (and
+through it BigQuery, pandas, ...) is imported by the subcommand, and heavier
+libraries (bigframes, matplotlib, scikit-learn) only by the stages using them.
+"""
+
+import argparse
+import os
+import sys
+
+# Stages run by each subcommand; "run" runs every stage of the pipeline
+COMMAND_STAGES = {
+    "load": ["upload_drivers", "upload_rides"],
+    "metrics": ["driver_window_metrics", "prescore_drivers", "drivers_metrics"],
+    "tags": ["drivers_reason_tags", "driver_tag_matrix"],
+    "embed": ["driver_reason_embeddings"],
+    "index": ["driver_similarity_index"],
+    "plot": ["plot_driver_reason_embeddings"],
+    "news": ["dedupe_articles", "article_digests", "articles_metrics"],
+}
+
+# Flags overriding parameters.py settings: (flag, setting name, argparse options)
+SETTING_FLAGS = [
+    ("--project", "project_id", {}),
+    ("--staging-dataset", "staging_dataset_id", {}),
+    ("--marts-dataset", "marts_dataset_id", {}),
+    ("--connection", "connection_id", {}),
+    ("--marts-mode", "marts_mode", {"choices": ["table", "view"]}),
+    ("--load-mode", "rides_load_mode", {"choices": ["incremental", "truncate"]}),
+    ("--prompt-execution", "prompt_execution", {"choices": ["bigquery", "client"]}),
+    ("--prescoring", "stress_prescoring", {"choices": ["true", "false"]}),
+    ("--llm-tokens-per-minute", "llm_tokens_per_minute", {}),
+    ("--prompt-cache-ttl-hours", "prompt_cache_ttl_hours", {}),
+    ("--news-scoring", "news_scoring", {"choices": ["true", "false"]}),
+    ("--news-dedupe", "news_dedupe", {"choices": ["true", "false"]}),
+    ("--article-token-budget", "article_token_budget", {}),
+    ("--drivers-csv", "drivers_csv_path", {}),
+    ("--rides-csv", "rides_csv_path", {}),
+    ("--metrics-dir", "metrics_dir", {}),
+    ("--similarity-index", "similarity_index_kind", {"choices": ["ivf", "exact"]}),
+]
+
+
+def build_parser():
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    for flag, setting, options in SETTING_FLAGS:
+        arg_parser.add_argument(flag, dest=setting, default=None,
+                                help=f"Overrides the {setting} setting.", **options)
+
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    for command, stages in [*COMMAND_STAGES.items(), ("run", None)]:
+        subparser = subparsers.add_parser(
+            command, help=f"Run {', '.join(stages) if stages else 'every stage'}.")
+        subparser.add_argument("--force", action="store_true",
+                               help="Run the stages even if their inputs are unchanged.")
+        if command == "metrics":
+            subparser.add_argument(
+                "--metrics-backend", choices=["bigquery", "local"], default=None,
+                help="Only compute the numeric drivers_metrics columns with this backend "
+                     "and write them to --out, instead of running the stages.")
+            subparser.add_argument("--out", default="drivers_metrics.csv",
+                                   help="CSV written with --metrics-backend.")
+
+    similar_parser = subparsers.add_parser(
+        "similar", help="Print the drivers closest to a driver in the similarity index.")
+    similar_parser.add_argument("driver_id", type=int)
+    similar_parser.add_argument("-k", type=int, default=10, help="Drivers to print.")
+    clusters_parser = subparsers.add_parser(
+        "clusters", help="Group the drivers of the similarity index by stress reason.")
+    clusters_parser.add_argument("-n", "--clusters", type=int, default=8, dest="n_clusters",
+                                 help="Number of k-means clusters.")
+    return arg_parser
+
+
+def apply_settings(args):
+    """Export the given setting flags as environment variables read by parameters.py."""
+    for _, setting, _ in SETTING_FLAGS:
+        value = getattr(args, setting)
+        if value is not None:
+            os.environ[setting] = value
+
+
+def run_command(command, force=False):
+    """
+    Run the pipeline stages of a subcommand and write the run metrics.
+
+    Stages of the command that are disabled by the settings (e.g.
+    prescore_drivers without stress_prescoring) are left out.
+    """
+    import main
+
+    pipeline = main.build_pipeline()
+    stages = list(pipeline.stages) if command == "run" else \
+        [stage for stage in COMMAND_STAGES[command] if stage in pipeline.stages]
+    try:
+        return pipeline.run(only=None if command == "run" else stages,
+                            force=stages if force else ())
+    finally:
+        main.instrumentation.write_json(os.path.join(main.metrics_dir, f"{command}_run.json"))
+        main.instrumentation.write_prometheus(os.path.join(main.metrics_dir, f"{command}.prom"))
+
+
+def compute_metrics(backend, out_path):
+    """Compute the numeric drivers_metrics columns with a metrics backend and save them as CSV."""
+    import main
+
+    df = main.compute_drivers_metrics_df(backend=backend)
+    df.to_csv(out_path, index=False)
+    print(f"Wrote {len(df)} drivers to {out_path}")
+    return 0
+
+
+def query_index(args):
+    """Answer the similar and clusters subcommands from the saved similarity index."""
+    import main
+
+    if args.command == "similar":
+        try:
+            print(main.find_similar_drivers(args.driver_id, k=args.k).to_string(index=False))
+        except KeyError as e:
+            print(e.args[0], file=sys.stderr)
+            return 1
+    else:
+        clusters = main.cluster_drivers(n_clusters=args.n_clusters)
+        summary = clusters.groupby("cluster")["driver_ID"].agg(
+            drivers="count", first_drivers=lambda ids: ids.head(10).tolist())
+        print(summary.to_string())
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    apply_settings(args)
+    if args.command in ("similar", "clusters"):
+        return query_index(args)
+    if args.command == "metrics" and args.metrics_backend:
+        return compute_metrics(args.metrics_backend, args.out)
+    from pipeline import PipelineError
+
+    try:
+        run_command(args.command, force=args.force)
+    except PipelineError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+"""Shared fixtures of the tests: local HTTP servers standing in for remote services."""
+
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+
+@pytest.fixture
+def serve():
+    """
+    Return a function starting a threaded HTTP server for a handler class.
+
+    Calling it returns the server's base URL; every server is shut down when
+    the test ends.
+    """
+    servers = []
+
+    def start(handler_class):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
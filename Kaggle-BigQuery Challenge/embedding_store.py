@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def embedding_key(model_name, text):
+    """Return the store key of a text embedded with a given model."""
+    return hashlib.sha256(f"{model_name}\x1f{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Append-only, memory-mapped store of embedding vectors.
+
+    Vectors live in a single contiguous float32 file (row i belongs to the i-th
+    key of keys.txt), so opening the store only reads the key index and maps the
+    matrix without copying it. Keys are embedding_key(model_name, text).
+
+    Parameters:
+    - path: str. Directory holding meta.json, keys.txt and vectors.f32.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dim = None
+        self._index = {}
+        self._vectors = None
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.dim = json.load(f)["dim"]
+            self._load()
+
+    @property
+    def _keys_path(self):
+        return os.path.join(self.path, "keys.txt")
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.path, "vectors.f32")
+
+    def _load(self):
+        with open(self._keys_path) as f:
+            keys = f.read().split()
+        rows = os.path.getsize(self._vectors_path) // (4 * self.dim)
+        if rows != len(keys):
+            # A write interrupted between the two files; drop the unmatched tail of both
+            keys = keys[:rows]
+            os.truncate(self._vectors_path, len(keys) * 4 * self.dim)
+            with open(self._keys_path, "w") as f:
+                f.write("".join(f"{key}\n" for key in keys))
+        self._index = {key: row for row, key in enumerate(keys)}
+        self._vectors = None
+        if keys:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                      shape=(len(keys), self.dim))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    @property
+    def vectors(self):
+        """Memory-mapped (n, dim) float32 matrix of every stored vector."""
+        if self._vectors is None:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return self._vectors
+
+    def get(self, keys):
+        """Return the (len(keys), dim) float32 matrix of the given keys."""
+        rows = np.fromiter((self._index[key] for key in keys), dtype=np.int64, count=len(keys))
+        return np.asarray(self.vectors[rows])
+
+    def add(self, keys, vectors):
+        """Append vectors for keys not stored yet; existing keys are left untouched."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(keys):
+            raise ValueError("vectors must be a 2D array with one row per key")
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, "meta.json"), "w") as f:
+                json.dump({"dim": self.dim}, f)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+
+        new_keys = []
+        new_rows = []
+        seen = set(self._index)
+        for row, key in enumerate(keys):
+            if key not in seen:
+                seen.add(key)
+                new_keys.append(key)
+                new_rows.append(row)
+        if not new_keys:
+            return 0
+
+        with open(self._vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors[new_rows]).tobytes())
+        with open(self._keys_path, "a") as f:
+            f.write("".join(f"{key}\n" for key in new_keys))
+        self._load()
+        return len(new_keys)
+
+    def embed(self, texts, model_name, embed_fn):
+        """
+        Return a (len(texts), dim) float32 matrix, embedding only texts not stored yet.
+
+        Parameters:
+        - texts: list[str]. Texts to embed; duplicates are embedded once.
+        - model_name: str. Embedding model, part of the store key.
+        - embed_fn: callable. Maps a list of texts to one vector per text, in order.
+        """
+        keys = [embedding_key(model_name, text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self._index:
+                missing.setdefault(key, text)
+
+        if missing:
+            vectors = embed_fn(list(missing.values()))
+            self.add(list(missing.keys()), vectors)
+        print(f"Embedding store: {len(set(keys)) - len(missing)} cached, {len(missing)} embedded")
+        return self.get(keys)
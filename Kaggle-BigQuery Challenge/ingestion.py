@@ -0,0 +1,212 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from instrumentation import UNSTAGED, instrumentation
+
+# BigQuery streaming inserts accept up to 10 MB per request; stay well below it.
+DEFAULT_MAX_BATCH_ROWS = 500
+DEFAULT_MAX_BATCH_BYTES = 5 * 1024 * 1024
+
+# Rows rejected for their content fail the same way on every attempt
+NON_RETRYABLE_REASONS = {"invalid"}
+
+
+@dataclass
+class RowError:
+    """A row that could not be inserted after all retries."""
+
+    row_index: int
+    row_id: object
+    errors: list
+    attempts: int
+
+
+@dataclass
+class InsertReport:
+    """Outcome of a bulk insert, with one entry per failed row."""
+
+    table_id: str
+    rows_submitted: int = 0
+    rows_inserted: int = 0
+    requests_sent: int = 0
+    failed_rows: list = field(default_factory=list)
+
+    @property
+    def ok(self):
+        return not self.failed_rows
+
+
+def _row_size(row):
+    """Approximate the request payload size of a row in bytes."""
+    return len(json.dumps(row, default=str).encode("utf-8"))
+
+
+class BulkInsertSink:
+    """
+    Buffer rows and stream them to BigQuery in bounded, concurrent batches.
+
+    Batches are cut when either max_batch_rows or max_batch_bytes is reached and
+    sent through a pool of at most max_workers in-flight insert_rows_json
+    requests. Rows rejected by a batch are retried one by one with exponential
+    backoff; whatever still fails is recorded in the returned InsertReport.
+    Requests are instrumented under the stage that submitted their batch, or
+    the stage that created the sink when rows are added from outside any stage.
+
+    Parameters:
+    - client: Object exposing insert_rows_json(table_id, rows, row_ids=...),
+      usually a bigquery.Client.
+    - table_id: str. Full table path of the destination table.
+    - id_column_name: str or None. Column used as insertId so retries are deduplicated;
+      rows without a value are sent without insertId.
+    - max_batch_rows: int. Maximum rows per request.
+    - max_batch_bytes: int. Maximum approximate payload bytes per request.
+    - max_workers: int. Maximum concurrent requests.
+    - max_retries: int. Per-row retries after the batch attempt.
+    - backoff_seconds: float. Base delay of the exponential backoff.
+    """
+
+    def __init__(self, client, table_id, id_column_name=None,
+                 max_batch_rows=DEFAULT_MAX_BATCH_ROWS,
+                 max_batch_bytes=DEFAULT_MAX_BATCH_BYTES,
+                 max_workers=4, max_retries=3, backoff_seconds=0.5):
+        self.client = client
+        self.table_id = table_id
+        self.id_column_name = id_column_name
+        self.max_batch_rows = max_batch_rows
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+
+        self.report = InsertReport(table_id=table_id)
+        self._stage = instrumentation.current_stage
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Bound queued batches as well, so a fast producer cannot buffer the whole input
+        self._in_flight = threading.BoundedSemaphore(max_workers * 2)
+        self._futures = []
+        self._batch = []
+        self._batch_bytes = 0
+        self._next_index = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, row):
+        """Queue a single row, sending the current batch once it is full."""
+        size = _row_size(row)
+        if self._batch and (len(self._batch) >= self.max_batch_rows
+                            or self._batch_bytes + size > self.max_batch_bytes):
+            self.flush()
+        self._batch.append((self._next_index, row))
+        self._batch_bytes += size
+        self._next_index += 1
+
+    def extend(self, rows):
+        """Queue every row of an iterable."""
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        """Submit the buffered rows as one request."""
+        if not self._batch:
+            return
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+        stage = instrumentation.current_stage
+        if stage == UNSTAGED:
+            stage = self._stage
+        self._in_flight.acquire()
+        future = self._executor.submit(self._send_batch, batch, stage)
+        future.add_done_callback(lambda _: self._in_flight.release())
+        self._futures.append(future)
+
+    def close(self):
+        """Flush pending rows, wait for all requests and return the InsertReport."""
+        self.flush()
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        self._executor.shutdown(wait=True)
+        self.report.failed_rows.sort(key=lambda error: error.row_index)
+        return self.report
+
+    def _row_id(self, row):
+        # A row without an id is sent without insertId rather than deduplicated as "None"
+        if self.id_column_name is None or row.get(self.id_column_name) is None:
+            return None
+        return str(row[self.id_column_name])
+
+    def _insert(self, rows):
+        """Send one insert_rows_json request, returning its per-row errors."""
+        row_ids = None
+        if self.id_column_name is not None:
+            row_ids = [self._row_id(row) for row in rows]
+        with self._lock:
+            self.report.requests_sent += 1
+        try:
+            if row_ids is None:
+                return self.client.insert_rows_json(self.table_id, rows)
+            return self.client.insert_rows_json(self.table_id, rows, row_ids=row_ids)
+        except Exception as e:
+            return [{"index": i, "errors": [{"reason": type(e).__name__, "message": str(e)}]}
+                    for i in range(len(rows))]
+
+    def _send_batch(self, batch, stage):
+        with instrumentation.attributed_to(stage):
+            self._insert_batch(batch)
+
+    def _insert_batch(self, batch):
+        rows = [row for _, row in batch]
+        errors = self._insert(rows)
+        failed = {error["index"]: error.get("errors", []) for error in errors}
+
+        with self._lock:
+            self.report.rows_submitted += len(batch)
+            self.report.rows_inserted += len(batch) - len(failed)
+
+        for position, first_errors in sorted(failed.items()):
+            row_index, row = batch[position]
+            self._retry_row(row_index, row, first_errors)
+
+    def _retry_row(self, row_index, row, errors):
+        attempts = 1
+        for attempt in range(self.max_retries):
+            if any(error.get("reason") in NON_RETRYABLE_REASONS for error in errors):
+                break
+            delay = self.backoff_seconds * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay))
+            attempts += 1
+            retry_errors = self._insert([row])
+            if not retry_errors:
+                with self._lock:
+                    self.report.rows_inserted += 1
+                return
+            errors = retry_errors[0].get("errors", [])
+
+        with self._lock:
+            self.report.failed_rows.append(
+                RowError(row_index=row_index, row_id=self._row_id(row),
+                         errors=errors, attempts=attempts)
+            )
+
+
+def insert_rows(client, table_id, rows, id_column_name=None, **sink_options):
+    """
+    Insert an iterable of JSON rows through a BulkInsertSink and return its report.
+
+    Parameters:
+    - client: bigquery.Client or a compatible fake.
+    - table_id: str. Full table path of the destination table.
+    - rows: iterable of dict. Rows to insert.
+    - id_column_name: str or None. Column used as insertId for deduplication.
+    - sink_options: Extra BulkInsertSink keyword arguments.
+    """
+    with BulkInsertSink(client, table_id, id_column_name=id_column_name, **sink_options) as sink:
+        sink.extend(rows)
+    return sink.report
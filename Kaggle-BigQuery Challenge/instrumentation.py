@@ -0,0 +1,377 @@
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+UNSTAGED = "unstaged"
+
+# Numeric job statistics accumulated per stage, as exposed by QueryJob and LoadJob
+JOB_STATISTICS = [
+    "total_bytes_processed",
+    "total_bytes_billed",
+    "slot_millis",
+    "num_dml_affected_rows",
+    "input_file_bytes",
+    "output_bytes",
+    "output_rows",
+]
+
+
+def estimate_tokens(text):
+    """Approximate the number of model tokens of a text (about 4 characters per token)."""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def _new_stage_record():
+    return {
+        "status": None,
+        "seconds": 0.0,
+        "rows": 0,
+        "bytes_loaded": 0,
+        "calls": defaultdict(lambda: {"count": 0, "seconds": 0.0}),
+        "jobs": defaultdict(int),
+        "job_statistics": defaultdict(int),
+        "cache_hits": 0,
+        "llm": defaultdict(lambda: {"calls": 0, "input_tokens": 0, "output_tokens": 0,
+                                    "saved_input_tokens": 0}),
+        "profile": None,
+    }
+
+
+class Instrumentation:
+    """
+    Collect per-stage timings, row and byte counts, BigQuery job statistics and
+    LLM call accounting, and export them as JSON and Prometheus text format.
+
+    The current stage is tracked per thread, so stages running concurrently in a
+    thread pool are accounted separately; work a stage hands to other threads is
+    attributed to it with attributed_to. Anything recorded outside a stage goes
+    to the "unstaged" record.
+
+    Parameters:
+    - profile_dir: str or None. When set, stages opened with profile=True are run
+      under cProfile and their stats written to <profile_dir>/<stage>.prof.
+    """
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.started_at = datetime.now(timezone.utc)
+        self.stages = defaultdict(_new_stage_record)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # cProfile cannot profile two threads at once; concurrent stages skip profiling
+        self._profiler_lock = threading.Lock()
+
+    @property
+    def current_stage(self):
+        return getattr(self._local, "stage", None) or UNSTAGED
+
+    @contextmanager
+    def stage(self, name, profile=False):
+        """Time a block as a stage, optionally under cProfile."""
+        previous = getattr(self._local, "stage", None)
+        self._local.stage = name
+        profiler = None
+        if profile and self.profile_dir and self._profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        status = "failed"
+        try:
+            yield
+            status = "ok"
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profile_path = os.path.join(self.profile_dir, f"{name}.prof")
+                profiler.dump_stats(profile_path)
+                self._profiler_lock.release()
+            with self._lock:
+                record = self.stages[name]
+                record["seconds"] += elapsed
+                record["status"] = status
+                if profiler is not None:
+                    record["profile"] = profile_path
+            self._local.stage = previous
+
+    @contextmanager
+    def attributed_to(self, name):
+        """
+        Record what the current thread does in a block under stage name, without timing it.
+
+        Worker threads use it to account their work to the stage that submitted it.
+        """
+        previous = getattr(self._local, "stage", None)
+        self._local.stage = name
+        try:
+            yield
+        finally:
+            self._local.stage = previous
+
+    def set_status(self, status):
+        """Override the status of the current stage, e.g. "skipped"."""
+        with self._lock:
+            self.stages[self.current_stage]["status"] = status
+
+    def record_call(self, name, seconds):
+        with self._lock:
+            call = self.stages[self.current_stage]["calls"][name]
+            call["count"] += 1
+            call["seconds"] += seconds
+
+    def record_rows(self, rows, bytes_loaded=0):
+        with self._lock:
+            record = self.stages[self.current_stage]
+            record["rows"] += int(rows or 0)
+            record["bytes_loaded"] += int(bytes_loaded or 0)
+
+    def record_job(self, job):
+        """Accumulate the statistics of a finished BigQuery job into the current stage."""
+        with self._lock:
+            record = self.stages[self.current_stage]
+            record["jobs"][getattr(job, "job_type", "unknown")] += 1
+            for statistic in JOB_STATISTICS:
+                value = getattr(job, statistic, None)
+                if isinstance(value, (int, float)):
+                    record["job_statistics"][statistic] += int(value)
+            if getattr(job, "cache_hit", False):
+                record["cache_hits"] += 1
+            record["bytes_loaded"] += int(getattr(job, "input_file_bytes", None) or 0)
+
+    def record_llm(self, model, calls, input_tokens=0, output_tokens=0):
+        """
+        Count model calls and tokens in the current stage.
+
+        Parameters:
+        - model: str. Endpoint or model name.
+        - calls: int. Number of requests (rows sent to the model).
+        - input_tokens, output_tokens: int. Token counts, exact or estimated.
+        """
+        with self._lock:
+            llm = self.stages[self.current_stage]["llm"][model]
+            llm["calls"] += int(calls)
+            llm["input_tokens"] += int(input_tokens)
+            llm["output_tokens"] += int(output_tokens)
+
+    def record_saved_tokens(self, model, input_tokens):
+        """Count input tokens the current stage removed from the prompts sent to a model."""
+        with self._lock:
+            self.stages[self.current_stage]["llm"][model]["saved_input_tokens"] += int(input_tokens)
+
+    def to_dict(self):
+        with self._lock:
+            stages = json.loads(json.dumps(self.stages))
+        return {
+            "started_at": self.started_at.isoformat(),
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "stages": stages,
+        }
+
+    def write_json(self, path):
+        """Write every stage record as one JSON document."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        print(f"Wrote run metrics to {path}")
+
+    def prometheus_text(self, prefix="gig_pipeline"):
+        """Render the stage records in the Prometheus text exposition format."""
+        samples = defaultdict(list)
+        for name, record in self.to_dict()["stages"].items():
+            stage = {"stage": name}
+            samples["stage_seconds"].append((stage, record["seconds"]))
+            samples["stage_rows"].append((stage, record["rows"]))
+            samples["stage_bytes_loaded"].append((stage, record["bytes_loaded"]))
+            samples["bigquery_cache_hits_total"].append((stage, record["cache_hits"]))
+            for job_type, count in record["jobs"].items():
+                samples["bigquery_jobs_total"].append(({**stage, "job_type": job_type}, count))
+            for statistic, value in record["job_statistics"].items():
+                samples[f"bigquery_{statistic.removeprefix('total_')}_total"].append((stage, value))
+            for call, totals in record["calls"].items():
+                labels = {**stage, "call": call}
+                samples["calls_total"].append((labels, totals["count"]))
+                samples["call_seconds_total"].append((labels, totals["seconds"]))
+            for model, totals in record["llm"].items():
+                labels = {**stage, "model": model}
+                samples["llm_calls_total"].append((labels, totals["calls"]))
+                samples["llm_input_tokens_total"].append((labels, totals["input_tokens"]))
+                samples["llm_output_tokens_total"].append((labels, totals["output_tokens"]))
+                samples["llm_saved_input_tokens_total"].append(
+                    (labels, totals.get("saved_input_tokens", 0)))
+
+        lines = []
+        for metric, values in sorted(samples.items()):
+            metric_type = "counter" if metric.endswith("_total") else "gauge"
+            lines.append(f"# TYPE {prefix}_{metric} {metric_type}")
+            for labels, value in values:
+                label_text = ",".join(f'{key}="{str(val).replace(chr(34), chr(39))}"'
+                                      for key, val in labels.items())
+                lines.append(f"{prefix}_{metric}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the metrics as a Prometheus textfile (e.g. for node_exporter)."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+        print(f"Wrote Prometheus metrics to {path}")
+
+
+instrumentation = Instrumentation()
+
+
+def timed(name=None):
+    """Decorator recording the wall time of every call in the current stage."""
+    def decorator(func):
+        call_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                instrumentation.record_call(call_name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def table_path(table):
+    """Return the project.dataset.table id of a table id, Table or TableReference."""
+    if isinstance(table, str):
+        return table
+    return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+
+class InstrumentedJob:
+    """
+    BigQuery job proxy recording its statistics once result() returns.
+
+    Parameters:
+    - job: bigquery job. The wrapped job.
+    - call_name: str. Name its wait time is recorded under.
+    - on_done: callable or None. Called with the job once it completed.
+    """
+
+    def __init__(self, job, call_name, on_done=None):
+        self._job = job
+        self._call_name = call_name
+        self._on_done = on_done
+        self._recorded = False
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def result(self, *args, **kwargs):
+        start = time.perf_counter()
+        rows = self._job.result(*args, **kwargs)
+        if not self._recorded:
+            self._recorded = True
+            instrumentation.record_call(self._call_name, time.perf_counter() - start)
+            instrumentation.record_job(self._job)
+            total_rows = getattr(rows, "total_rows", None)
+            if self._job.job_type == "load":
+                instrumentation.record_rows(self._job.output_rows)
+            elif isinstance(total_rows, int):
+                instrumentation.record_rows(total_rows)
+            if self._on_done is not None:
+                self._on_done(self._job)
+        return rows
+
+    def to_dataframe(self, *args, **kwargs):
+        return self.result().to_dataframe(*args, **kwargs)
+
+
+class InstrumentedClient:
+    """
+    bigquery.Client proxy that records the jobs it starts.
+
+    query and load_table_* return InstrumentedJob, so statistics are captured
+    when the caller waits for the job; insert_rows_json counts streamed rows.
+    Listeners added with add_write_listener are told about every table written
+    through the proxy (None when a script may have written any table).
+    Every other attribute is the wrapped client's.
+
+    Parameters:
+    - client: bigquery.Client, or a callable returning one. A callable is only
+      called on first use, so creating the proxy costs no credential lookup.
+    """
+
+    def __init__(self, client):
+        self._client_or_factory = client
+        self._resolved = None
+        self._write_listeners = []
+
+    @property
+    def _client(self):
+        if self._resolved is None:
+            factory = self._client_or_factory
+            self._resolved = factory() if callable(factory) else factory
+        return self._resolved
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def add_write_listener(self, listener):
+        """Call listener(table_id) whenever a table is written through this client."""
+        self._write_listeners.append(listener)
+
+    def _written(self, table):
+        table_id = None if table is None else table_path(table)
+        for listener in self._write_listeners:
+            listener(table_id)
+
+    def _query_done(self, job):
+        # A plain SELECT only writes its destination; DML, DDL and scripts may write anything
+        if job.statement_type == "SELECT":
+            if job.configuration.destination is not None:
+                self._written(job.configuration.destination)
+        else:
+            self._written(None)
+
+    def _load_done(self, job):
+        self._written(job.destination)
+
+    def query(self, *args, **kwargs):
+        return InstrumentedJob(self._client.query(*args, **kwargs), "client.query",
+                               on_done=self._query_done)
+
+    def load_table_from_file(self, *args, **kwargs):
+        return InstrumentedJob(self._client.load_table_from_file(*args, **kwargs),
+                               "client.load_table_from_file", on_done=self._load_done)
+
+    def load_table_from_dataframe(self, *args, **kwargs):
+        return InstrumentedJob(self._client.load_table_from_dataframe(*args, **kwargs),
+                               "client.load_table_from_dataframe", on_done=self._load_done)
+
+    def create_table(self, table, *args, **kwargs):
+        created = self._client.create_table(table, *args, **kwargs)
+        self._written(table)
+        return created
+
+    def update_table(self, table, *args, **kwargs):
+        updated = self._client.update_table(table, *args, **kwargs)
+        self._written(table)
+        return updated
+
+    def delete_table(self, table, *args, **kwargs):
+        self._client.delete_table(table, *args, **kwargs)
+        self._written(table)
+
+    def insert_rows_json(self, table, json_rows, *args, **kwargs):
+        start = time.perf_counter()
+        errors = self._client.insert_rows_json(table, json_rows, *args, **kwargs)
+        self._written(table)
+        instrumentation.record_call("client.insert_rows_json", time.perf_counter() - start)
+        instrumentation.record_rows(len(json_rows) - len(errors),
+                                    bytes_loaded=len(json.dumps(json_rows, default=str)))
+        return errors
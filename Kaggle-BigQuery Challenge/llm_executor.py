@@ -0,0 +1,453 @@
+"""Client-side execution of the Gemini prompts of queries.py.
+
+Instead of inline AI.GENERATE* calls, where one throttled row nulls out or
+fails the whole query, prompts are sent from Python through an asyncio worker
+pool. Requests are paced by token buckets (requests and input tokens per
+minute), the number of requests in flight adapts to throttling (additive
+increase, multiplicative decrease), transient errors are retried with jittered
+exponential backoff and completed rows are checkpointed to disk, so an
+interrupted run resumes where it stopped.
+
+Endpoints speak the Vertex AI generateContent REST protocol; any HTTP server
+answering that protocol (e.g. a local fake) can stand in for Vertex AI.
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+from instrumentation import estimate_tokens, instrumentation
+from queries import prompt_cache_key
+
+# HTTP statuses worth retrying; 429 also shrinks the concurrency window
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+_FORMAT_SPEC = re.compile(r"%[-+ #0]*\d*(?:\.\d+)?[sdif%]")
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+
+
+class RetryableError(Exception):
+    """A request that may succeed if sent again, e.g. HTTP 429 or 503."""
+
+    def __init__(self, message, throttled=False, retry_after=None):
+        super().__init__(message)
+        self.throttled = throttled
+        self.retry_after = retry_after
+
+
+class PermanentError(Exception):
+    """A request that fails the same way on every attempt, e.g. HTTP 400."""
+
+
+def format_prompt(prompt, row):
+    """
+    Render a prompt template for one row, like BigQuery FORMAT does.
+
+    Missing values (None or NaN) are rendered as NULL, as FORMAT renders them.
+
+    Parameters:
+    - prompt: queries.PromptSpec. Prompt whose template and args are used.
+    - row: Mapping of argument name to value, e.g. a dict or a pandas row.
+    """
+    values = iter([row[arg] for arg in prompt.args])
+
+    def substitute(match):
+        spec = match.group(0)
+        if spec == "%%":
+            return "%"
+        value = next(values)
+        if value is None or (isinstance(value, float) and value != value):
+            return "NULL"
+        return spec % value
+
+    return _FORMAT_SPEC.sub(substitute, prompt.template)
+
+
+def parse_result(prompt, text):
+    """Convert the model's answer to the type of prompt.function; None if it cannot be parsed."""
+    if text is None:
+        return None
+    text = text.strip()
+    if prompt.function == "AI.GENERATE_DOUBLE":
+        match = _NUMBER.search(text)
+        return float(match.group(0)) if match else None
+    if prompt.function == "AI.GENERATE_BOOL":
+        answer = text.lower()
+        if answer.startswith(("true", "yes")):
+            return True
+        if answer.startswith(("false", "no")):
+            return False
+        return None
+    return text or None
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket: acquire(n) waits until n tokens are available.
+
+    Parameters:
+    - rate: float. Tokens added per second.
+    - capacity: float. Maximum tokens held, i.e. the largest burst.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        # Waiters are served in arrival order, so large requests are not starved
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on requests in flight, used as an async context manager.
+
+    The limit grows by about one request per round trip while calls succeed and
+    halves on throttling. Entering returns the current generation; only a
+    request sent after the last decrease can halve the limit again, so a burst
+    of 429s from the same window counts once.
+
+    Parameters:
+    - initial: int. Starting limit.
+    - minimum: int. Lowest limit.
+    - maximum: int. Highest limit.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.generation = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self.generation
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttle(self, generation):
+        if generation == self.generation:
+            self.generation += 1
+            self.limit = max(self.minimum, self.limit / 2)
+
+
+class GoogleAuth:
+    """Bearer token headers from Application Default Credentials, refreshed when expired."""
+
+    def __init__(self):
+        import google.auth
+
+        self.credentials, _ = google.auth.default(
+            scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        import google.auth.transport.requests
+
+        with self._lock:
+            if not self.credentials.valid:
+                self.credentials.refresh(google.auth.transport.requests.Request())
+            return {"Authorization": f"Bearer {self.credentials.token}"}
+
+
+class GenerateContentEndpoint:
+    """
+    Blocking client of the generateContent REST method.
+
+    Calling it returns (text, input_tokens, output_tokens); token counts are
+    None when the response carries no usage metadata.
+
+    Parameters:
+    - url_template: str. Request URL with a {model} placeholder.
+    - auth: callable or None. Returns extra request headers, e.g. GoogleAuth().
+    - timeout: float. Per-request timeout in seconds.
+    - generation_config: dict or None. generationConfig sent with every request.
+    """
+
+    def __init__(self, url_template, auth=None, timeout=60, generation_config=None):
+        self.url_template = url_template
+        self.auth = auth
+        self.timeout = timeout
+        self.generation_config = generation_config or {"temperature": 0.0}
+
+    def __call__(self, model, text):
+        body = json.dumps({
+            "contents": [{"role": "user", "parts": [{"text": text}]}],
+            "generationConfig": self.generation_config,
+        }).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.auth is not None:
+            headers.update(self.auth())
+        request = urllib.request.Request(self.url_template.format(model=model), data=body,
+                                         headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                payload = json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code in RETRYABLE_STATUSES:
+                retry_after = e.headers.get("Retry-After")
+                raise RetryableError(f"HTTP {e.code}", throttled=e.code == 429,
+                                     retry_after=float(retry_after) if retry_after else None)
+            raise PermanentError(f"HTTP {e.code}: {e.read()[:200]!r}")
+        except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            raise RetryableError(repr(e))
+
+        candidates = payload.get("candidates") or []
+        parts = candidates[0].get("content", {}).get("parts", []) if candidates else []
+        text = "".join(part.get("text", "") for part in parts) or None
+        usage = payload.get("usageMetadata", {})
+        return text, usage.get("promptTokenCount"), usage.get("candidatesTokenCount")
+
+
+def vertex_ai_endpoint(project_id, location="us-central1", timeout=60):
+    """Return a GenerateContentEndpoint for the Gemini models of a project on Vertex AI."""
+    url_template = (f"https://{location}-aiplatform.googleapis.com/v1/projects/{project_id}"
+                    f"/locations/{location}/publishers/google/models/{{model}}:generateContent")
+    return GenerateContentEndpoint(url_template, auth=GoogleAuth(), timeout=timeout)
+
+
+@dataclass
+class ExecutionReport:
+    """Outcome of running a prompt over a set of rows."""
+
+    prompt_name: str
+    rows_submitted: int = 0
+    rows_from_checkpoint: int = 0
+    rows_completed: int = 0
+    rows_unparsed: int = 0
+    calls: int = 0
+    retries: int = 0
+    throttled: int = 0
+    seconds: float = 0.0
+    failed_rows: dict = field(default_factory=dict)
+
+    @property
+    def ok(self):
+        return not self.failed_rows
+
+
+class PromptExecutor:
+    """
+    Run a PromptSpec over many rows with bounded, adaptive concurrency.
+
+    Distinct prompts are keyed like the BigQuery prompt cache (prompt_cache_key)
+    and sent once each. Results are appended to a JSON-lines checkpoint as they
+    complete; a rerun skips every key already in the checkpoint. Rows that still
+    fail after max_attempts are reported instead of failing the run.
+
+    Parameters:
+    - endpoint: callable. endpoint(model, text) -> (text, input_tokens,
+      output_tokens), raising RetryableError or PermanentError; usually a
+      GenerateContentEndpoint.
+    - requests_per_minute: float. Sustained request rate.
+    - tokens_per_minute: float or None. Sustained input token rate (estimated
+      from the prompt length), unlimited when None.
+    - initial_concurrency: int. Requests in flight when a run starts.
+    - max_concurrency: int. Upper bound of the adaptive concurrency.
+    - max_attempts: int. Attempts per row, including the first.
+    - base_delay: float. Base of the exponential backoff, in seconds.
+    - max_delay: float. Cap of a single backoff delay, in seconds.
+    - checkpoint_dir: str or None. Directory of the checkpoint files; no
+      checkpointing when None.
+    - progress_every: int. Print progress every this many completed rows.
+    """
+
+    def __init__(self, endpoint, requests_per_minute=600, tokens_per_minute=None,
+                 initial_concurrency=8, max_concurrency=64, max_attempts=6,
+                 base_delay=1.0, max_delay=60.0, checkpoint_dir=None, progress_every=1000):
+        self.endpoint = endpoint
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.checkpoint_dir = checkpoint_dir
+        self.progress_every = progress_every
+
+    def checkpoint_path(self, prompt):
+        return os.path.join(self.checkpoint_dir, f"{prompt.name}-{prompt.template_hash}.jsonl")
+
+    def load_checkpoint(self, prompt):
+        """Return {cache key: result} of the rows completed by previous runs."""
+        if self.checkpoint_dir is None or not os.path.exists(self.checkpoint_path(prompt)):
+            return {}
+        results = {}
+        with open(self.checkpoint_path(prompt)) as f:
+            for line in f:
+                # A run killed mid-write leaves a truncated last line
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                results[record["key"]] = record["result"]
+        return results
+
+    def clear_checkpoint(self, prompt):
+        """Delete the checkpoint of a prompt once its results are stored elsewhere."""
+        if self.checkpoint_dir is not None and os.path.exists(self.checkpoint_path(prompt)):
+            os.remove(self.checkpoint_path(prompt))
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        return delay
+
+    async def _call(self, loop, pool, prompt, text, state, report):
+        input_tokens = estimate_tokens(text)
+        for attempt in range(self.max_attempts):
+            await state["requests"].acquire()
+            if state["tokens"] is not None:
+                await state["tokens"].acquire(input_tokens)
+            try:
+                async with state["concurrency"] as generation:
+                    report.calls += 1
+                    answer, prompt_tokens, output_tokens = await loop.run_in_executor(
+                        pool, self.endpoint, prompt.endpoint, text)
+            except RetryableError as e:
+                instrumentation.record_llm(prompt.endpoint, calls=1, input_tokens=input_tokens)
+                if e.throttled:
+                    report.throttled += 1
+                    state["concurrency"].on_throttle(generation)
+                if attempt + 1 == self.max_attempts:
+                    raise
+                report.retries += 1
+                await asyncio.sleep(self._backoff(attempt, e))
+                continue
+            except PermanentError:
+                instrumentation.record_llm(prompt.endpoint, calls=1, input_tokens=input_tokens)
+                raise
+            state["concurrency"].on_success()
+            instrumentation.record_llm(prompt.endpoint, calls=1,
+                                       input_tokens=prompt_tokens or input_tokens,
+                                       output_tokens=output_tokens or estimate_tokens(answer))
+            return parse_result(prompt, answer)
+
+    async def run_async(self, prompt, items):
+        """
+        Run a prompt over (cache key, prompt text) pairs and return ({key: result}, report).
+
+        Keys whose answer could not be parsed map to None; keys that failed are
+        only listed in report.failed_rows.
+        """
+        start = time.perf_counter()
+        items = dict(items)
+        report = ExecutionReport(prompt_name=prompt.name, rows_submitted=len(items))
+        checkpointed = self.load_checkpoint(prompt)
+        results = {key: checkpointed[key] for key in items if key in checkpointed}
+        report.rows_from_checkpoint = len(results)
+        pending = [(key, text) for key, text in items.items() if key not in results]
+
+        state = {
+            "requests": TokenBucket(self.requests_per_minute / 60,
+                                    max(1.0, self.requests_per_minute / 60)),
+            "tokens": (TokenBucket(self.tokens_per_minute / 60, self.tokens_per_minute / 60)
+                       if self.tokens_per_minute else None),
+            "concurrency": AdaptiveConcurrency(initial=min(self.initial_concurrency,
+                                                           self.max_concurrency),
+                                               maximum=self.max_concurrency),
+        }
+        queue = asyncio.Queue()
+        for item in pending:
+            queue.put_nowait(item)
+
+        checkpoint = None
+        if self.checkpoint_dir is not None and pending:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            checkpoint = open(self.checkpoint_path(prompt), "a")
+        loop = asyncio.get_running_loop()
+
+        async def worker(pool):
+            while not queue.empty():
+                key, text = queue.get_nowait()
+                try:
+                    result = await self._call(loop, pool, prompt, text, state, report)
+                except (RetryableError, PermanentError) as e:
+                    report.failed_rows[key] = repr(e)
+                    continue
+                results[key] = result
+                report.rows_completed += 1
+                if result is None:
+                    report.rows_unparsed += 1
+                elif checkpoint is not None:
+                    checkpoint.write(json.dumps({"key": key, "result": result}) + "\n")
+                    checkpoint.flush()
+                if report.rows_completed % self.progress_every == 0:
+                    print(f"[{prompt.name}] {report.rows_completed}/{len(pending)} rows, "
+                          f"concurrency {int(state['concurrency'].limit)}, "
+                          f"{report.throttled} throttled")
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+                await asyncio.gather(*(worker(pool)
+                                       for _ in range(min(self.max_concurrency, len(pending)))))
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+
+        report.seconds = time.perf_counter() - start
+        print(f"[{prompt.name}] {report.rows_completed} rows generated, "
+              f"{report.rows_from_checkpoint} from checkpoint, {len(report.failed_rows)} failed "
+              f"({report.calls} calls, {report.retries} retries, {report.throttled} throttled) "
+              f"in {report.seconds:.1f}s")
+        return results, report
+
+    def run(self, prompt, items):
+        """Blocking wrapper of run_async."""
+        return asyncio.run(self.run_async(prompt, items))
+
+    def execute(self, prompt, rows):
+        """
+        Evaluate a prompt on every row of a DataFrame.
+
+        Returns (a copy of rows with a prompt.name column, report). Rows whose
+        call failed get a missing value.
+
+        Parameters:
+        - prompt: queries.PromptSpec. Prompt to evaluate; rows must hold prompt.args.
+        - rows: pandas.DataFrame. One prompt per row.
+        """
+        texts = [format_prompt(prompt, row) for row in rows[list(prompt.args)].to_dict("records")]
+        keys = [prompt_cache_key(prompt, text) for text in texts]
+        results, report = self.run(prompt, zip(keys, texts))
+        output = rows.copy()
+        output[prompt.name] = pd.Series([results.get(key) for key in keys], index=rows.index,
+                                        dtype=object)
+        return output, report
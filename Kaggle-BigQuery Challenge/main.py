@@ -1,13 +1,35 @@
 from parameters import *
 from queries import *
+from backends import get_metrics_backend
+from ingestion import insert_rows
+from prompt_cache import PromptCache
+from llm_executor import PromptExecutor, vertex_ai_endpoint
+from prescoring import StressPrescorer
+from near_duplicates import NearDuplicateIndex
+from article_digests import DigestCache, label_keywords
+from embedding_store import EmbeddingStore
+from arrow_fetch import fetch_vectors, get_bqstorage_client
+from query_cache import QueryResultCache
+from tags import TagMatrix, TagVocabulary, compose_driver_vectors
+from similarity import ExactIndex, IVFIndex, kmeans, load_index
+from projection import project_embeddings
+from staging import select_new_rows, stage_csv_to_parquet
+from pipeline import Pipeline, Stage
+from instrumentation import InstrumentedClient, estimate_tokens, instrumentation, timed
+from google.api_core.exceptions import BadRequest, NotFound
 from google.cloud import bigquery
-from bigframes.ml.llm import TextEmbeddingGenerator
 
+import os
+from datetime import timedelta
 import pandas as pd
 import numpy as np
-from sklearn.manifold import TSNE
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+# Every job started through client is recorded by the instrumentation layer; the
+# BigQuery client itself is only created by the first call that needs it
+client = InstrumentedClient(get_client)
+instrumentation.profile_dir = os.path.join(metrics_dir, "profiles")
+query_cache = QueryResultCache(client, query_cache_dir, max_bytes=query_cache_max_bytes,
+                               metadata_ttl=query_cache_metadata_ttl)
 
 def ensure_table_exists(table_id, schema):
     """Create the given BigQuery table if it does not already exist."""
@@ -22,46 +44,194 @@ def ensure_table_exists(table_id, schema):
 
 
 def create_table(table_id, schema, append_data, id_column_name):
-    """Create a BigQuery table if missing and append data rows."""
-    ensure_table_exists(table_id, schema)
+    """
+    Create a BigQuery table if missing and append data rows in batches.
 
-    rows_added = 0
-    for item in append_data:
-        errors = client.insert_rows_json(table_id, [item])
-        if errors:
-            print(f"Failed to add row for '{item[id_column_name]}': {errors}")
-        else:
-            rows_added += 1
-            print(f"Added row {rows_added}: {item[id_column_name]}")
+    Returns the ingestion.InsertReport listing any row that failed after retries.
+    """
+    ensure_table_exists(table_id, schema)
 
-    print(f"Total rows added: {rows_added}")
+    report = insert_rows(client, table_id, append_data, id_column_name=id_column_name)
+    for error in report.failed_rows:
+        print(f"Failed to add row for '{error.row_id}': {error.errors}")
+    print(f"Total rows added: {report.rows_inserted} of {report.rows_submitted} "
+          f"in {report.requests_sent} requests")
+    return report
 
 
-def upload_table(csv_path, schema, table_id):
+@timed()
+def upload_table(csv_path, schema, table_id, stage_parquet=True):
     """
     Load a CSV file into a BigQuery table, replacing existing data.
 
+    By default the CSV is first validated against the schema and staged as
+    typed Parquet, so bad files fail locally and the upload is columnar and
+    compressed.
+
     Parameters:
     - csv_path: str. Local path to the CSV file.
     - schema: list[bigquery.SchemaField]. Schema for the destination table.
     - table_id: str. Full table path where the data will be loaded.
+    - stage_parquet: bool. Validate and convert to Parquet before loading.
     """
 
-    job_config = bigquery.LoadJobConfig(
-        write_disposition="WRITE_TRUNCATE",
-        source_format=bigquery.SourceFormat.CSV,
-        skip_leading_rows=1,  # skip header
-        autodetect=True,  # set to True if you want BigQuery to infer schema
-        schema=schema,
-    )
+    if stage_parquet:
+        name = os.path.splitext(os.path.basename(csv_path))[0]
+        source_path = stage_csv_to_parquet(csv_path, schema,
+                                           os.path.join(staging_dir, f"{name}.parquet"))
+        job_config = bigquery.LoadJobConfig(
+            write_disposition="WRITE_TRUNCATE",
+            source_format=bigquery.SourceFormat.PARQUET,
+            schema=schema,
+        )
+    else:
+        source_path = csv_path
+        job_config = bigquery.LoadJobConfig(
+            write_disposition="WRITE_TRUNCATE",
+            source_format=bigquery.SourceFormat.CSV,
+            skip_leading_rows=1,  # skip header
+            autodetect=True,  # set to True if you want BigQuery to infer schema
+            schema=schema,
+        )
 
     # === Load to BigQuery ===
-    with open(csv_path, "rb") as source_file:
+    with open(source_path, "rb") as source_file:
         job = client.load_table_from_file(source_file, table_id, job_config=job_config)
 
     job.result()  # Wait for completion
     print(f"Loaded {job.output_rows} rows to {table_id}")
 
+def ensure_partitioned_table(table_id, schema, partition_field, clustering_fields):
+    """
+    Create a day-partitioned, clustered table, converting an existing unpartitioned one.
+
+    Returns True when the table did not exist and was created empty.
+
+    Parameters:
+    - table_id: str. Full table path.
+    - schema: list[bigquery.SchemaField]. Schema of the table.
+    - partition_field: str. DATE column the table is partitioned by.
+    - clustering_fields: list[str]. Clustering columns, most selective first.
+    """
+    try:
+        table = client.get_table(table_id)
+    except Exception:
+        table = bigquery.Table(table_id, schema=schema)
+        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY,
+                                                            field=partition_field)
+        table.clustering_fields = clustering_fields
+        client.create_table(table)
+        print(f"Created partitioned table {table_id}")
+        return True
+
+    if table.time_partitioning is None:
+        print(f"Repartitioning {table_id} by {partition_field}")
+        client.query(f"""
+CREATE OR REPLACE TABLE `{table_id}`
+PARTITION BY {partition_field}
+CLUSTER BY {", ".join(clustering_fields)}
+AS SELECT * FROM `{table_id}`
+""").result()
+    return False
+
+@timed()
+def refresh_driver_daily_rides(rides_table_id, min_date=None, max_date=None):
+    """
+    Recompute the driver x day aggregates of a date range (every day by default).
+
+    Parameters:
+    - rides_table_id: str. Full path of the rides table aggregated.
+    - min_date, max_date: datetime.date or None. Range of days to recompute.
+    """
+    job = client.query(get_driver_daily_rides_refresh_query(rides_table_id,
+                                                            driver_daily_rides_table_id,
+                                                            min_date, max_date))
+    job.result()
+    print(f"Refreshed {driver_daily_rides_table_id}: {job.num_dml_affected_rows} driver days changed")
+
+def ensure_driver_daily_rides(rides_table_id):
+    """Create the driver x day aggregate table, backfilling it from all rides when new."""
+    if ensure_partitioned_table(driver_daily_rides_table_id, driver_daily_rides_schema,
+                                "Date", ["Driver_ID"]):
+        refresh_driver_daily_rides(rides_table_id)
+
+@timed()
+def load_rides_incremental(csv_path, schema, table_id, late_days=3):
+    """
+    Merge only the rides past the load high-water mark into the partitioned rides table.
+
+    The CSV is staged and validated locally, then only rides with a Ride_ID
+    above the watermark or dated within late_days of its max date are uploaded
+    to a delta table and merged. The driver x day aggregates of the delta's days
+    are recomputed in the same transaction. Replaying the same file is a no-op.
+
+    Parameters:
+    - csv_path: str. Local path to the rides CSV (full history or a daily export).
+    - schema: list[bigquery.SchemaField]. Schema of the rides table.
+    - table_id: str. Full path of the rides table.
+    - late_days: int. Days before the watermark date that are re-checked.
+    """
+    ensure_partitioned_table(table_id, schema, "Date", ["Driver_ID", "City"])
+    ensure_table_exists(load_watermarks_table_id, load_watermarks_schema)
+    ensure_driver_daily_rides(table_id)
+
+    watermark = list(client.query(get_rides_watermark_query(load_watermarks_table_id,
+                                                            table_id)).result())
+    if watermark:
+        max_ride_id, max_date = watermark[0].max_ride_id, watermark[0].max_date
+    else:
+        # First incremental load of an existing table: derive the mark from its rows
+        row = next(iter(client.query(
+            f"SELECT MAX(Ride_ID) AS max_ride_id, MAX(Date) AS max_date FROM `{table_id}`"
+        ).result()))
+        max_ride_id, max_date = row.max_ride_id, row.max_date
+
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    parquet_path = stage_csv_to_parquet(csv_path, schema,
+                                        os.path.join(staging_dir, f"{name}.parquet"))
+    delta_path = os.path.join(staging_dir, f"{name}_delta.parquet")
+    since_date = max_date - timedelta(days=late_days) if max_date is not None else None
+    rows, min_date, delta_max_date = select_new_rows(parquet_path, delta_path, "Ride_ID", "Date",
+                                                     max_key=max_ride_id, since_date=since_date)
+    if rows == 0:
+        print(f"No new rides past Ride_ID {max_ride_id} / {max_date}; {table_id} unchanged")
+        return
+
+    delta_table_id = f"{table_id}_delta"
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_TRUNCATE",
+        source_format=bigquery.SourceFormat.PARQUET,
+        schema=schema,
+    )
+    with open(delta_path, "rb") as source_file:
+        client.load_table_from_file(source_file, delta_table_id, job_config=job_config).result()
+
+    # Corrected rides may move between days: their stored days are rewritten too
+    stored = next(iter(client.query(get_rides_stored_dates_query(table_id, delta_table_id)).result()))
+    dates = [date for date in (min_date, delta_max_date, stored.min_date, stored.max_date)
+             if date is not None]
+    min_date, delta_max_date = (min(dates), max(dates)) if dates else (None, None)
+
+    merge_query = get_rides_incremental_merge_query(table_id, delta_table_id,
+                                                    load_watermarks_table_id,
+                                                    min_date, delta_max_date,
+                                                    [field.name for field in schema],
+                                                    daily_table_id=driver_daily_rides_table_id)
+    client.query(merge_query).result()
+    client.delete_table(delta_table_id, not_found_ok=True)
+    print(f"Merged {rows} candidate rides dated {min_date}..{delta_max_date} into {table_id}")
+
+def upload_rides(csv_path, schema, table_id):
+    """Load rides with the configured rides_load_mode."""
+    if rides_load_mode == "incremental":
+        load_rides_incremental(csv_path, schema, table_id, late_days=rides_late_days)
+    else:
+        upload_table(csv_path, schema, table_id)
+        ensure_partitioned_table(driver_daily_rides_table_id, driver_daily_rides_schema,
+                                 "Date", ["Driver_ID"])
+        refresh_driver_daily_rides(table_id)
+
+@timed()
 def run_query_and_create_view(view_id, query):
     """
     Create or replace a BigQuery view with the given query.
@@ -78,41 +248,469 @@ def run_query_and_create_view(view_id, query):
     except Exception as e:
         print(f"Failed to create view: {e}")
 
-def create_driver_reason_tags_view():
+def compute_drivers_metrics_df(backend="bigquery"):
+    """
+    Compute the numeric drivers_metrics columns (no AI columns) as a DataFrame.
+
+    Parameters:
+    - backend: str. "bigquery" runs the aggregation as a remote job, "local"
+      runs the same join and group-bys in-process over the CSV exports.
+    """
+    if backend == "local":
+        metrics_backend = get_metrics_backend("local",
+                                              drivers_path=drivers_csv_path,
+                                              rides_path=rides_csv_path)
+    else:
+        metrics_backend = get_metrics_backend(backend,
+                                              client=client,
+                                              project_id=project_id,
+                                              dataset_id=marts_dataset_id)
+    df = metrics_backend.drivers_metrics()
+    print(f"Computed metrics for {len(df)} drivers with the {metrics_backend.name} backend")
+    return df
+
+def get_prompt_executor():
+    """Return the client-side PromptExecutor calling Gemini on Vertex AI."""
+    return PromptExecutor(vertex_ai_endpoint(project_id, location=vertex_location),
+                          requests_per_minute=llm_requests_per_minute,
+                          tokens_per_minute=llm_tokens_per_minute,
+                          max_concurrency=llm_max_concurrency,
+                          checkpoint_dir=llm_checkpoint_dir)
+
+def get_prompt_cache():
+    """Return the PromptCache holding AI.GENERATE results for the marts."""
+    return PromptCache(client=client,
+                       table_id=prompt_cache_table_id,
+                       project_id=project_id,
+                       connection_id=connection_id,
+                       ttl_hours=prompt_cache_ttl_hours,
+                       max_entries=prompt_cache_max_entries,
+                       executor=get_prompt_executor() if prompt_execution == "client" else None)
+
+def create_drivers_metrics_view(use_prompt_cache=True):
+    """
+    Create the drivers_metrics view.
+
+    With use_prompt_cache the model is only called for drivers whose prompt is
+    not cached yet, and the view reads stress_score/stress_reason from the cache.
+    """
+    cache_table_id = None
+    if use_prompt_cache:
+        cache = get_prompt_cache()
+        cache.refresh(stage="drivers_metrics",
+                      source_query=get_drivers_aggregates_query(project_id=project_id,
+                                                                dataset_id=marts_dataset_id,
+                                                                daily_table_id=driver_daily_rides_table_id),
+                      prompts=[DRIVER_STRESS_SCORE_PROMPT, DRIVER_STRESS_REASON_PROMPT])
+        cache_table_id = cache.table_id
+
+    dm_query = get_drivers_metrics_query(project_id=project_id,
+                                         dataset_id=marts_dataset_id,
+                                         connection_id=connection_id,
+                                         prompt_cache_table_id=cache_table_id,
+                                         daily_table_id=driver_daily_rides_table_id)
+    run_query_and_create_view(view_id=drivers_metrics_table_id,
+                              query=dm_query)
+
+def create_driver_reason_tags_view(use_prompt_cache=True):
     """Create view that generates stress reason tags for drivers."""
+    cache_table_id = None
+    if use_prompt_cache:
+        cache = get_prompt_cache()
+        cache.refresh(stage="drivers_reason_tags",
+                      source_query=f"SELECT * FROM `{drivers_metrics_table_id}`",
+                      prompts=[DRIVER_REASON_TAGS_PROMPT])
+        cache_table_id = cache.table_id
+
     drt_query = get_driver_reason_tags_query(project_id=project_id,
                                              dataset_id=marts_dataset_id,
-                                             connection_id=connection_id)
+                                             connection_id=connection_id,
+                                             prompt_cache_table_id=cache_table_id)
     run_query_and_create_view(view_id=drivers_reason_tags_table_id,
                               query=drt_query)
 
-def generate_driver_reason_embeddings():
-    """Generate embeddings for driver stress reasons and store them in BigQuery."""
+@timed()
+def materialize_mart(table_id, schema, refresh_query, prompts=(), llm_rows_condition="TRUE"):
+    """
+    Create a mart table if needed and run its incremental refresh script.
+
+    Parameters:
+    - table_id: str. Full table path of the mart. A view at this path is replaced.
+    - schema: list[bigquery.SchemaField]. Schema of the mart table.
+    - refresh_query: str. Script merging changed rows into the table.
+    - prompts: list[queries.PromptSpec]. Prompts the script evaluates inline once per
+      refreshed row matching llm_rows_condition; empty when the script reads the prompt cache.
+    - llm_rows_condition: str. SQL predicate over the mart selecting the rows whose values
+      came from the model rather than from the local prescorer.
+    """
+    try:
+        if client.get_table(table_id).table_type == "VIEW":
+            print(f"Replacing view with a materialized table: {table_id}")
+            client.delete_table(table_id)
+    except NotFound:
+        pass
+
+    table = bigquery.Table(table_id, schema=schema)
+    table.clustering_fields = ["driver_ID"]
+    table = client.create_table(table, exists_ok=True)
+    missing_fields = [field for field in schema
+                      if field.name not in {existing.name for existing in table.schema}]
+    if missing_fields:
+        print(f"Adding columns to {table_id}: {[field.name for field in missing_fields]}")
+        table.schema = list(table.schema) + missing_fields
+        client.update_table(table, ["schema"])
+
+    job = client.query(refresh_query)
+    job.result()
+    refreshed_rows = next(iter(client.query(
+        get_refreshed_rows_count_query(table_id, job.started)).result())).refreshed_rows
+    print(f"Refreshed {table_id}: {refreshed_rows} rows changed")
+    if prompts and refreshed_rows:
+        llm_rows = next(iter(client.query(get_refreshed_rows_count_query(
+            table_id, job.started, llm_rows_condition)).result())).refreshed_rows
+        for prompt in prompts:
+            instrumentation.record_llm(prompt.endpoint, calls=llm_rows)
+
+def get_drivers_metrics_refresh_query():
+    """Return the script refreshing the drivers_metrics table, pruned for incremental loads."""
+    return get_materialized_drivers_metrics_query(
+        project_id=project_id,
+        dataset_id=marts_dataset_id,
+        connection_id=connection_id,
+        target_table_id=drivers_metrics_table_id,
+        watermark_table_id=load_watermarks_table_id if rides_load_mode == "incremental" else None,
+        daily_table_id=driver_daily_rides_table_id,
+        rides_table_id=rides_data_table_id,
+        prompt_cache_table_id=prompt_cache_table_id if prompt_execution == "client" else None,
+        prescores_table_id=driver_prescores_table_id if stress_prescoring else None,
+    )
+
+def get_driver_reason_tags_refresh_query():
+    """Return the script refreshing the drivers_reason_tags table."""
+    return get_materialized_driver_reason_tags_query(
+        project_id=project_id,
+        connection_id=connection_id,
+        source_table_id=drivers_metrics_table_id,
+        target_table_id=drivers_reason_tags_table_id,
+        prompt_cache_table_id=prompt_cache_table_id if prompt_execution == "client" else None,
+        prescored=stress_prescoring,
+    )
+
+def create_driver_window_metrics_view():
+    """Create the view of lifetime, 7-day and 30-day driver metrics over the daily aggregates."""
+    run_query_and_create_view(view_id=driver_window_metrics_table_id,
+                              query=get_driver_window_metrics_query(driver_daily_rides_table_id))
+
+@timed()
+def prescore_drivers():
+    """
+    Score every driver locally and write which ones need the LLM to driver_prescores.
+
+    The prescorer is calibrated on the stress scores the LLM already produced
+    (stress_score_source "llm"); until there are prescore_min_calibration_rows
+    of them every driver is sent to the LLM. Drivers of the previous triage's
+    holdout stand for every driver kept local, so they are weighted by the
+    inverse of prescore_holdout_share.
+    """
+    metrics = client.query(get_drivers_aggregates_query(project_id=project_id,
+                                                        dataset_id=marts_dataset_id,
+                                                        daily_table_id=driver_daily_rides_table_id)
+                           ).to_dataframe()
+    prescorer = StressPrescorer()
+    try:
+        scores = client.query(f"""
+SELECT driver_ID, stress_score
+FROM `{drivers_metrics_table_id}`
+WHERE IFNULL(stress_score_source, 'llm') = 'llm'
+  AND stress_score IS NOT NULL""").to_dataframe()
+    except Exception as e:
+        print(f"No stored LLM stress scores to calibrate on: {e}")
+        scores = pd.DataFrame(columns=["driver_ID", "stress_score"])
+    if len(scores) >= prescore_min_calibration_rows:
+        try:
+            holdout = client.query(f"SELECT driver_ID FROM `{driver_prescores_table_id}` "
+                                   f"WHERE holdout").to_dataframe()["driver_ID"]
+        except (NotFound, BadRequest):
+            holdout = pd.Series(dtype="int64")
+        calibration = metrics.merge(scores, on="driver_ID")
+        weights = np.where(calibration["driver_ID"].isin(holdout),
+                           1 / prescore_holdout_share if prescore_holdout_share > 0 else 1.0, 1.0)
+        prescorer.fit(calibration, calibration["stress_score"].astype("float64"), weights=weights)
+
+    prescores = prescorer.triage(metrics, threshold=prescore_threshold,
+                                 confidence_z=prescore_confidence_z,
+                                 holdout_share=prescore_holdout_share)
+    job_config = bigquery.LoadJobConfig(schema=driver_prescores_schema,
+                                        write_disposition="WRITE_TRUNCATE")
+    client.load_table_from_dataframe(prescores, driver_prescores_table_id,
+                                     job_config=job_config).result()
+    sent = int(prescores["send_to_llm"].sum())
+    print(f"Prescored {len(prescores)} drivers: {sent} "
+          f"({sent / max(len(prescores), 1):.0%}) sent to the LLM, "
+          f"{int(prescores['holdout'].sum())} of them as calibration holdout")
+
+@timed()
+def dedupe_articles():
+    """
+    Cluster near-duplicate news articles and write each one's canonical article to article_clusters.
+
+    Articles are added to the MinHash/LSH index saved at near_duplicate_index_path
+    in table order; articles indexed by earlier runs keep their cluster, so only
+    new articles are hashed and the canonical articles (the ones scored by
+    articles_metrics) never change.
+    """
+    articles = client.query(f"""
+SELECT article_name, content
+FROM `{news_content_table_id}`
+WHERE content IS NOT NULL AND content != ''
+ORDER BY published, article_name""").to_dataframe()
+    index = NearDuplicateIndex.load(near_duplicate_index_path,
+                                    num_perm=minhash_permutations,
+                                    bands=minhash_bands,
+                                    threshold=near_duplicate_threshold,
+                                    shingle_size=shingle_size)
+    known = len(index)
+    clusters = index.add_many(articles["article_name"], articles["content"])
+    index.save(near_duplicate_index_path)
+
+    job_config = bigquery.LoadJobConfig(schema=article_clusters_schema,
+                                        write_disposition="WRITE_TRUNCATE")
+    client.load_table_from_dataframe(clusters, article_clusters_table_id,
+                                     job_config=job_config).result()
+    duplicates = int((clusters["article_name"] != clusters["canonical_article_name"]).sum())
+    print(f"Clustered {len(clusters)} articles ({len(index) - known} new) into "
+          f"{len(clusters) - duplicates} canonical articles: {duplicates} duplicates "
+          f"will take their labels instead of being scored")
+    return clusters
+
+@timed()
+def build_article_digests(consolidated=True):
+    """
+    Write a token-budgeted digest of every article to be scored to article_digests.
+
+    Articles within article_token_budget keep their content; longer ones are
+    chunked and reduced locally (article_digests.digest_text). Digests are
+    cached at article_digests_path by content hash, so each content is only
+    reduced once. With news_dedupe only canonical articles are digested, as
+    only they are scored. Reports the prompt tokens saved per scoring run:
+    one prompt per article when consolidated, one per label otherwise.
+    """
+    query = f"""
+SELECT article_name, content
+FROM `{news_content_table_id}`
+WHERE content IS NOT NULL AND content != ''"""
+    if news_dedupe:
+        query += f"""
+  AND article_name IN (SELECT canonical_article_name FROM `{article_clusters_table_id}`)"""
+    articles = client.query(query).to_dataframe()
+    cache = DigestCache(article_digests_path,
+                        budget_tokens=article_token_budget,
+                        chunk_tokens=article_chunk_tokens,
+                        overlap_tokens=article_chunk_overlap_tokens,
+                        keywords=label_keywords(ARTICLE_LABELS))
+    digests = cache.digest_articles(articles["article_name"], articles["content"])
+    cache.save()
+
+    job_config = bigquery.LoadJobConfig(schema=article_digests_schema,
+                                        write_disposition="WRITE_TRUNCATE")
+    client.load_table_from_dataframe(digests[[field.name for field in article_digests_schema]],
+                                     article_digests_table_id, job_config=job_config).result()
+
+    prompts_per_article = 1 if consolidated else len(ARTICLE_LABELS)
+    content_tokens = int(digests["content_tokens"].sum()) * prompts_per_article
+    digest_tokens = int(digests["digest_tokens"].sum()) * prompts_per_article
+    instrumentation.record_saved_tokens("gemini-2.0-flash", content_tokens - digest_tokens)
+    print(f"Digested {len(digests)} articles ({int(digests['cached'].sum())} cached, "
+          f"{int((digests['chunks'] > 1).sum())} chunked): prompts carry {digest_tokens} "
+          f"instead of {content_tokens} content tokens, "
+          f"{content_tokens - digest_tokens} saved per scoring run")
+    return digests
+
+def create_articles_metrics_view():
+    """
+    Create the articles_metrics view.
+
+    With news_dedupe only canonical articles are scored; with an
+    article_token_budget prompts carry the article digests.
+    """
+    query = get_articles_metrics_query(project_id=project_id,
+                                       dataset_id=staging_dataset_id,
+                                       connection_id=connection_id,
+                                       consolidated=True,
+                                       clusters_table_id=article_clusters_table_id if news_dedupe else None,
+                                       digests_table_id=article_digests_table_id if article_token_budget else None)
+    run_query_and_create_view(view_id=articles_metrics_table_id, query=query)
+
+def materialize_drivers_metrics():
+    """
+    Refresh the drivers_metrics table, calling the model only for changed drivers.
+
+    With prompt_execution "client" the missing prompts are first generated by
+    the client-side executor into the prompt cache, which the refresh reads.
+    With stress_prescoring, drivers the prescorer kept local get its score
+    and a templated reason instead.
+    """
+    prompts = [DRIVER_STRESS_SCORE_PROMPT, DRIVER_STRESS_REASON_PROMPT]
+    if prompt_execution == "client":
+        source_query = get_drivers_aggregates_query(project_id=project_id,
+                                                    dataset_id=marts_dataset_id,
+                                                    daily_table_id=driver_daily_rides_table_id)
+        if stress_prescoring:
+            source_query = f"""SELECT metrics.*
+FROM ({source_query}) metrics
+LEFT JOIN `{driver_prescores_table_id}` prescores
+ON metrics.driver_ID = prescores.driver_ID
+WHERE IFNULL(prescores.send_to_llm, TRUE)"""
+        get_prompt_cache().refresh(stage="drivers_metrics",
+                                   source_query=source_query,
+                                   prompts=prompts)
+        prompts = []
+    materialize_mart(drivers_metrics_table_id, drivers_metrics_mart_schema,
+                     get_drivers_metrics_refresh_query(), prompts=prompts,
+                     llm_rows_condition="IFNULL(stress_score_source, 'llm') = 'llm'")
+
+def materialize_driver_reason_tags():
+    """Refresh the drivers_reason_tags table for drivers whose stress_reason changed."""
+    prompts = [DRIVER_REASON_TAGS_PROMPT]
+    if prompt_execution == "client":
+        source_query = f"SELECT * FROM `{drivers_metrics_table_id}`"
+        if stress_prescoring:
+            source_query += "\nWHERE IFNULL(stress_score_source, 'llm') = 'llm'"
+        get_prompt_cache().refresh(stage="drivers_reason_tags",
+                                   source_query=source_query,
+                                   prompts=prompts)
+        prompts = []
+    materialize_mart(drivers_reason_tags_table_id, drivers_reason_tags_mart_schema,
+                     get_driver_reason_tags_refresh_query(), prompts=prompts,
+                     llm_rows_condition=f"""driver_ID IN (
+  SELECT driver_ID FROM `{drivers_metrics_table_id}`
+  WHERE IFNULL(stress_score_source, 'llm') = 'llm'
+)""")
+
+@timed()
+def embed_texts(texts):
+    """Embed a list of texts with the Vertex AI text embedding model, in input order."""
+    instrumentation.record_llm(embedding_model_name, calls=len(texts),
+                               input_tokens=sum(estimate_tokens(text) for text in texts))
+    from bigframes.ml.llm import TextEmbeddingGenerator
+
+    generator = TextEmbeddingGenerator(model_name=embedding_model_name)
+    embeddings = generator.predict(texts)
+    return np.array(embeddings["ml_generate_embedding_result"].to_pandas().tolist(),
+                    dtype=np.float32)
+
+@timed()
+def build_driver_tag_matrix():
+    """
+    Normalize the drivers' stress_report_tags into the tag vocabulary and a driver x tag matrix.
+
+    Tags are split, canonicalized and interned into the vocabulary saved at
+    tag_vocabulary_path (ids are stable across runs); the sparse CSR matrix is
+    saved at driver_tag_matrix_path.
+    """
     query = f"""
         SELECT driver_ID, stress_report_tags
         FROM `{drivers_reason_tags_table_id}`
         WHERE stress_report_tags IS NOT NULL
         """
-    df = client.query(query).result().to_dataframe()
+    df = query_cache.query_dataframe(query)
+
+    vocabulary = TagVocabulary.load(tag_vocabulary_path)
+    known_tags = len(vocabulary)
+    matrix = TagMatrix.from_tag_strings(df["driver_ID"].to_numpy(), df["stress_report_tags"],
+                                        vocabulary)
+    vocabulary.save(tag_vocabulary_path)
+    matrix.save(driver_tag_matrix_path)
+    print(f"Normalized tags of {matrix.shape[0]} drivers into {len(vocabulary)} tags "
+          f"({len(vocabulary) - known_tags} new, {len(matrix.indices)} driver-tag pairs)")
+    return matrix, vocabulary
+
+def generate_driver_reason_embeddings():
+    """
+    Embed every vocabulary tag once and store each driver's composed vector in BigQuery.
+
+    A driver's embedding is the normalized mean of its tags' embeddings, so the
+    number of embedding calls is bounded by the vocabulary size instead of the
+    number of distinct tag combinations.
+    """
+    vocabulary = TagVocabulary.load(tag_vocabulary_path)
+    matrix = TagMatrix.load(driver_tag_matrix_path)
 
-    unique_reasons = df["stress_report_tags"].unique().tolist()
-    generator = TextEmbeddingGenerator(model_name="text-embedding-005")
-    embeddings = generator.predict(unique_reasons)
-    reason_to_embedding = dict(zip(unique_reasons, embeddings['ml_generate_embedding_result']))
-    df["embedding"] = df["stress_report_tags"].map(reason_to_embedding)
+    store = EmbeddingStore(embedding_store_path)
+    tag_vectors = store.embed(vocabulary.labels, embedding_model_name, embed_texts)
+    vectors = compose_driver_vectors(matrix, tag_vectors)
+
+    has_tags = matrix.row_lengths > 0
+    df = pd.DataFrame({"driver_ID": matrix.ids,
+                       "stress_report_tags": matrix.row_labels(vocabulary)})
+    df["embedding"] = vectors.astype(np.float64).tolist()
+    df = df[has_tags]
 
     job_config = bigquery.LoadJobConfig(
         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
         schema=embedding_schema,
     )
 
-    destination = "mlops-project-430120.MARTS_DATA.driver_reason_embeddings"
-    ensure_table_exists(destination, embedding_schema)
-    client.load_table_from_dataframe(df, destination, job_config=job_config).result()
+    ensure_table_exists(driver_reason_embeddings_table_id, embedding_schema)
+    client.load_table_from_dataframe(df, driver_reason_embeddings_table_id,
+                                     job_config=job_config).result()
+
+
+def build_driver_similarity_index(table_id, kind="ivf"):
+    """
+    Build a nearest-neighbour index over driver reason embeddings and save it.
+
+    Parameters:
+    - table_id: str. Full path of the driver_reason_embeddings table.
+    - kind: str. "ivf" for the approximate index, "exact" for brute force.
+    """
+    query = f"""
+    SELECT driver_ID, embedding
+    FROM `{table_id}`
+    WHERE ARRAY_LENGTH(embedding) > 0
+    """
+    df, X = fetch_vectors(client, query, "embedding", bqstorage_client=get_bqstorage_client(),
+                          cache=query_cache)
+
+    if kind == "ivf":
+        index = IVFIndex(n_lists=max(1, int(np.sqrt(len(X)))))
+    else:
+        index = ExactIndex()
+    index.add(df["driver_ID"].to_numpy(), X)
+    os.makedirs(os.path.dirname(similarity_index_path), exist_ok=True)
+    index.save(similarity_index_path)
+    print(f"Indexed {len(index)} drivers in a {kind} index: {similarity_index_path}")
+    return index
+
+def find_similar_drivers(driver_id, k=10, index=None):
+    """Return a DataFrame of the k drivers whose stress profile is closest to driver_id."""
+    if index is None:
+        index = load_index(similarity_index_path)
+    rows = np.nonzero(index.ids == driver_id)[0]
+    if len(rows) == 0:
+        raise KeyError(f"Driver {driver_id} is not in the similarity index")
+    ids, scores = index.query(index.vectors[rows[0]], k + 1)
+    similar = pd.DataFrame({"driver_ID": ids, "similarity": scores})
+    return similar[similar["driver_ID"] != driver_id].head(k).reset_index(drop=True)
+
+def cluster_drivers(n_clusters=8, index=None):
+    """Group indexed drivers by stress reason with k-means over their embeddings."""
+    if index is None:
+        index = load_index(similarity_index_path)
+    _, labels = kmeans(index.vectors, n_clusters)
+    return pd.DataFrame({"driver_ID": index.ids, "cluster": labels})
 
 
 def plot_driver_reason_embeddings(table_id):
-    """Plot a 2D t-SNE visualization of driver reason embeddings."""
+    """
+    Plot a 2D t-SNE visualization of driver reason embeddings to driver_embeddings.png.
+
+    The layout comes from projection.project_embeddings: PCA, then Barnes-Hut
+    t-SNE on a tag-stratified landmark sample, cached on disk per embedding set.
+    The figure is drawn on its own Agg canvas rather than through pyplot, whose
+    global state is not thread-safe, so the stage can run on a pipeline worker
+    thread. Returns the matplotlib Figure.
+    """
 
     query = f"""
     SELECT
@@ -120,37 +718,179 @@ def plot_driver_reason_embeddings(table_id):
         stress_report_tags,
         embedding
     FROM `{table_id}`
-    WHERE embedding IS NOT NULL AND stress_report_tags IS NOT NULL
+    WHERE ARRAY_LENGTH(embedding) > 0 AND stress_report_tags IS NOT NULL
     """
-    df = client.query(query).to_dataframe()
+    df, X = fetch_vectors(client, query, "embedding", bqstorage_client=get_bqstorage_client(),
+                          cache=query_cache)
     print(f"Loaded {len(df)} rows from driver_reason_embeddings")
 
-    df["main_tag"] = df["stress_report_tags"].str.split(",").str[0].str.strip()
+    vocabulary = TagVocabulary.load(tag_vocabulary_path)
+    matrix = TagMatrix.from_tag_strings(df["driver_ID"].to_numpy(), df["stress_report_tags"],
+                                        vocabulary)
+    df["main_tag"] = np.array(vocabulary.labels + [None], dtype=object)[matrix.first_tags()]
+
+    X_embedded = project_embeddings(ids=df["driver_ID"].to_numpy(),
+                                    X=X,
+                                    labels=df["main_tag"].to_numpy(),
+                                    cache_dir=projection_cache_dir,
+                                    max_cached=projection_cache_max_entries)
 
-    X = np.array(df["embedding"].tolist())
-    X_embedded = TSNE(n_components=2, perplexity=30, random_state=42).fit_transform(X)
+    import seaborn as sns
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
 
     viz_df = pd.DataFrame(X_embedded, columns=["x", "y"])
     viz_df["main_tag"] = df["main_tag"]
 
-    plt.figure(figsize=(10, 8))
-    sns.scatterplot(data=viz_df, x="x", y="y", hue="main_tag", palette="tab10")
-    plt.title("Driver Embeddings Colored by First Tag")
-    plt.savefig("driver_embeddings.png")
-    plt.show()
+    fig = Figure(figsize=(10, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    sns.scatterplot(data=viz_df, x="x", y="y", hue="main_tag", palette="tab10", ax=ax)
+    ax.set_title("Driver Embeddings Colored by First Tag")
+    fig.savefig("driver_embeddings.png")
+    return fig
 
 
-if __name__ == "__main__":
+def refresh_drivers_metrics():
+    """Publish drivers_metrics in the configured marts_mode."""
+    if marts_mode == "table":
+        materialize_drivers_metrics()
+    else:
+        create_drivers_metrics_view()
+
+def refresh_driver_reason_tags():
+    """
+    Publish drivers_reason_tags in the configured marts_mode.
+
+    Views, and tables with prompt_execution "client", read the prompt cache,
+    whose expired entries are then evicted.
+    """
+    if marts_mode == "table":
+        materialize_driver_reason_tags()
+    else:
+        create_driver_reason_tags_view()
+    if marts_mode != "table" or prompt_execution == "client":
+        print("---> Evicting expired prompt cache entries.")
+        get_prompt_cache().evict()
+
+def build_pipeline():
+    """
+    Declare the end-to-end pipeline as stages with their inputs and outputs.
+
+    The two uploads run concurrently; every other stage waits for the tables it
+    reads. Loading rides also updates the driver x day aggregates, which the
+    metrics read instead of raw rides. With stress_prescoring the drivers are
+    triaged locally before the metrics call the LLM. The embeddings are indexed for
+    find_similar_drivers and cluster_drivers. Views do not change when their source
+    data does, so in "view" mode the marts also list the raw tables as inputs. With
+    news_scoring the news articles are deduplicated, digested and scored too.
+    """
+    drivers_table = f"table:{drivers_data_table_id}"
+    rides_table = f"table:{rides_data_table_id}"
+    daily_table = f"table:{driver_daily_rides_table_id}"
+    metrics_table = f"table:{drivers_metrics_table_id}"
+    tags_table = f"table:{drivers_reason_tags_table_id}"
+    embeddings_table = f"table:{driver_reason_embeddings_table_id}"
+    tag_files = [f"file:{driver_tag_matrix_path}", f"file:{tag_vocabulary_path}"]
+    prescores_table = f"table:{driver_prescores_table_id}"
+    raw_tables = [drivers_table, daily_table] if marts_mode == "view" else []
+
+    stages = [
+        Stage("upload_drivers",
+              lambda: upload_table(csv_path=drivers_csv_path,
+                                   schema=drivers_data_schema,
+                                   table_id=drivers_data_table_id),
+              inputs=[f"file:{drivers_csv_path}"],
+              outputs=[drivers_table],
+              params={"schema": [field.to_api_repr() for field in drivers_data_schema]}),
+        Stage("upload_rides",
+              lambda: upload_rides(csv_path=rides_csv_path,
+                                   schema=rides_data_schema,
+                                   table_id=rides_data_table_id),
+              inputs=[f"file:{rides_csv_path}"],
+              outputs=[rides_table, daily_table],
+              params={"schema": [field.to_api_repr() for field in rides_data_schema],
+                      "load_mode": rides_load_mode}),
+        Stage("driver_window_metrics",
+              create_driver_window_metrics_view,
+              inputs=[daily_table],
+              outputs=[f"table:{driver_window_metrics_table_id}"],
+              params={"query": get_driver_window_metrics_query(driver_daily_rides_table_id)}),
+        Stage("drivers_metrics",
+              refresh_drivers_metrics,
+              inputs=[drivers_table, daily_table] + ([prescores_table] if stress_prescoring else []),
+              outputs=[metrics_table],
+              params={"marts_mode": marts_mode,
+                      "query": get_drivers_metrics_refresh_query()}),
+        Stage("drivers_reason_tags",
+              refresh_driver_reason_tags,
+              inputs=[metrics_table] + raw_tables,
+              outputs=[tags_table],
+              params={"marts_mode": marts_mode,
+                      "query": get_driver_reason_tags_refresh_query()}),
+        Stage("driver_tag_matrix",
+              build_driver_tag_matrix,
+              inputs=[tags_table] + raw_tables,
+              outputs=tag_files),
+        Stage("driver_reason_embeddings",
+              generate_driver_reason_embeddings,
+              inputs=tag_files,
+              outputs=[embeddings_table],
+              params={"model": embedding_model_name}),
+        Stage("driver_similarity_index",
+              lambda: build_driver_similarity_index(table_id=driver_reason_embeddings_table_id,
+                                                    kind=similarity_index_kind),
+              inputs=[embeddings_table],
+              outputs=[f"file:{similarity_index_path}"],
+              params={"kind": similarity_index_kind}),
+        Stage("plot_driver_reason_embeddings",
+              lambda: plot_driver_reason_embeddings(table_id=driver_reason_embeddings_table_id),
+              inputs=[embeddings_table],
+              outputs=["file:driver_embeddings.png"]),
+    ]
+    if stress_prescoring:
+        stages.insert(2, Stage("prescore_drivers",
+                               prescore_drivers,
+                               inputs=[drivers_table, daily_table],
+                               outputs=[prescores_table],
+                               params={"threshold": prescore_threshold,
+                                       "confidence_z": prescore_confidence_z,
+                                       "min_calibration_rows": prescore_min_calibration_rows,
+                                       "holdout_share": prescore_holdout_share}))
+    if news_scoring:
+        news_table = f"table:{news_content_table_id}"
+        clusters_table = f"table:{article_clusters_table_id}"
+        if news_dedupe:
+            stages.append(Stage("dedupe_articles",
+                                dedupe_articles,
+                                inputs=[news_table],
+                                outputs=[clusters_table, f"file:{near_duplicate_index_path}"],
+                                params={"threshold": near_duplicate_threshold,
+                                        "num_perm": minhash_permutations,
+                                        "bands": minhash_bands,
+                                        "shingle_size": shingle_size}))
+        digests_table = f"table:{article_digests_table_id}"
+        if article_token_budget:
+            stages.append(Stage("article_digests",
+                                build_article_digests,
+                                inputs=[news_table] + ([clusters_table] if news_dedupe else []),
+                                outputs=[digests_table, f"file:{article_digests_path}"],
+                                params={"budget_tokens": article_token_budget,
+                                        "chunk_tokens": article_chunk_tokens,
+                                        "overlap_tokens": article_chunk_overlap_tokens,
+                                        "labels": ARTICLE_LABELS}))
+        stages.append(Stage("articles_metrics",
+                            create_articles_metrics_view,
+                            inputs=[news_table] + ([clusters_table] if news_dedupe else [])
+                                   + ([digests_table] if article_token_budget else []),
+                            outputs=[f"table:{articles_metrics_table_id}"],
+                            params={"news_dedupe": news_dedupe,
+                                    "article_token_budget": article_token_budget}))
+    return Pipeline(stages, state_path=pipeline_state_path, client=client,
+                    instrumentation=instrumentation, profile_stages=profile_stages)
 
-    print("---> Creating drivers_data table to your Bigquery environment.")
-    upload_table(csv_path="data/Drivers_Data.csv",
-                 schema=drivers_data_schema,
-                 table_id=drivers_data_table_id)
-    
-    print("---> Creating rides_data table to your Bigquery environment.")
-    upload_table(csv_path="data/Rides_Data.csv",
-                 schema=rides_data_schema,
-                 table_id=rides_data_table_id)
+
+if __name__ == "__main__":
 
     # print("---> Creating news_content_usa table to your Bigquery environment.")
     # create_table(table_id=news_content_table_id,
@@ -158,26 +898,16 @@ if __name__ == "__main__":
     #              append_data=usa_articles,
     #              id_column_name="article_name")
 
-    print("---> Creating drivers_metrics view to your Bigquery environment.")
-    dm_query = get_drivers_metrics_query(project_id=project_id,
-                                         dataset_id=marts_dataset_id,
-                                         connection_id=connection_id)
-    run_query_and_create_view(view_id=drivers_metrics_table_id,
-                              query=dm_query)
-    
     # print("---> Creating articles_metrics view to your Bigquery environment.")
-    # am_query = get_drivers_metrics_query(project_id=project_id,
-    #                                      dataset_id=marts_dataset_id,
-    #                                      connection_id=connection_id)
+    # am_query = get_articles_metrics_query(project_id=project_id,
+    #                                       dataset_id=staging_dataset_id,
+    #                                       connection_id=connection_id,
+    #                                       consolidated=True)
     # run_query_and_create_view(view_id=articles_metrics_table_id,
     #                           query=am_query)
 
-    print("---> Creating drivers_reason_tags view to your Bigquery environment.")
-    create_driver_reason_tags_view()
-
-    print("---> Generating driver_reason_embeddings table.")
-    generate_driver_reason_embeddings()
-
-    print("---> Visualizing driver_reason_embeddings table.")
-    plot_driver_reason_embeddings(table_id=driver_reason_embeddings_table_id)
-
+    try:
+        build_pipeline().run()
+    finally:
+        instrumentation.write_json(os.path.join(metrics_dir, "pipeline_run.json"))
+        instrumentation.write_prometheus(os.path.join(metrics_dir, "pipeline.prom"))
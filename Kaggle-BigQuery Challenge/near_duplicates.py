@@ -0,0 +1,200 @@
+"""Near-duplicate detection of news articles with MinHash signatures and LSH banding.
+
+Syndicated copies of a story differ by a headline, a byline or a trimmed
+paragraph, so exact hashes miss them. Each article is reduced to the set of its
+word k-shingles and summarized by a MinHash signature, whose agreement with
+another signature estimates the Jaccard similarity of the two sets. Signatures
+are split into bands; only articles sharing a whole band are compared, so each
+new article is checked against a handful of candidates instead of the corpus.
+"""
+
+import os
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+import pandas as pd
+
+_WORD = re.compile(r"\w+")
+# Multiplier combining the token hashes of a shingle (a 64-bit odd constant)
+_SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def normalize_text(text):
+    """Return text lowercased, without accents, as a list of words."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return _WORD.findall(text.lower())
+
+
+def shingle_hashes(text, shingle_size=5):
+    """
+    Return the distinct 64-bit hashes of the word shingle_size-grams of text.
+
+    Texts shorter than a shingle give one hash of all their words; empty texts none.
+    """
+    words = normalize_text(text)
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    tokens = np.array([zlib.crc32(word.encode("utf-8")) for word in words], dtype=np.uint64)
+    size = min(shingle_size, len(tokens))
+    hashes = np.zeros(len(tokens) - size + 1, dtype=np.uint64)
+    for offset in range(size):
+        hashes = hashes * _SHINGLE_MULTIPLIER + tokens[offset:len(tokens) - size + 1 + offset]
+    return np.unique(hashes)
+
+
+class NearDuplicateIndex:
+    """
+    Incremental clusters of near-duplicate articles.
+
+    The first article of a cluster is its canonical article; a later article
+    whose estimated Jaccard similarity to any indexed article reaches
+    threshold joins that article's cluster. Canonical articles never change,
+    so labels computed for them stay valid as the corpus grows.
+
+    Parameters:
+    - num_perm: int. MinHash permutations (signature length).
+    - bands: int. LSH bands; num_perm must be a multiple. More bands find
+      pairs of lower similarity at the cost of more candidates.
+    - threshold: float. Estimated Jaccard similarity making two articles duplicates.
+    - shingle_size: int. Words per shingle.
+    - seed: int. Seed of the permutations; signatures are only comparable
+      between indexes with the same parameters.
+    """
+
+    def __init__(self, num_perm=128, bands=16, threshold=0.8, shingle_size=5, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(0, np.iinfo(np.uint64).max, num_perm, dtype=np.uint64,
+                               endpoint=True) | np.uint64(1)
+        self._b = rng.integers(0, np.iinfo(np.uint64).max, num_perm, dtype=np.uint64,
+                               endpoint=True)
+
+        self.ids = []
+        self.canonical = []
+        self.similarity = []
+        self._signatures = []
+        self._positions = {}
+        self._buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def params(self):
+        return {"num_perm": self.num_perm, "bands": self.bands, "threshold": self.threshold,
+                "shingle_size": self.shingle_size, "seed": self.seed}
+
+    def signature(self, text):
+        """Return the (num_perm,) uint32 MinHash signature of an article's text."""
+        hashes = shingle_hashes(text, self.shingle_size)
+        if len(hashes) == 0:
+            return np.full(self.num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+        # Multiply-shift hashes: high 32 bits of (a * x + b) mod 2**64, with a odd
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) >> np.uint64(32)
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        return [signature[band::self.bands].tobytes() for band in range(self.bands)]
+
+    def _best_match(self, signature):
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self._buckets[band].get(key, ()))
+        if not candidates:
+            return None, 0.0
+        candidates = np.fromiter(candidates, dtype=np.int64)
+        agreement = (np.stack([self._signatures[i] for i in candidates]) == signature).mean(axis=1)
+        best = int(np.argmax(agreement))
+        return int(candidates[best]), float(agreement[best])
+
+    def _append(self, article_id, signature, canonical, similarity):
+        position = len(self.ids)
+        self.ids.append(article_id)
+        self.canonical.append(canonical)
+        self.similarity.append(similarity)
+        self._signatures.append(signature)
+        self._positions[article_id] = position
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, []).append(position)
+
+    def add(self, article_id, text):
+        """
+        Index an article and return (canonical article id, similarity to its closest match).
+
+        An article id already indexed keeps the cluster it was first given.
+        """
+        if article_id in self._positions:
+            position = self._positions[article_id]
+            return self.ids[self.canonical[position]], self.similarity[position]
+        signature = self.signature(text)
+        match, similarity = self._best_match(signature)
+        if match is not None and similarity >= self.threshold:
+            canonical = self.canonical[match]
+        else:
+            canonical = len(self.ids)
+            similarity = 1.0
+        self._append(article_id, signature, canonical, similarity)
+        return self.ids[canonical], similarity
+
+    def add_many(self, article_ids, texts):
+        """Index articles in order and return their clusters, as clusters() does."""
+        rows = [(article_id,) + self.add(article_id, text)
+                for article_id, text in zip(article_ids, texts)]
+        return pd.DataFrame(rows, columns=["article_name", "canonical_article_name", "similarity"])
+
+    def clusters(self):
+        """
+        Return every indexed article with its canonical article.
+
+        Columns: article_name, canonical_article_name and similarity (the
+        estimated Jaccard similarity that joined the cluster; 1.0 for
+        canonical articles).
+        """
+        return pd.DataFrame({
+            "article_name": self.ids,
+            "canonical_article_name": [self.ids[canonical] for canonical in self.canonical],
+            "similarity": np.array(self.similarity, dtype=np.float64),
+        })
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        signatures = (np.stack(self._signatures) if self._signatures
+                      else np.empty((0, self.num_perm), dtype=np.uint32))
+        np.savez(tmp_path, ids=np.array(self.ids, dtype=str), signatures=signatures,
+                 canonical=np.array(self.canonical, dtype=np.int64),
+                 similarity=np.array(self.similarity, dtype=np.float64),
+                 **{f"param_{name}": value for name, value in self.params.items()})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, **params):
+        """
+        Return the index saved at path, or a new one with params if there is none.
+
+        An index saved with other parameters than the given ones is discarded,
+        as its signatures or clusters would not match.
+        """
+        index = cls(**params)
+        if not os.path.exists(path):
+            return index
+        with np.load(path, allow_pickle=False) as f:
+            saved = {name: f[f"param_{name}"].item() for name in index.params}
+            if saved != index.params:
+                print(f"Discarding the near-duplicate index at {path}: "
+                      f"saved with {saved}, expected {index.params}")
+                return index
+            for article_id, signature, canonical, similarity in zip(
+                    f["ids"].tolist(), f["signatures"], f["canonical"].tolist(),
+                    f["similarity"].tolist()):
+                index._append(article_id, signature, canonical, similarity)
+        return index
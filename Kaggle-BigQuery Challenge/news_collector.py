@@ -0,0 +1,264 @@
+"""Poll many RSS feeds concurrently and stream only unseen entries to BigQuery.
+
+Feeds are fetched with conditional requests (ETag / Last-Modified), so unchanged
+feeds cost a 304 and no parsing. Entries are deduplicated by a hash of their
+link against every link already stored, and only new entries reach the sink.
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import feedparser
+
+from ingestion import BulkInsertSink
+
+USER_AGENT = "gig-workers-news-collector/1.0"
+
+
+def link_hash(link):
+    """Return the dedupe key of an entry link."""
+    return hashlib.sha256(link.strip().encode("utf-8")).hexdigest()[:16]
+
+
+def google_news_feed_url(query, language, country):
+    """Return the Google News RSS search URL of a query in a language and country."""
+    params = urllib.parse.urlencode({
+        "q": query, "hl": language, "gl": country, "ceid": f"{country}:{language}",
+    })
+    return f"https://news.google.com/rss/search?{params}"
+
+
+def fetch_feed(url, etag=None, last_modified=None, timeout=20):
+    """
+    GET a feed, sending the validators of the previous response.
+
+    Returns (status, body, etag, last_modified); body is None when the server
+    answered 304 Not Modified.
+    """
+    headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = response.read()
+            if response.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            return (response.status, body,
+                    response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, None, etag, last_modified
+        raise
+
+
+def entry_to_row(entry):
+    """Convert a feedparser entry to a row of the news table."""
+    published = None
+    if getattr(entry, "published_parsed", None):
+        published = datetime(*entry.published_parsed[:6], tzinfo=timezone.utc).isoformat()
+    return {
+        "title": getattr(entry, "title", ""),
+        "description": getattr(entry, "description", ""),
+        "link": entry.link.strip(),
+        "published": published,
+        "summary": getattr(entry, "summary", ""),
+    }
+
+
+class NewsCollector:
+    """
+    Concurrent, incremental RSS collector.
+
+    Every poll fetches all feeds at once, with at most per_host_limit requests
+    in flight per host and max_concurrency overall. The validators of each
+    feed and the hashes of stored links are kept in a JSON state file, and are
+    only committed for entries the sink actually stored, so a failed insert is
+    retried on the next poll.
+
+    Parameters:
+    - feeds: list[str]. Feed URLs.
+    - state_path: str. JSON file holding feed validators and seen link hashes.
+    - per_host_limit: int. Maximum concurrent requests to the same host.
+    - max_concurrency: int. Maximum concurrent requests overall.
+    - timeout: float. Per-request timeout in seconds.
+    """
+
+    def __init__(self, feeds, state_path, per_host_limit=2, max_concurrency=16, timeout=20):
+        self.feeds = list(feeds)
+        self.state_path = state_path
+        self.per_host_limit = per_host_limit
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.validators = {}
+        self.seen = set()
+        self._load_state()
+
+    def _load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.validators = state.get("validators", {})
+            self.seen = set(state.get("seen", []))
+
+    def save_state(self):
+        """Write the state file atomically."""
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"validators": self.validators, "seen": sorted(self.seen)}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def add_stored_links(self, links):
+        """Mark links already present in the destination table as seen."""
+        self.seen.update(link_hash(link) for link in links)
+
+    async def poll(self, sink):
+        """
+        Fetch every feed once and send unseen entries to the sink.
+
+        Returns a dict mapping each feed URL to its outcome: the HTTP status (or
+        the error), the new rows it contributed and its response validators.
+        """
+        loop = asyncio.get_running_loop()
+        host_limits = {}
+        total_limit = asyncio.Semaphore(self.max_concurrency)
+        sink_lock = asyncio.Lock()
+        claimed = set()
+
+        async def poll_feed(executor, url):
+            host = urllib.parse.urlsplit(url).netloc
+            host_limit = host_limits.setdefault(host, asyncio.Semaphore(self.per_host_limit))
+            previous = self.validators.get(url, {})
+            async with host_limit, total_limit:
+                try:
+                    status, body, etag, last_modified = await loop.run_in_executor(
+                        executor, fetch_feed, url,
+                        previous.get("etag"), previous.get("last_modified"), self.timeout,
+                    )
+                except Exception as e:
+                    print(f"Failed to fetch {url}: {e}")
+                    return url, {"status": repr(e), "rows": []}
+
+            outcome = {"status": status, "rows": [],
+                       "validators": {"etag": etag, "last_modified": last_modified}}
+            if body is None:
+                return url, outcome
+            feed = await loop.run_in_executor(executor, feedparser.parse, body)
+            for entry in feed.entries:
+                if not getattr(entry, "link", None):
+                    continue
+                key = link_hash(entry.link)
+                # Checked and claimed without awaiting, so two feeds never emit the same link
+                if key in self.seen or key in claimed:
+                    continue
+                claimed.add(key)
+                outcome["rows"].append(entry_to_row(entry))
+            if outcome["rows"]:
+                async with sink_lock:
+                    await loop.run_in_executor(executor, sink.extend, outcome["rows"])
+            return url, outcome
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            results = await asyncio.gather(*(poll_feed(executor, url) for url in self.feeds))
+        return dict(results)
+
+    def commit(self, outcomes, failed_links=()):
+        """
+        Record what a poll stored: link hashes of inserted rows and the validators of
+        feeds whose new rows were all inserted.
+
+        Parameters:
+        - outcomes: dict. Result of poll().
+        - failed_links: iterable of str. Links the sink failed to insert.
+        """
+        failed = {link_hash(link) for link in failed_links if link}
+        for url, outcome in outcomes.items():
+            keys = {link_hash(row["link"]) for row in outcome["rows"]}
+            self.seen.update(keys - failed)
+            if "validators" in outcome and not keys & failed:
+                self.validators[url] = outcome["validators"]
+        self.save_state()
+
+
+def load_stored_links(client, table_id):
+    """Return every link already stored in the news table (empty if it does not exist)."""
+    try:
+        rows = client.query(f"SELECT DISTINCT link FROM `{table_id}`").result()
+    except Exception as e:
+        print(f"Could not read stored links from {table_id}: {e}")
+        return []
+    return [row.link for row in rows]
+
+
+async def collect(collector, client, table_id):
+    """
+    Run one poll of every feed into a BigQuery table and commit the collector state.
+
+    Parameters:
+    - collector: NewsCollector.
+    - client: bigquery.Client or a compatible fake.
+    - table_id: str. Full path of the news table.
+    """
+    start = time.perf_counter()
+    sink = BulkInsertSink(client, table_id, id_column_name="link")
+    try:
+        outcomes = await collector.poll(sink)
+    finally:
+        report = await asyncio.to_thread(sink.close)
+    collector.commit(outcomes, failed_links=[error.row_id for error in report.failed_rows])
+
+    unchanged = sum(outcome["status"] == 304 for outcome in outcomes.values())
+    errors = sum(not isinstance(outcome["status"], int) for outcome in outcomes.values())
+    print(f"Polled {len(outcomes)} feeds in {time.perf_counter() - start:.1f}s: "
+          f"{unchanged} unchanged, {errors} failed, {report.rows_inserted} new entries stored, "
+          f"{len(report.failed_rows)} failed inserts")
+    return report
+
+
+async def run(collector, client, table_id, interval_seconds=None):
+    """Collect once, or forever every interval_seconds."""
+    while True:
+        started = time.monotonic()
+        await collect(collector, client, table_id)
+        if interval_seconds is None:
+            return
+        await asyncio.sleep(max(0.0, interval_seconds - (time.monotonic() - started)))
+
+
+def main():
+    """Poll the configured news feeds into BigQuery."""
+    from google.cloud import bigquery
+
+    from parameters import get_client, news_feed_searches, news_feeds_schema, news_feeds_table_id, \
+        news_state_path
+
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--interval", type=float, default=None,
+                            help="Seconds between polls; poll once when omitted.")
+    args = arg_parser.parse_args()
+
+    client = get_client()
+    client.create_table(bigquery.Table(news_feeds_table_id, schema=news_feeds_schema),
+                        exists_ok=True)
+    feeds = [google_news_feed_url(*search) for search in news_feed_searches]
+    collector = NewsCollector(feeds, news_state_path)
+    if not collector.seen:
+        collector.add_stored_links(load_stored_links(client, news_feeds_table_id))
+    asyncio.run(run(collector, client, news_feeds_table_id, args.interval))
+
+
+if __name__ == "__main__":
+    main()
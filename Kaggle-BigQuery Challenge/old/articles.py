@@ -1,6 +1,8 @@
+# Run from the project directory with `python -m old.articles`
 from google.cloud import bigquery
 
 import os
+from ingestion import insert_rows
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/Users/mariana/.config/gcloud/application_default_credentials.json"
 
 brazil_articles = [
@@ -68,13 +70,8 @@ table = bigquery.Table(table_id, schema=schema)
 table = client.create_table(table)  # Will raise error if table exists
 print(f"✅ Table created: {table_id}")
 
-rows_added = 0
-for item in usa_articles:
-    errors = client.insert_rows_json(table_id, [item])
-    if errors:
-        print(f"Failed to add row for '{item['article_name']}': {errors}")
-    else:
-        rows_added += 1
-        print(f"Added row {rows_added}: {item['article_name']}")
+report = insert_rows(client, table_id, usa_articles, id_column_name="article_name")
+for error in report.failed_rows:
+    print(f"Failed to add row for '{error.row_id}': {error.errors}")
 
-print(f"Total rows added: {rows_added}")
\ No newline at end of file
+print(f"Total rows added: {report.rows_inserted}")
@@ -3,6 +3,7 @@
 This script parses an RSS feed using ``feedparser`` and writes the
 resulting entries to a BigQuery table.  Each row in the table contains the
 title, description, link, published date and summary of a news item.
+Run it from the project directory with ``python -m old.feedparser_news``.
 """
 
 from __future__ import annotations
@@ -11,6 +12,7 @@ import feedparser
 from dateutil import parser
 from google.cloud import bigquery
 import os
+from ingestion import insert_rows
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/Users/mariana/.config/gcloud/application_default_credentials.json"
 
 
@@ -61,16 +63,11 @@ def main() -> None:
     client = bigquery.Client()
     news_items = extract_news(feed_url)
 
-    rows_added = 0
-    for item in news_items:
-        errors = client.insert_rows_json(table_id, [item])
-        if errors:
-            print(f"Failed to add row for '{item['title']}': {errors}")
-        else:
-            rows_added += 1
-            print(f"Added row {rows_added}: {item['title']}")
+    report = insert_rows(client, table_id, news_items, id_column_name="link")
+    for error in report.failed_rows:
+        print(f"Failed to add row for '{error.row_id}': {error.errors}")
 
-    print(f"Total rows added: {rows_added}")
+    print(f"Total rows added: {report.rows_inserted}")
 
 
 if __name__ == "__main__":
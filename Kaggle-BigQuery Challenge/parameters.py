@@ -1,16 +1,29 @@
+import functools
 import os
 from google.cloud import bigquery
 
+# Every setting read with _setting can be overridden by an environment variable of the same
+# name (cli.py sets some of them from its flags); table ids follow from the project and
+# datasets, and cache paths and schemas are fixed. Nothing here touches the network at
+# import time.
 # os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/Users/mariana/.config/gcloud/application_default_credentials.json"
 
-os.environ['project_id'] = "mlops-project-430120" 
-os.environ['staging_dataset_id'] = "STAGING_DATA"
-os.environ['marts_dataset_id'] = "MARTS_DATA"
-os.environ['connection_id'] = 'my-connection'
-project_id = os.environ['project_id']
-staging_dataset_id = os.environ['staging_dataset_id']
-marts_dataset_id = os.environ['marts_dataset_id']
-connection_id = os.environ['connection_id']
+
+def _setting(name, default, cast=str):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    if cast is bool:
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return cast(value)
+
+
+project_id = _setting("project_id", "mlops-project-430120")
+staging_dataset_id = _setting("staging_dataset_id", "STAGING_DATA")
+marts_dataset_id = _setting("marts_dataset_id", "MARTS_DATA")
+connection_id = _setting("connection_id", "my-connection")
+# Connections kept open per host by the shared BigQuery client (stages run concurrently)
+http_pool_size = _setting("http_pool_size", 16, int)
 
 news_content_table_id = f"{project_id}.{staging_dataset_id}.news_content_usa"
 drivers_data_table_id = f"{project_id}.{staging_dataset_id}.drivers_data"
@@ -19,8 +32,129 @@ articles_metrics_table_id = f"{project_id}.{marts_dataset_id}.articles_metrics"
 drivers_metrics_table_id = f"{project_id}.{marts_dataset_id}.drivers_metrics"
 drivers_reason_tags_table_id = f"{project_id}.{marts_dataset_id}.drivers_reason_tags"
 driver_reason_embeddings_table_id = f"{project_id}.{marts_dataset_id}.driver_reason_embeddings"
+prompt_cache_table_id = f"{project_id}.{marts_dataset_id}.prompt_cache"
+news_feeds_table_id = f"{project_id}.{staging_dataset_id}.gig_workers_news"
+load_watermarks_table_id = f"{project_id}.{staging_dataset_id}.load_watermarks"
+driver_daily_rides_table_id = f"{project_id}.{marts_dataset_id}.driver_daily_rides"
+driver_window_metrics_table_id = f"{project_id}.{marts_dataset_id}.driver_window_metrics"
+driver_prescores_table_id = f"{project_id}.{marts_dataset_id}.driver_prescores"
+article_clusters_table_id = f"{project_id}.{staging_dataset_id}.article_clusters"
+article_digests_table_id = f"{project_id}.{staging_dataset_id}.article_digests"
+
+# "view" publishes drivers_metrics/drivers_reason_tags as views evaluated on every read,
+# "table" materializes them and refreshes changed drivers only (replacing existing views)
+marts_mode = _setting("marts_mode", "view")
+
+# "truncate" reloads the full file into rides_data, "incremental" keeps it partitioned by Date
+# and merges only rides past the load high-water mark (or within rides_late_days of it)
+rides_load_mode = _setting("rides_load_mode", "truncate")
+rides_late_days = _setting("rides_late_days", 3, int)
+
+# "bigquery" calls Gemini through inline AI.GENERATE* functions, "client" generates missing
+# prompts with llm_executor (rate limited, retried, checkpointed) and bulk-loads them into
+# the prompt cache the marts read from
+prompt_execution = _setting("prompt_execution", "bigquery")
+vertex_location = _setting("vertex_location", "us-central1")
+llm_requests_per_minute = _setting("llm_requests_per_minute", 600, int)
+llm_tokens_per_minute = _setting("llm_tokens_per_minute", None, int)
+llm_max_concurrency = _setting("llm_max_concurrency", 64, int)
+llm_checkpoint_dir = "cache/llm_checkpoints"
+# Prompt cache results older than prompt_cache_ttl_hours are generated again; the least
+# recently used entries beyond prompt_cache_max_entries are evicted
+prompt_cache_ttl_hours = _setting("prompt_cache_ttl_hours", 24 * 30, int)
+prompt_cache_max_entries = _setting("prompt_cache_max_entries", 5_000_000, int)
+
+# Score drivers locally first and only send the LLM those whose local stress score is
+# not confidently below prescore_threshold; the local model is calibrated on stored LLM
+# scores once at least prescore_min_calibration_rows of them exist. A random
+# prescore_holdout_share of the drivers kept local is sent to the LLM anyway, so the
+# calibration also sees drivers the prescorer is confident about. Off by default: until it
+# is calibrated the prescorer keeps no driver local, so small fleets only pay for the stage
+stress_prescoring = _setting("stress_prescoring", False, bool)
+prescore_threshold = _setting("prescore_threshold", 0.35, float)
+prescore_confidence_z = _setting("prescore_confidence_z", 2.0, float)
+prescore_min_calibration_rows = _setting("prescore_min_calibration_rows", 200, int)
+prescore_holdout_share = _setting("prescore_holdout_share", 0.05, float)
+
+# Score the news_content_usa articles (dedupe_articles and articles_metrics stages). With
+# news_dedupe, near-duplicate articles are clustered by MinHash/LSH and only the canonical
+# article of each cluster is sent to Gemini; its labels are copied to the rest of the cluster
+news_scoring = _setting("news_scoring", False, bool)
+news_dedupe = _setting("news_dedupe", True, bool)
+near_duplicate_threshold = _setting("near_duplicate_threshold", 0.8, float)
+minhash_permutations = _setting("minhash_permutations", 128, int)
+minhash_bands = _setting("minhash_bands", 16, int)
+shingle_size = _setting("shingle_size", 5, int)
+# Articles over article_token_budget (estimated tokens) are split into overlapping chunks
+# and reduced to a digest of that size, computed once per content and sent to every prompt
+# in place of the content; 0 sends the full content
+article_token_budget = _setting("article_token_budget", 400, int)
+article_chunk_tokens = _setting("article_chunk_tokens", 512, int)
+article_chunk_overlap_tokens = _setting("article_chunk_overlap_tokens", 64, int)
+
+drivers_csv_path = _setting("drivers_csv_path", "data/Drivers_Data.csv")
+rides_csv_path = _setting("rides_csv_path", "data/Rides_Data.csv")
+
+embedding_model_name = "text-embedding-005"
+embedding_store_path = "cache/embeddings"
+tag_vocabulary_path = "cache/tag_vocabulary.json"
+driver_tag_matrix_path = "cache/driver_tag_matrix.npz"
+similarity_index_path = "cache/driver_similarity_index.npz"
+# "ivf" builds the approximate inverted-file index, "exact" scores every driver per query
+similarity_index_kind = _setting("similarity_index_kind", "ivf")
+near_duplicate_index_path = "cache/near_duplicate_index.npz"
+article_digests_path = "cache/article_digests.json"
+# Local results of mart reads, reused while the tables they read are unchanged
+query_cache_dir = "cache/query_results"
+query_cache_max_bytes = _setting("query_cache_max_bytes", 2 * 1024 ** 3, int)
+query_cache_metadata_ttl = _setting("query_cache_metadata_ttl", 30.0, float)
+projection_cache_dir = "cache/projections"
+# t-SNE layouts kept besides the latest one, for embedding sets seen again
+projection_cache_max_entries = _setting("projection_cache_max_entries", 8, int)
+staging_dir = "cache/staging"
+news_state_path = "cache/news_collector_state.json"
+pipeline_state_path = "cache/pipeline_state.json"
+metrics_dir = _setting("metrics_dir", "cache/metrics")
+# Pipeline stages run under cProfile; stats are written to metrics_dir/profiles
+profile_stages = []
+
+# Google News searches polled by news_collector.py: (query, language, country)
+news_feed_searches = [
+    ("entregadores", "pt-BR", "BR"),
+    ("motoristas de aplicativo", "pt-BR", "BR"),
+    ("entregadores São Paulo", "pt-BR", "BR"),
+    ("motoristas de aplicativo Rio de Janeiro", "pt-BR", "BR"),
+    ("repartidores de aplicaciones", "es-419", "MX"),
+    ("conductores de aplicaciones", "es-419", "MX"),
+    ("rideshare drivers", "en-US", "US"),
+    ("gig workers", "en-US", "US"),
+    ("Uber drivers Chicago", "en-US", "US"),
+    ("Uber drivers Los Angeles", "en-US", "US"),
+    ("rideshare drivers New York", "en-US", "US"),
+    ("rideshare drivers San Francisco", "en-US", "US"),
+    ("rideshare drivers Miami", "en-US", "US"),
+]
+
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """
+    Return the shared BigQuery client, created on first use.
+
+    Credentials are resolved once and every caller shares one HTTP session
+    holding up to http_pool_size connections, instead of a client per job.
+    """
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    session = AuthorizedSession(credentials)
+    session.mount("https://", HTTPAdapter(pool_connections=http_pool_size,
+                                          pool_maxsize=http_pool_size))
+    return bigquery.Client(project=project_id, credentials=credentials, _http=session)
 
-client = bigquery.Client(project=project_id)
 
 news_content_usa_schema = [
     bigquery.SchemaField("article_name", "STRING", mode="REQUIRED"),
@@ -29,6 +163,29 @@ news_content_usa_schema = [
     bigquery.SchemaField("content", "STRING", mode="REQUIRED"),
 ]
 
+article_clusters_schema = [
+    bigquery.SchemaField("article_name", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("canonical_article_name", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("similarity", "FLOAT64", mode="NULLABLE"),
+]
+
+article_digests_schema = [
+    bigquery.SchemaField("article_name", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("content_hash", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("digest", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("chunks", "INT64", mode="NULLABLE"),
+    bigquery.SchemaField("content_tokens", "INT64", mode="NULLABLE"),
+    bigquery.SchemaField("digest_tokens", "INT64", mode="NULLABLE"),
+]
+
+news_feeds_schema = [
+    bigquery.SchemaField("title", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("description", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("link", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("published", "TIMESTAMP", mode="NULLABLE"),
+    bigquery.SchemaField("summary", "STRING", mode="NULLABLE"),
+]
+
 drivers_data_schema = [
     bigquery.SchemaField("Driver_ID", "INTEGER", mode="REQUIRED"),
     bigquery.SchemaField("Name", "STRING", mode="NULLABLE"),
@@ -51,6 +208,53 @@ rides_data_schema = [
     bigquery.SchemaField("Promo_Code", "STRING", mode="NULLABLE"),
 ]
 
+load_watermarks_schema = [
+    bigquery.SchemaField("table_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("max_ride_id", "INT64", mode="NULLABLE"),
+    bigquery.SchemaField("max_date", "DATE", mode="NULLABLE"),
+    bigquery.SchemaField("dirty_since", "DATE", mode="NULLABLE"),
+    bigquery.SchemaField("loaded_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+driver_daily_rides_schema = [
+    bigquery.SchemaField("Driver_ID", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("Date", "DATE", mode="NULLABLE"),
+    bigquery.SchemaField("total_rides", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("fare_sum", "FLOAT64", mode="NULLABLE"),
+    bigquery.SchemaField("fare_sum_sq", "FLOAT64", mode="NULLABLE"),
+    bigquery.SchemaField("fare_count", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("duration_sum", "INT64", mode="NULLABLE"),
+    bigquery.SchemaField("duration_count", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("rides_fingerprint", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("updated_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+drivers_metrics_mart_schema = [
+    bigquery.SchemaField("driver_ID", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("City", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("Age", "INT64", mode="NULLABLE"),
+    bigquery.SchemaField("stress_score", "FLOAT64", mode="NULLABLE"),
+    bigquery.SchemaField("stress_reason", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("stress_score_source", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("prompts_hash", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("input_fingerprint", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("refreshed_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+drivers_reason_tags_mart_schema = [
+    bigquery.SchemaField("driver_ID", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("stress_report_tags", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("input_fingerprint", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("refreshed_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+driver_prescores_schema = [
+    bigquery.SchemaField("driver_ID", "INT64", mode="REQUIRED"),
+    bigquery.SchemaField("prescore", "FLOAT64", mode="NULLABLE"),
+    bigquery.SchemaField("send_to_llm", "BOOL", mode="REQUIRED"),
+    bigquery.SchemaField("holdout", "BOOL", mode="NULLABLE"),
+]
+
 embedding_schema = [
     bigquery.SchemaField("driver_ID", "INT64"),
     bigquery.SchemaField("stress_report_tags", "STRING"),
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Stage:
+    """
+    A pipeline step and the resources it reads and writes.
+
+    Resources are strings: "file:<path>" for local files and "table:<table_id>"
+    for BigQuery tables or views. A stage depends on every stage that outputs one
+    of its inputs, plus the stages named in after.
+
+    Parameters:
+    - name: str. Unique stage name.
+    - func: callable. Called without arguments to run the stage.
+    - inputs: list[str]. Resources whose content decides whether the stage reruns.
+    - outputs: list[str]. Resources the stage writes.
+    - after: list[str]. Extra stages that must finish first.
+    - params: dict. Configuration that also invalidates the stage when it changes,
+      e.g. the SQL it runs.
+    """
+
+    name: str
+    func: object
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+    after: list = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+
+
+class PipelineError(RuntimeError):
+    """Raised when stages failed; carries the failed and the not-run stage names."""
+
+    def __init__(self, failed, blocked):
+        self.failed = failed
+        self.blocked = blocked
+        super().__init__(f"Stages failed: {', '.join(failed)}"
+                         + (f"; not run: {', '.join(blocked)}" if blocked else ""))
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Pipeline:
+    """
+    Run stages as a DAG on a thread pool, skipping stages whose inputs are unchanged.
+
+    A stage starts as soon as its dependencies are done, so wall time is bounded
+    by the critical path. Its fingerprint hashes its name, params and the current
+    fingerprints of its inputs; when that matches the last successful run and its
+    outputs are unchanged since, the stage is skipped. State is saved after every
+    stage, so rerunning after a failure resumes from the failed stage.
+
+    File fingerprints are content hashes, cached by (size, mtime) so unchanged
+    files are not re-read. Table fingerprints are the table's last-modified time
+    and row count (the query text for views).
+
+    Parameters:
+    - stages: list[Stage]. Stages of the pipeline.
+    - state_path: str. JSON file recording the last successful run of each stage.
+    - client: bigquery.Client or None. Needed for "table:" resources.
+    - max_workers: int. Maximum stages running at once.
+    - instrumentation: instrumentation.Instrumentation or None. Each stage runs
+      inside instrumentation.stage(name).
+    - profile_stages: list[str]. Stages run under cProfile by the instrumentation.
+    """
+
+    def __init__(self, stages, state_path, client=None, max_workers=4,
+                 instrumentation=None, profile_stages=()):
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+        self.state_path = state_path
+        self.client = client
+        self.max_workers = max_workers
+        self.instrumentation = instrumentation
+        self.profile_stages = set(profile_stages)
+        self.state = {"stages": {}, "files": {}}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        self._lock = threading.Lock()
+        self.dependencies = self._dependencies()
+
+    def _dependencies(self):
+        producers = {}
+        for stage in self.stages.values():
+            for resource in stage.outputs:
+                producers[resource] = stage.name
+        dependencies = {}
+        for stage in self.stages.values():
+            upstream = {producers[r] for r in stage.inputs if r in producers} | set(stage.after)
+            upstream.discard(stage.name)
+            unknown = upstream - set(self.stages)
+            if unknown:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages {sorted(unknown)}")
+            dependencies[stage.name] = upstream
+        self._check_acyclic(dependencies)
+        return dependencies
+
+    @staticmethod
+    def _check_acyclic(dependencies):
+        remaining = {name: set(upstream) for name, upstream in dependencies.items()}
+        while remaining:
+            ready = [name for name, upstream in remaining.items() if not upstream]
+            if not ready:
+                raise ValueError(f"Stages form a cycle: {sorted(remaining)}")
+            for name in ready:
+                del remaining[name]
+            for upstream in remaining.values():
+                upstream.difference_update(ready)
+
+    def _file_fingerprint(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        with self._lock:
+            cached = self.state["files"].get(path)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha256"]
+        digest = file_digest(path)
+        with self._lock:
+            self.state["files"][path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                         "sha256": digest}
+        return digest
+
+    def _table_fingerprint(self, table_id):
+        try:
+            table = self.client.get_table(table_id)
+        except Exception:
+            return None
+        if table.table_type == "VIEW":
+            return hashlib.sha256(table.view_query.encode("utf-8")).hexdigest()
+        return f"{table.modified.isoformat()}/{table.num_rows}"
+
+    def fingerprint(self, resource):
+        """Return the current fingerprint of a resource, or None if it does not exist."""
+        kind, _, name = resource.partition(":")
+        if kind == "file":
+            return self._file_fingerprint(name)
+        if kind == "table":
+            return self._table_fingerprint(name)
+        raise ValueError(f"Unknown resource kind in {resource!r}")
+
+    def _stage_fingerprint(self, stage):
+        payload = {
+            "name": stage.name,
+            "params": stage.params,
+            "inputs": {resource: self.fingerprint(resource) for resource in stage.inputs},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str)
+                              .encode("utf-8")).hexdigest()
+
+    def _is_current(self, stage, stage_fingerprint):
+        last = self.state["stages"].get(stage.name)
+        if not last or last["fingerprint"] != stage_fingerprint:
+            return False
+        if any(resource_fingerprint is None for resource_fingerprint in last["outputs"].values()):
+            return False
+        return all(self.fingerprint(resource) == last["outputs"].get(resource)
+                   for resource in stage.outputs)
+
+    def _save_state(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.state, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+
+    def _run_stage(self, stage, force):
+        if self.instrumentation is None:
+            return self._run_stage_once(stage, force)
+        with self.instrumentation.stage(stage.name, profile=stage.name in self.profile_stages):
+            status, seconds = self._run_stage_once(stage, force)
+            if status == "skipped":
+                self.instrumentation.set_status("skipped")
+        return status, seconds
+
+    def _run_stage_once(self, stage, force):
+        start = time.perf_counter()
+        stage_fingerprint = self._stage_fingerprint(stage)
+        if not force and self._is_current(stage, stage_fingerprint):
+            print(f"---> Skipping {stage.name}: inputs unchanged")
+            return "skipped", time.perf_counter() - start
+
+        print(f"---> Running {stage.name}")
+        stage.func()
+        outputs = {resource: self.fingerprint(resource) for resource in stage.outputs}
+        with self._lock:
+            self.state["stages"][stage.name] = {
+                "fingerprint": stage_fingerprint,
+                "outputs": outputs,
+                "finished_at": time.time(),
+            }
+        self._save_state()
+        return "ran", time.perf_counter() - start
+
+    def run(self, only=None, force=()):
+        """
+        Run the pipeline and return {stage name: (status, seconds)}.
+
+        Parameters:
+        - only: list[str] or None. Run these stages (and nothing else); their
+          upstream stages are assumed done.
+        - force: iterable of str. Stages run even if their inputs are unchanged.
+        """
+        selected = set(only) if only is not None else set(self.stages)
+        force = set(force)
+        pending = {name: self.dependencies[name] & selected for name in selected}
+        results = {}
+        failed = []
+        started = time.perf_counter()
+        submitted_at = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while pending or running:
+                done_names = {name for name, (status, _) in results.items()
+                              if status in ("ran", "skipped")}
+                for name in sorted(pending):
+                    if pending[name] <= done_names:
+                        del pending[name]
+                        future = executor.submit(self._run_stage, self.stages[name], name in force)
+                        running[future] = name
+                        submitted_at[name] = time.perf_counter()
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        print(f"---> Stage {name} failed: {e!r}")
+                        results[name] = ("failed", time.perf_counter() - submitted_at[name])
+                        failed.append(name)
+
+        self._save_state()
+        wall = time.perf_counter() - started
+        durations = {name: seconds for name, (_, seconds) in results.items()}
+        print(f"Pipeline finished in {wall:.1f}s "
+              f"(critical path {self.critical_path_seconds(durations, selected):.1f}s, "
+              f"sum of stages {sum(durations.values()):.1f}s)")
+        if failed:
+            raise PipelineError(failed, sorted(pending))
+        return results
+
+    def critical_path_seconds(self, durations, selected=None):
+        """Return the longest chain of stage durations through the DAG."""
+        selected = set(self.stages) if selected is None else selected
+        finish = {}
+
+        def finish_time(name):
+            if name not in finish:
+                upstream = [finish_time(u) for u in self.dependencies[name] if u in selected]
+                finish[name] = max(upstream, default=0.0) + durations.get(name, 0.0)
+            return finish[name]
+
+        return max((finish_time(name) for name in selected), default=0.0)
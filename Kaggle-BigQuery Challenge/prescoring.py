@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+
+# drivers_metrics columns the stress prompts are built from
+PRESCORE_FEATURES = [
+    "Age",
+    "Experience_Years",
+    "Average_Rating",
+    "total_rides_all_days",
+    "active_days",
+    "total_duration_min_all_days",
+    "min_fare",
+    "max_fare",
+    "stddev_fare",
+]
+
+# Direction of each derived feature in the uncalibrated score: workload and
+# income variability raise stress, experience and a good rating lower it.
+HEURISTIC_WEIGHTS = {
+    "rides_per_day": 0.8,
+    "minutes_per_day": 1.0,
+    "log_total_minutes": 0.4,
+    "fare_variation": 0.6,
+    "Experience_Years": -0.4,
+    "Average_Rating": -0.5,
+}
+# Shifts the uncalibrated score so a typical driver scores about 0.3
+HEURISTIC_OFFSET = -1.0
+
+
+def prescore_features(metrics):
+    """
+    Return the feature matrix (one column per derived feature) of drivers_metrics rows.
+
+    Per-day workload and fare variation are derived from the raw totals;
+    missing values are left as NaN for the model to impute.
+    """
+    values = metrics[PRESCORE_FEATURES].astype("float64")
+    active_days = values["active_days"].where(values["active_days"] > 0)
+    mean_fare = (values["min_fare"] + values["max_fare"]) / 2
+    features = pd.DataFrame({
+        "Age": values["Age"],
+        "Experience_Years": values["Experience_Years"],
+        "Average_Rating": values["Average_Rating"],
+        "log_total_rides": np.log1p(values["total_rides_all_days"]),
+        "log_total_minutes": np.log1p(values["total_duration_min_all_days"]),
+        "active_days": values["active_days"],
+        "rides_per_day": values["total_rides_all_days"] / active_days,
+        "minutes_per_day": values["total_duration_min_all_days"] / active_days,
+        "fare_range": values["max_fare"] - values["min_fare"],
+        "fare_variation": values["stddev_fare"] / mean_fare.where(mean_fare > 0),
+    }, index=metrics.index)
+    return features.replace([np.inf, -np.inf], np.nan)
+
+
+def holdout_mask(driver_ids, share, seed=0):
+    """
+    Return which drivers belong to a random holdout of about share of them.
+
+    Membership is a hash of the driver id, so it does not depend on the
+    driver's features and a driver stays in (or out of) the holdout across runs.
+    Integer ids are hashed by value and other ids by their string form, both
+    vectorized with pandas.util.hash_array; the seed is mixed into a second pass.
+    """
+    ids = np.asarray(driver_ids)
+    if share <= 0:
+        return np.zeros(len(ids), dtype=bool)
+    if ids.dtype == object:
+        try:
+            ids = ids.astype(np.int64)
+        except (TypeError, ValueError):
+            pass
+    if ids.dtype.kind not in "iu":
+        ids = ids.astype(str).astype(object)
+    hashes = pd.util.hash_array(pd.util.hash_array(ids) ^ np.uint64(seed))
+    return hashes / 2.0 ** 64 < share
+
+
+def _center_and_scale(X):
+    """Return the per-column median and standard deviation, ignoring NaN."""
+    center = np.nanmedian(X, axis=0) if len(X) else np.zeros(X.shape[1])
+    scale = np.nanstd(X, axis=0) if len(X) else np.ones(X.shape[1])
+    center = np.where(np.isnan(center), 0.0, center)
+    scale = np.where(np.isnan(scale) | (scale == 0), 1.0, scale)
+    return center, scale
+
+
+def _standardize(X, center, scale):
+    """Impute NaN with the center, then scale every column to unit spread."""
+    return (np.where(np.isnan(X), center, X) - center) / scale
+
+
+class StressPrescorer:
+    """
+    Vectorized local stress score used to triage drivers before the LLM.
+
+    Uncalibrated, the score is a logistic of a fixed weighted sum of
+    standardized workload features and its uncertainty is unknown, so every
+    driver is sent to the LLM. Calibrated with fit() on stored LLM stress
+    scores, it is a ridge regression whose uncertainty is the cross-validated
+    residual standard deviation.
+
+    Drivers kept local never get an LLM score, so the stored scores
+    over-represent uncertain and stressed drivers. triage() sends a random
+    holdout of the kept drivers to the LLM anyway; weighting them by the
+    inverse of the holdout share in fit() makes the calibration sample
+    represent every driver.
+
+    Parameters:
+    - alpha: float. Ridge penalty on the standardized coefficients.
+    """
+
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+        self.columns = None
+        self.center = None
+        self.scale = None
+        self.coefficients = None
+        self.intercept = None
+        self.uncertainty = np.inf
+
+    @property
+    def calibrated(self):
+        return self.coefficients is not None
+
+    def _standardize(self, features):
+        return _standardize(features[self.columns].to_numpy(dtype=np.float64),
+                            self.center, self.scale)
+
+    def _solve(self, X, y, weights):
+        mean = np.average(y, weights=weights)
+        gram = X.T @ (weights[:, None] * X) + self.alpha * np.eye(X.shape[1])
+        coefficients = np.linalg.solve(gram, X.T @ (weights * (y - mean)))
+        return coefficients, mean
+
+    def fit(self, metrics, scores, weights=None, n_folds=5, seed=42):
+        """
+        Calibrate on drivers with a stored LLM score.
+
+        Parameters:
+        - metrics: pandas.DataFrame. drivers_metrics rows with PRESCORE_FEATURES.
+        - scores: array-like. LLM stress_score of each row (NaN rows are ignored).
+        - weights: array-like or None. Weight of each row, e.g. 1 / holdout share
+          for the holdout drivers; equal weights when None.
+        - n_folds: int. Folds of the cross-validation estimating the uncertainty.
+        - seed: int. Seed of the fold assignment.
+        """
+        scores = np.asarray(scores, dtype=np.float64)
+        known = ~np.isnan(scores)
+        features = prescore_features(metrics[known])
+        self.columns = list(features.columns)
+        self.center, self.scale = _center_and_scale(features.to_numpy(dtype=np.float64))
+        X = self._standardize(features)
+        y = scores[known]
+        weights = np.ones(len(scores)) if weights is None else np.asarray(weights, np.float64)
+        weights = weights[known] * len(y) / max(weights[known].sum(), 1e-12)
+
+        folds = np.random.default_rng(seed).integers(0, n_folds, len(y))
+        residuals = np.empty(len(y))
+        for fold in range(n_folds):
+            test = folds == fold
+            if not test.any() or test.all():
+                continue
+            coefficients, intercept = self._solve(X[~test], y[~test], weights[~test])
+            residuals[test] = y[test] - np.clip(X[test] @ coefficients + intercept, 0, 1)
+        self.coefficients, self.intercept = self._solve(X, y, weights)
+        self.uncertainty = (float(np.sqrt(np.average(residuals ** 2, weights=weights)))
+                            if len(y) > n_folds else np.inf)
+        print(f"Calibrated stress prescorer on {len(y)} LLM scores "
+              f"(cross-validated residual std {self.uncertainty:.3f})")
+        return self
+
+    def score(self, metrics):
+        """Return the local stress score in [0, 1] of every row."""
+        features = prescore_features(metrics)
+        if self.calibrated:
+            return np.clip(self._standardize(features) @ self.coefficients + self.intercept, 0, 1)
+        z = features[list(HEURISTIC_WEIGHTS)].to_numpy(dtype=np.float64)
+        z = _standardize(z, *_center_and_scale(z))
+        return 1 / (1 + np.exp(-(z @ np.array(list(HEURISTIC_WEIGHTS.values())) + HEURISTIC_OFFSET)))
+
+    def triage(self, metrics, threshold=0.35, confidence_z=2.0, holdout_share=0.0, seed=0):
+        """
+        Score every driver and decide which ones need the LLM.
+
+        A driver is kept local only when its score is confidently low: the
+        score plus confidence_z uncertainties is still below threshold. Uncertain
+        and high-stress drivers are sent to the LLM, and so is a random
+        holdout_share of the drivers that would be kept local, to calibrate on.
+
+        Returns a DataFrame with driver_ID, prescore, send_to_llm and holdout.
+
+        Parameters:
+        - metrics: pandas.DataFrame. drivers_metrics rows with driver_ID and PRESCORE_FEATURES.
+        - threshold: float. Scores at or above it count as possibly stressed.
+        - confidence_z: float. Width of the confidence band in uncertainties.
+        - holdout_share: float. Share of the locally kept drivers sent to the LLM anyway.
+        - seed: int. Seed of the holdout membership, see holdout_mask.
+        """
+        scores = self.score(metrics)
+        send_to_llm = scores + confidence_z * self.uncertainty >= threshold
+        holdout = ~send_to_llm & holdout_mask(metrics["driver_ID"].to_numpy(), holdout_share, seed)
+        return pd.DataFrame({
+            "driver_ID": metrics["driver_ID"].to_numpy(),
+            "prescore": scores,
+            "send_to_llm": send_to_llm | holdout,
+            "holdout": holdout,
+        })
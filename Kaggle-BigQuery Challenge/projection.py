@@ -0,0 +1,271 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def pca_fit(X, n_components=50, batch_size=65536):
+    """
+    Fit PCA with a streamed covariance matrix, returning (mean, components).
+
+    Parameters:
+    - X: np.ndarray. (n, dim) matrix.
+    - n_components: int. Number of principal axes kept.
+    - batch_size: int. Rows accumulated into the covariance at a time.
+    """
+    X = np.asarray(X, dtype=np.float32)
+    mean = X.mean(axis=0, dtype=np.float64)
+    cov = np.zeros((X.shape[1], X.shape[1]), dtype=np.float64)
+    for start in range(0, len(X), batch_size):
+        batch = X[start:start + batch_size] - mean
+        cov += batch.T @ batch
+    eigenvalues, eigenvectors = np.linalg.eigh(cov)
+    order = np.argsort(eigenvalues)[::-1][:min(n_components, X.shape[1])]
+    return mean.astype(np.float32), eigenvectors[:, order].astype(np.float32)
+
+
+def stratified_sample(labels, max_points, seed=42, min_per_label=5):
+    """
+    Return sorted row indices sampling every label proportionally to its size.
+
+    Each label keeps at least min_per_label rows (or all of them, if fewer) so
+    small stress tags still appear in the layout.
+    """
+    labels = np.asarray(labels)
+    if len(labels) <= max_points:
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    values, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    quotas = np.maximum(np.minimum(counts, min_per_label),
+                        np.floor(counts * max_points / len(labels)).astype(np.int64))
+    picked = []
+    for value_index, quota in enumerate(quotas):
+        rows = np.nonzero(inverse == value_index)[0]
+        picked.append(rng.choice(rows, quota, replace=False))
+    return np.sort(np.concatenate(picked))
+
+
+def embedding_set_key(ids, X, **params):
+    """Hash the ids, vectors and projection parameters of an embedding set."""
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(ids).tobytes())
+    digest.update(np.ascontiguousarray(X, dtype=np.float32).tobytes())
+    digest.update(repr(sorted(params.items())).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def vector_hashes(X):
+    """Return a 64-bit hash of every row of X, to tell when a point's vector changed."""
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    return np.array([int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), "little")
+                     for row in X], dtype=np.uint64)
+
+
+class Projection:
+    """
+    2D layout of an embedding set computed on landmarks.
+
+    t-SNE (Barnes-Hut) runs on the PCA-reduced landmarks only; every other point,
+    including points added later, is placed at the distance-weighted average of
+    its nearest landmarks. The layout of existing points only moves when their
+    vector changes.
+
+    Parameters:
+    - mean, components: PCA fitted on the embedding set.
+    - landmarks: np.ndarray. PCA-reduced landmark vectors.
+    - landmark_coords: np.ndarray. (n_landmarks, 2) t-SNE coordinates.
+    - ids, coords: Point ids and their (n, 2) coordinates.
+    - hashes: np.ndarray or None. vector_hashes of the points' vectors; None
+      (a layout saved without them) makes every point count as changed.
+    """
+
+    def __init__(self, mean, components, landmarks, landmark_coords, ids, coords, hashes=None):
+        self.mean = mean
+        self.components = components
+        self.landmarks = landmarks
+        self.landmark_coords = landmark_coords
+        self.ids = ids
+        self.coords = coords
+        self.hashes = np.zeros(len(ids), dtype=np.uint64) if hashes is None else hashes
+        self._verified = hashes is not None
+
+    def reduce(self, X):
+        """Project vectors onto the fitted principal axes."""
+        return (np.asarray(X, dtype=np.float32) - self.mean) @ self.components
+
+    def place(self, X, n_neighbors=10, batch_size=4096):
+        """Return 2D coordinates of new vectors by interpolating their nearest landmarks."""
+        reduced = self.reduce(X)
+        n_neighbors = min(n_neighbors, len(self.landmarks))
+        landmark_norms = (self.landmarks ** 2).sum(axis=1)
+        coords = np.empty((len(reduced), 2), dtype=np.float32)
+        for start in range(0, len(reduced), batch_size):
+            batch = reduced[start:start + batch_size]
+            distances = ((batch ** 2).sum(axis=1)[:, None] + landmark_norms[None, :]
+                         - 2 * batch @ self.landmarks.T)
+            distances = np.maximum(distances, 0)
+            nearest = np.argpartition(distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+            weights = 1.0 / (np.sqrt(np.take_along_axis(distances, nearest, axis=1)) + 1e-6)
+            weights /= weights.sum(axis=1, keepdims=True)
+            coords[start:start + batch_size] = np.einsum(
+                "ij,ijk->ik", weights, self.landmark_coords[nearest]
+            )
+        return coords
+
+    def outdated(self, ids, hashes):
+        """Return a mask of the ids that are not in the layout or whose vector hash changed."""
+        position = {point_id: row for row, point_id in enumerate(self.ids.tolist())}
+        rows = np.array([position.get(point_id, -1) for point_id in np.asarray(ids).tolist()],
+                        dtype=np.int64)
+        mask = rows < 0
+        if self._verified:
+            mask[~mask] = self.hashes[rows[~mask]] != hashes[~mask]
+        else:
+            mask[:] = True
+        return mask
+
+    def extend(self, ids, X, hashes=None):
+        """
+        Place points whose ids are new or whose vectors changed, and return their count.
+
+        New ids are appended; changed ones are moved to their new place.
+        """
+        ids = np.asarray(ids)
+        hashes = vector_hashes(X) if hashes is None else hashes
+        outdated = self.outdated(ids, hashes)
+        if outdated.any():
+            coords = self.place(np.asarray(X)[outdated])
+            position = {point_id: row for row, point_id in enumerate(self.ids.tolist())}
+            rows = np.array([position.get(point_id, -1) for point_id in ids[outdated].tolist()],
+                            dtype=np.int64)
+            known = rows >= 0
+            self.coords[rows[known]] = coords[known]
+            self.hashes[rows[known]] = hashes[outdated][known]
+            self.ids = np.concatenate([self.ids, ids[outdated][~known]])
+            self.coords = np.vstack([self.coords, coords[~known]])
+            self.hashes = np.concatenate([self.hashes, hashes[outdated][~known]])
+        self._verified = True
+        return int(outdated.sum())
+
+    def coords_for(self, ids):
+        """Return the coordinates of the given ids, in order."""
+        position = {point_id: row for row, point_id in enumerate(self.ids.tolist())}
+        return self.coords[[position[point_id] for point_id in np.asarray(ids).tolist()]]
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components, landmarks=self.landmarks,
+                 landmark_coords=self.landmark_coords, ids=self.ids, coords=self.coords,
+                 hashes=self.hashes)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+
+def fit_projection(ids, X, labels=None, n_components=50, n_landmarks=5000,
+                   perplexity=30, random_state=42):
+    """
+    Compute a landmark t-SNE layout of an embedding set.
+
+    Parameters:
+    - ids: np.ndarray. One id per row of X.
+    - X: np.ndarray. (n, dim) embedding matrix.
+    - labels: array-like or None. Labels used to stratify the landmark sample.
+    - n_components: int. PCA dimensions fed to t-SNE.
+    - n_landmarks: int. Maximum number of points laid out by t-SNE itself.
+    - perplexity: float. t-SNE perplexity, capped for small landmark sets.
+    - random_state: int. Seed for sampling and t-SNE.
+    """
+    from sklearn.manifold import TSNE
+
+    X = np.asarray(X, dtype=np.float32)
+    ids = np.asarray(ids)
+    mean, components = pca_fit(X, n_components=n_components)
+    if labels is None:
+        labels = np.zeros(len(X), dtype=np.int64)
+    landmark_rows = stratified_sample(labels, n_landmarks, seed=random_state)
+    landmarks = (X[landmark_rows] - mean) @ components
+
+    tsne = TSNE(n_components=2,
+                perplexity=min(perplexity, max(1, len(landmarks) - 1) / 3),
+                method="barnes_hut",
+                init="pca",
+                n_jobs=-1,
+                random_state=random_state)
+    landmark_coords = tsne.fit_transform(landmarks).astype(np.float32)
+
+    projection = Projection(mean, components, landmarks, landmark_coords,
+                            ids=ids[landmark_rows], coords=landmark_coords.copy(),
+                            hashes=vector_hashes(X[landmark_rows]))
+    projection.extend(ids, X)
+    return projection
+
+
+def prune_projection_cache(cache_dir, max_entries):
+    """
+    Delete all but the max_entries most recently used layouts of cache_dir.
+
+    latest.npz, which incremental updates start from, is always kept. Returns
+    the number of files deleted.
+    """
+    paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+             if name.endswith(".npz") and name != "latest.npz"]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[max_entries:]:
+        os.remove(path)
+    return max(0, len(paths) - max_entries)
+
+
+def project_embeddings(ids, X, labels=None, cache_dir="cache/projections",
+                       max_new_fraction=0.5, max_cached=8, **params):
+    """
+    Return (n, 2) coordinates of an embedding set, reusing cached layouts.
+
+    An identical embedding set is served from disk. Otherwise the latest layout
+    is extended with the new ids and the ids whose vector changed, as long as
+    they are at most max_new_fraction of the set; beyond that the layout is
+    recomputed from scratch.
+
+    Parameters:
+    - ids: np.ndarray. One id per row of X.
+    - X: np.ndarray. (n, dim) embedding matrix.
+    - labels: array-like or None. Labels used to stratify the landmark sample.
+    - cache_dir: str. Directory holding cached layouts.
+    - max_new_fraction: float. Share of unseen or changed ids still placed incrementally.
+    - max_cached: int. Layouts kept besides latest.npz, least recently used deleted first.
+    - params: Extra fit_projection arguments, part of the cache key.
+    """
+    ids = np.asarray(ids)
+    key = embedding_set_key(ids, X, **params)
+    path = os.path.join(cache_dir, f"{key}.npz")
+    latest_path = os.path.join(cache_dir, "latest.npz")
+
+    if os.path.exists(path):
+        print(f"Loaded cached projection {key}")
+        # The modification time orders layouts by last use for prune_projection_cache
+        os.utime(path)
+        return Projection.load(path).coords_for(ids)
+
+    projection = None
+    if os.path.exists(latest_path):
+        projection = Projection.load(latest_path)
+        if projection.mean.shape[0] != np.shape(X)[1]:
+            projection = None
+        else:
+            hashes = vector_hashes(X)
+            if projection.outdated(ids, hashes).mean() > max_new_fraction:
+                projection = None
+            else:
+                placed = projection.extend(ids, X, hashes=hashes)
+                print(f"Placed {placed} new or changed points on the cached projection")
+
+    if projection is None:
+        print(f"Computing landmark t-SNE projection for {len(ids)} points")
+        projection = fit_projection(ids, X, labels=labels, **params)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    projection.save(path)
+    projection.save(latest_path)
+    prune_projection_cache(cache_dir, max_cached)
+    return projection.coords_for(ids)
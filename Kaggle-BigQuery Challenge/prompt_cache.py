@@ -0,0 +1,145 @@
+import pandas as pd
+from google.cloud import bigquery
+
+from instrumentation import instrumentation
+from queries import (
+    get_prompt_cache_evict_query,
+    get_prompt_cache_fill_query,
+    get_prompt_cache_load_query,
+    get_prompt_cache_misses_query,
+    get_prompt_cache_stats_query,
+    get_prompt_cache_touch_query,
+)
+
+prompt_cache_schema = [
+    bigquery.SchemaField("cache_key", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("stage", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("prompt_name", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("endpoint", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("result", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("created_at", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("last_used_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+
+class PromptCache:
+    """
+    Content-addressed cache of AI.GENERATE* results stored in a BigQuery table.
+
+    Each distinct prompt is keyed by a hash of (AI function, endpoint, prompt
+    template, formatted prompt), so the model is only called for prompts whose
+    inputs changed or whose cached result is older than ttl_hours. Marts built
+    with get_cached_prompts_sql then read results from the cache instead of
+    calling the model.
+
+    Parameters:
+    - client: bigquery.Client used to run the cache jobs.
+    - table_id: str. Full path of the cache table.
+    - project_id: str. Google Cloud project identifier.
+    - connection_id: str. Vertex AI connection used for AI.GENERATE functions.
+    - ttl_hours: int. Age after which a result is regenerated and evicted.
+    - max_entries: int. Number of most recently used entries kept by evict().
+    - executor: llm_executor.PromptExecutor or None. When set, missing prompts
+      are generated client-side and bulk-loaded instead of through AI.GENERATE*.
+    """
+
+    def __init__(self, client, table_id, project_id, connection_id,
+                 ttl_hours=24 * 30, max_entries=5_000_000, executor=None):
+        self.client = client
+        self.table_id = table_id
+        self.project_id = project_id
+        self.connection_id = connection_id
+        self.ttl_hours = ttl_hours
+        self.max_entries = max_entries
+        self.executor = executor
+
+    def ensure_table(self):
+        """Create the cache table, clustered by key, if it does not exist yet."""
+        table = bigquery.Table(self.table_id, schema=prompt_cache_schema)
+        table.clustering_fields = ["cache_key"]
+        self.client.create_table(table, exists_ok=True)
+
+    def stats(self, source_query, prompt):
+        """Return the hits and misses a refresh of prompt over source_query would see."""
+        query = get_prompt_cache_stats_query(self.table_id, source_query, prompt, self.ttl_hours)
+        row = next(iter(self.client.query(query).result()))
+        return {"hits": row.hits, "misses": row.misses}
+
+    def refresh(self, stage, source_query, prompts):
+        """
+        Generate the missing results of a stage and return hit/miss counts per prompt.
+
+        Parameters:
+        - stage: str. Pipeline stage name, used in logs and stored with the results.
+        - source_query: str. SQL returning the columns referenced by the prompts.
+        - prompts: list[queries.PromptSpec]. Prompts evaluated by the stage.
+        """
+        self.ensure_table()
+        report = {}
+        for prompt in prompts:
+            counts = self.stats(source_query, prompt)
+            if counts["misses"] and self.executor is not None:
+                counts["failed"] = self.fill_with_executor(stage, source_query, prompt)
+            elif counts["misses"]:
+                fill_query = get_prompt_cache_fill_query(
+                    self.table_id, source_query, prompt, stage,
+                    self.project_id, self.connection_id, self.ttl_hours,
+                )
+                self.client.query(fill_query).result()
+                instrumentation.record_llm(prompt.endpoint, calls=counts["misses"])
+            if counts["hits"]:
+                touch_query = get_prompt_cache_touch_query(self.table_id, source_query, prompt)
+                self.client.query(touch_query).result()
+            print(f"Prompt cache [{stage}] {prompt.name}: "
+                  f"{counts['hits']} hits, {counts['misses']} misses")
+            report[prompt.name] = counts
+        return report
+
+    def fill_with_executor(self, stage, source_query, prompt):
+        """
+        Generate the missing prompts of a stage with the executor and bulk-load the results.
+
+        Returns the number of prompts that still failed; they stay missing and
+        are retried on the next refresh.
+        """
+        query = get_prompt_cache_misses_query(self.table_id, source_query, prompt, self.ttl_hours)
+        missing = self.client.query(query).result().to_dataframe()
+        results, report = self.executor.run(prompt, zip(missing["cache_key"], missing["prompt"]))
+        self.load_results(stage, prompt, results)
+        self.executor.clear_checkpoint(prompt)
+        return len(report.failed_rows)
+
+    def load_results(self, stage, prompt, results):
+        """
+        Merge {cache key: result} into the cache through a load job.
+
+        Results are stored as strings, as the AI function results are; None
+        results are not cached.
+        """
+        rows = pd.DataFrame({
+            "cache_key": list(results),
+            "result": [None if value is None else str(value).lower() if isinstance(value, bool)
+                       else str(value) for value in results.values()],
+        }, columns=["cache_key", "result"])
+        if rows.empty:
+            return
+        load_table_id = f"{self.table_id}_load"
+        job_config = bigquery.LoadJobConfig(
+            write_disposition="WRITE_TRUNCATE",
+            schema=[bigquery.SchemaField("cache_key", "STRING", mode="REQUIRED"),
+                    bigquery.SchemaField("result", "STRING", mode="NULLABLE")],
+        )
+        self.client.load_table_from_dataframe(rows, load_table_id, job_config=job_config).result()
+        try:
+            self.client.query(get_prompt_cache_load_query(self.table_id, load_table_id,
+                                                          stage, prompt)).result()
+        finally:
+            self.client.delete_table(load_table_id, not_found_ok=True)
+        print(f"Prompt cache [{stage}] {prompt.name}: loaded {len(rows)} results")
+
+    def evict(self):
+        """Delete expired entries and keep at most max_entries most recently used ones."""
+        query = get_prompt_cache_evict_query(self.table_id, self.ttl_hours, self.max_entries)
+        job = self.client.query(query)
+        job.result()
+        print(f"Prompt cache evicted {job.num_dml_affected_rows or 0} entries from {self.table_id}")
@@ -1,5 +1,18 @@
+import hashlib
+from dataclasses import dataclass
 
-def get_articles_metrics_query(project_id, dataset_id, connection_id):
+
+# Label column -> yes/no question asked about each news article
+ARTICLE_LABELS = {
+    "financial_pressure": "Does this article suggest that delivery drivers are experiencing financial pressure or debt due to work-related expenses?",
+    "unsafe_conditions": "Does this article describe unsafe or dangerous working conditions for delivery drivers?",
+    "lack_of_support": "Does this article mention lack of support, unfair treatment, or neglect from the platform (like iFood) toward gig workers?",
+    "overwork_burnout": "Does this article suggest that delivery drivers are overworked or at risk of burnout?",
+}
+
+
+def get_articles_metrics_query(project_id, dataset_id, connection_id, labels=None, consolidated=True,
+                               clusters_table_id=None, digests_table_id=None):
     """
     Generate SQL for evaluating news articles with AI-generated metrics.
 
@@ -7,96 +20,344 @@ def get_articles_metrics_query(project_id, dataset_id, connection_id):
     - project_id: str. Google Cloud project identifier.
     - dataset_id: str. BigQuery dataset containing the source table.
     - connection_id: str. Vertex AI connection used for AI.GENERATE functions.
+    - labels: dict[str, str] or None. Boolean label column -> question; defaults to ARTICLE_LABELS.
+    - consolidated: bool. Ask every question in a single structured-output call per
+      article instead of one AI.GENERATE_BOOL call (and one copy of the content) per label.
+    - clusters_table_id: str or None. Near-duplicate clusters (article_name,
+      canonical_article_name) written by dedupe_articles. When given, only canonical
+      articles are sent to Gemini and every clustered article gets its canonical
+      article's labels, with a canonical_article_name column.
+    - digests_table_id: str or None. Article digests (article_name, digest) written by
+      build_article_digests. When given, prompts carry an article's digest instead of
+      its full content (the content when it has no digest yet).
     """
-    return f'''
+    labels = labels or ARTICLE_LABELS
+    connection = f"projects/{project_id}/locations/us/connections/{connection_id}"
+    articles_table_id = f"{project_id}.{dataset_id}.news_content_usa"
+    where = "content IS NOT NULL AND content != ''"
+    source = f"`{articles_table_id}`"
+    content = "content"
+    if digests_table_id:
+        source += f"\nLEFT JOIN `{digests_table_id}` AS digests USING (article_name)"
+        content = "IFNULL(digests.digest, content)"
+    if clusters_table_id:
+        where += f"""
+  AND article_name IN (SELECT canonical_article_name FROM `{clusters_table_id}`)"""
 
-SELECT
+    if consolidated:
+        questions = "\n".join(f"- {name}: {question}" for name, question in labels.items())
+        output_schema = ", ".join(f"{name} BOOL" for name in labels)
+        columns = ",\n  ".join(f"labels.{name}" for name in labels)
+        scored = f'''SELECT
   article_name,
   city,
   published,
+  {columns}
 
-  AI.GENERATE_BOOL(
-    FORMAT("""
-Does this article suggest that delivery drivers are experiencing financial pressure or debt due to work-related expenses?
+FROM (
+  SELECT
+    article_name,
+    city,
+    published,
+    AI.GENERATE(
+      FORMAT("""
+Answer each question below about the article with true or false.
+
+{questions}
 
 Article name: %s
 Content: %s
-""", article_name, content),
-    connection_id => 'projects/{project_id}/locations/us/connections/{connection_id}',
-    endpoint => 'gemini-2.0-flash'
-  ) AS financial_pressure,
-
-  AI.GENERATE_BOOL(
+""", article_name, {content}),
+      connection_id => '{connection}',
+      endpoint => 'gemini-2.0-flash',
+      output_schema => '{output_schema}'
+    ) AS labels
+  FROM {source}
+  WHERE {where}
+)'''
+    else:
+        calls = ",\n\n".join(f'''  AI.GENERATE_BOOL(
     FORMAT("""
-Does this article describe unsafe or dangerous working conditions for delivery drivers?
+{question}
 
 Article name: %s
 Content: %s
-""", article_name, content),
-    connection_id => 'projects/{project_id}/locations/us/connections/{connection_id}',
+""", article_name, {content}),
+    connection_id => '{connection}',
     endpoint => 'gemini-2.0-flash'
-  ) AS unsafe_conditions,
+  ) AS {name}''' for name, question in labels.items())
+        scored = f'''SELECT
+  article_name,
+  city,
+  published,
 
-  AI.GENERATE_BOOL(
-    FORMAT("""
-Does this article mention lack of support, unfair treatment, or neglect from the platform (like iFood) toward gig workers?
+{calls}
 
-Article name: %s
-Content: %s
-""", article_name, content),
-    connection_id => 'projects/{project_id}/locations/us/connections/{connection_id}',
-    endpoint => 'gemini-2.0-flash'
-  ) AS lack_of_support,
+FROM {source}
+WHERE {where}'''
 
-  AI.GENERATE_BOOL(
-    FORMAT("""
-Does this article suggest that delivery drivers are overworked or at risk of burnout?
+    if not clusters_table_id:
+        return f"\n\n{scored};\n\n"
 
-Article name: %s
-Content: %s
-""", article_name, content),
-    connection_id => 'projects/{project_id}/locations/us/connections/{connection_id}',
-    endpoint => 'gemini-2.0-flash'
-  ) AS overwork_burnout
+    propagated = ",\n  ".join(f"scored.{name}" for name in labels)
+    return f'''
+
+WITH scored AS (
+{scored}
+)
 
-FROM `{project_id}.{dataset_id}.news_content_usa`
-WHERE content IS NOT NULL AND content != '';
+SELECT
+  articles.article_name,
+  articles.city,
+  articles.published,
+  clusters.canonical_article_name,
+  {propagated}
+FROM `{articles_table_id}` AS articles
+JOIN `{clusters_table_id}` AS clusters
+ON articles.article_name = clusters.article_name
+JOIN scored
+ON scored.article_name = clusters.canonical_article_name;
 
 '''
 
-def get_drivers_metrics_query(project_id, dataset_id, connection_id):
+
+@dataclass(frozen=True)
+class PromptSpec:
     """
-    Construct SQL to compute driver metrics and stress scores using AI.
+    A prompt sent to Gemini through one of the BigQuery AI functions.
+
+    Parameters:
+    - name: str. Output column the result is published as.
+    - function: str. AI.GENERATE, AI.GENERATE_DOUBLE or AI.GENERATE_BOOL.
+    - template: str. FORMAT template; also valid for Python %-formatting.
+    - args: tuple[str]. SQL expressions substituted into the template.
+    - endpoint: str. Gemini model endpoint.
+    """
+
+    name: str
+    function: str
+    template: str
+    args: tuple
+    endpoint: str = "gemini-2.0-flash"
+
+    @property
+    def template_hash(self):
+        return hashlib.sha256(self.template.encode("utf-8")).hexdigest()[:16]
+
+
+AI_RESULT_TYPES = {
+    "AI.GENERATE": "STRING",
+    "AI.GENERATE_DOUBLE": "FLOAT64",
+    "AI.GENERATE_BOOL": "BOOL",
+}
+
+DRIVER_STRESS_SCORE_PROMPT = PromptSpec(
+    name="stress_score",
+    function="AI.GENERATE_DOUBLE",
+    template="""
+Example:
+A 44-year-old driver from Los Angeles with 11 years of experience, a 4.9 average rating, 7 rides in 5 active days, worked a total of 402 minutes. The minimum fare was $20.45 and the maximum was $215.37, with a fare standard deviation of $75. This driver has a stress level of 0.2.
+
+Now assess the following driver:
+A %d-year-old driver from %s with %d years of experience, a %.1f rating, %d rides in %d active days, worked a total of %d minutes. The minimum fare was $%.2f and the maximum was $%.2f, with a fare standard deviation of $%.2f. What is the estimated stress level (from 0 to 1)?
+""",
+    args=("Age", "City", "Experience_Years", "Average_Rating", "total_rides_all_days",
+          "active_days", "total_duration_min_all_days", "min_fare", "max_fare", "stddev_fare"),
+)
+
+DRIVER_STRESS_REASON_PROMPT = PromptSpec(
+    name="stress_reason",
+    function="AI.GENERATE",
+    template="""
+Given the following metrics, write a short 2-sentence explanation describing this driver's work routine and stress rationale.
+
+Driver Profile:
+- Age: %d
+- City: %s
+- Experience: %d years
+- Average rating: %.1f
+- Active days: %d
+- Total rides: %d
+- Total minutes worked: %d
+- Fare range: $%.2f to $%.2f
+- Fare standard deviation: $%.2f
+
+Your response should mention the workload and variability in earnings, and whether the stress level is likely high or low.
+""",
+    args=("Age", "City", "Experience_Years", "Average_Rating", "active_days",
+          "total_rides_all_days", "total_duration_min_all_days", "min_fare", "max_fare",
+          "stddev_fare"),
+)
+
+DRIVER_REASON_TAGS_PROMPT = PromptSpec(
+    name="stress_report_tags",
+    function="AI.GENERATE",
+    template="""
+Given the stress reason described by the driver, return 2 to 3 keywords that reflect the health state of the driver.
+Return like example below on a limit of 2 words by keyword.
+
+Keyword1, Keyword2, Keyword3
+
+Please see the stress text below:
+%s
+""",
+    args=("stress_reason",),
+)
+
+
+# Reason published for drivers the local prescorer keeps away from the model
+PRESCORED_STRESS_REASON_TEMPLATE = (
+    "This %d-year-old driver from %s completed %d rides over %d active days, %d minutes in "
+    "total, with fares from $%.2f to $%.2f. The workload and earnings variability are moderate, "
+    "so the stress level is likely low (estimated locally)."
+)
+PRESCORED_STRESS_REASON_ARGS = ("Age", "City", "total_rides_all_days", "active_days",
+                                "total_duration_min_all_days", "min_fare", "max_fare")
+
+# Tags published for prescored drivers instead of asking the model
+PRESCORED_STRESS_TAGS = "Low stress, Light workload"
+
+
+def prompt_cache_key(prompt, formatted_prompt):
+    """Compute in Python the same cache key get_prompt_key_sql computes in BigQuery."""
+    payload = "|".join([prompt.function, prompt.endpoint, prompt.template_hash, formatted_prompt])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_format_sql(template, args):
+    """Render a FORMAT(...) expression of a template over SQL expressions."""
+    args = ",\n      ".join(args)
+    return f'''FORMAT("""{template}""",
+      {args}
+    )'''
+
+
+def get_prompt_format_sql(prompt):
+    """Render the FORMAT(...) expression building the prompt text of each row."""
+    return get_format_sql(prompt.template, prompt.args)
+
+
+def get_ai_function_sql(prompt, project_id, connection_id, prompt_sql=None):
+    """
+    Render the AI.GENERATE* call of a prompt, returning its typed result.
 
     Parameters:
+    - prompt: PromptSpec. Prompt to call.
     - project_id: str. Google Cloud project identifier.
-    - dataset_id: str. BigQuery dataset containing driver and ride tables.
     - connection_id: str. Vertex AI connection used for AI.GENERATE functions.
+    - prompt_sql: str or None. Prompt expression; defaults to the FORMAT of prompt.args.
     """
+    if prompt_sql is None:
+        prompt_sql = get_prompt_format_sql(prompt)
+    return f"""{prompt.function}(
+    prompt => {prompt_sql},
+    connection_id => 'projects/{project_id}/locations/us/connections/{connection_id}',
+    endpoint => '{prompt.endpoint}'
+  ).result"""
+
+
+def get_prompt_key_sql(prompt, prompt_sql):
+    """Render the content-addressed cache key of a prompt expression."""
+    return (f"TO_HEX(SHA256(CONCAT('{prompt.function}', '|', '{prompt.endpoint}', '|', "
+            f"'{prompt.template_hash}', '|', {prompt_sql})))")
+
+
+def get_prompt_keys_sql(source_query, prompt):
+    """Generate SQL listing each distinct prompt of a source with its cache key."""
     return f"""
+SELECT cache_key, ANY_VALUE(prompt) AS prompt
+FROM (
+  SELECT {get_prompt_key_sql(prompt, "prompt")} AS cache_key, prompt
+  FROM (
+    SELECT {get_prompt_format_sql(prompt)} AS prompt
+    FROM ({source_query})
+  )
+)
+WHERE cache_key IS NOT NULL
+GROUP BY cache_key
+"""
 
--- CREATE OR REPLACE TABLE MARTS_DATA.tbl_drivers_metrics AS 
 
-WITH summary_drivers AS (
+def get_cached_prompts_sql(cache_table_id, source, prompts, columns, require_cached=False):
+    """
+    Generate SQL that publishes prompt results by looking them up in the cache.
+
+    Parameters:
+    - cache_table_id: str. Full path of the prompt cache table.
+    - source: str. Table reference or CTE name holding the prompt arguments.
+    - prompts: list[PromptSpec]. Prompts published as columns named prompt.name.
+    - columns: list[str]. Source columns passed through unchanged.
+    - require_cached: bool. Drop rows whose results are not all cached yet,
+      instead of publishing them with NULL results.
+    """
+    keys = ",\n         ".join(
+        f"{get_prompt_key_sql(prompt, get_prompt_format_sql(prompt))} AS {prompt.name}_key"
+        for prompt in prompts
+    )
+    results = []
+    joins = []
+    for prompt in prompts:
+        result_sql = f"{prompt.name}_cache.result"
+        if AI_RESULT_TYPES[prompt.function] != "STRING":
+            result_sql = f"SAFE_CAST({result_sql} AS {AI_RESULT_TYPES[prompt.function]})"
+        results.append(f"{result_sql} AS {prompt.name}")
+        joins.append(f"LEFT JOIN `{cache_table_id}` {prompt.name}_cache\n"
+                     f"ON {prompt.name}_cache.cache_key = prompts.{prompt.name}_key")
+    selected = ",\n       ".join([f"prompts.{column}" for column in columns] + results)
+    joined = "\n".join(joins)
+    where = ""
+    if require_cached:
+        where = "\nWHERE " + "\n  AND ".join(f"{prompt.name}_cache.cache_key IS NOT NULL"
+                                             for prompt in prompts)
+    return f"""SELECT {selected}
+FROM (
+  SELECT *,
+         {keys}
+  FROM {source}
+) prompts
+{joined}{where}"""
+
+
+def get_drivers_summary_ctes(project_id, dataset_id, driver_ids_sql=None, daily_table_id=None):
+    """
+    Build the WITH clause that aggregates rides per driver and day, then per driver.
+
+    Per-day totals are read from the driver x day aggregate table instead of raw
+    rides, so a refresh scans one row per driver and active day.
+
+    Parameters:
+    - project_id: str. Google Cloud project identifier.
+    - dataset_id: str. BigQuery dataset containing driver and ride tables.
+    - driver_ids_sql: str or None. SQL ARRAY<INT64> expression (e.g. a script
+      variable) restricting the drivers aggregated. The daily table is clustered
+      by Driver_ID, so only the blocks of these drivers are scanned.
+    - daily_table_id: str or None. Full path of the driver x day aggregate table,
+      by default driver_daily_rides in dataset_id.
+    """
+    daily_table = f"`{daily_table_id or f'{project_id}.{dataset_id}.driver_daily_rides'}`"
+    drivers_filter = ""
+    if driver_ids_sql is not None:
+        daily_table = f"(SELECT * FROM {daily_table} WHERE Driver_ID IN UNNEST({driver_ids_sql}))"
+        drivers_filter = f"\n  WHERE drivers.Driver_ID IN UNNEST({driver_ids_sql})"
+    return f"""WITH summary_drivers AS (
   SELECT drivers.Driver_ID,
         drivers.Age,
         drivers.City,
         drivers.Experience_Years,
         drivers.Average_Rating,
-        rides.Date,
-        COUNT(rides.Ride_ID) AS total_rides,
-        ROUND(SUM(rides.fare),2) AS total_fare,
-        SUM(rides.Duration_min) AS total_duration_min
+        daily.Date,
+        IFNULL(SUM(daily.total_rides), 0) AS total_rides,
+        ROUND(SUM(IF(daily.fare_count > 0, daily.fare_sum, NULL)),2) AS total_fare,
+        SUM(IF(daily.duration_count > 0, daily.duration_sum, NULL)) AS total_duration_min
   FROM `{project_id}.{dataset_id}.drivers_data` drivers
-  LEFT JOIN `{project_id}.{dataset_id}.rides_data` rides
-  ON drivers.Driver_ID = rides.Driver_ID
+  LEFT JOIN {daily_table} daily
+  ON drivers.Driver_ID = daily.Driver_ID{drivers_filter}
   GROUP BY drivers.Driver_ID,
            drivers.Age,
            drivers.City,
            drivers.Experience_Years,
            drivers.Average_Rating,
-           rides.Date
-  ORDER BY total_fare DESC
+           daily.Date
 ),
 
 drivers_metrics AS (
@@ -115,87 +376,784 @@ drivers_metrics AS (
          SUM(total_duration_min) AS total_duration_min_all_days
   FROM summary_drivers
   GROUP BY driver_ID, Age, City, Experience_Years
-)
+)"""
+
+
+def get_drivers_aggregates_query(project_id, dataset_id, daily_table_id=None):
+    """
+    Construct SQL returning the numeric driver metrics without any AI columns.
+
+    This is the reference the local metrics backend is checked against.
+
+    Parameters:
+    - project_id: str. Google Cloud project identifier.
+    - dataset_id: str. BigQuery dataset containing driver and ride tables.
+    - daily_table_id: str or None. Driver x day aggregate table (see get_drivers_summary_ctes).
+    """
+    return f"""
+{get_drivers_summary_ctes(project_id, dataset_id, daily_table_id=daily_table_id)}
+
+SELECT *
+FROM drivers_metrics
+"""
+
+
+def get_drivers_metrics_query(project_id, dataset_id, connection_id, prompt_cache_table_id=None,
+                              daily_table_id=None):
+    """
+    Construct SQL to compute driver metrics and stress scores using AI.
+
+    Parameters:
+    - project_id: str. Google Cloud project identifier.
+    - dataset_id: str. BigQuery dataset containing driver and ride tables.
+    - connection_id: str. Vertex AI connection used for AI.GENERATE functions.
+    - prompt_cache_table_id: str or None. When set, stress_score and stress_reason are
+      read from this prompt cache table instead of calling the model.
+    - daily_table_id: str or None. Driver x day aggregate table (see get_drivers_summary_ctes).
+    """
+    summary_ctes = get_drivers_summary_ctes(project_id, dataset_id, daily_table_id=daily_table_id)
+    if prompt_cache_table_id:
+        return f"""
+{summary_ctes}
+
+{get_cached_prompts_sql(prompt_cache_table_id, "drivers_metrics",
+                        [DRIVER_STRESS_SCORE_PROMPT, DRIVER_STRESS_REASON_PROMPT],
+                        ["driver_ID", "City", "Age"])}
+"""
+
+    return f"""
+
+-- CREATE OR REPLACE TABLE MARTS_DATA.tbl_drivers_metrics AS 
+
+{summary_ctes}
 
 SELECT driver_ID,
        City,
        Age,
-       AI.GENERATE_DOUBLE(
-         prompt => FORMAT(\"""
-Example:
-A 44-year-old driver from Los Angeles with 11 years of experience, a 4.9 average rating, 7 rides in 5 active days, worked a total of 402 minutes. The minimum fare was $20.45 and the maximum was $215.37, with a fare standard deviation of $75. This driver has a stress level of 0.2.
-
-Now assess the following driver:
-A %d-year-old driver from %s with %d years of experience, a %.1f rating, %d rides in %d active days, worked a total of %d minutes. The minimum fare was $%.2f and the maximum was $%.2f, with a fare standard deviation of $%.2f. What is the estimated stress level (from 0 to 1)?
-\""",
-           Age,
-           City,
-           Experience_Years,
-           Average_Rating,
-           total_rides_all_days,
-           active_days,
-           total_duration_min_all_days,
-           min_fare,
-           max_fare,
-           stddev_fare
-         ),
-         connection_id => 'projects/{project_id}/locations/us/connections/{connection_id}',
-         endpoint => 'gemini-2.0-flash'
-       ).result AS stress_score,
-
-  AI.GENERATE(
-    prompt => FORMAT(\"""
-Given the following metrics, write a short 2-sentence explanation describing this driver's work routine and stress rationale.
+       {get_ai_function_sql(DRIVER_STRESS_SCORE_PROMPT, project_id, connection_id)} AS stress_score,
 
-Driver Profile:
-- Age: %d
-- City: %s
-- Experience: %d years
-- Average rating: %.1f
-- Active days: %d
-- Total rides: %d
-- Total minutes worked: %d
-- Fare range: $%.2f to $%.2f
-- Fare standard deviation: $%.2f
-
-Your response should mention the workload and variability in earnings, and whether the stress level is likely high or low.
-\""",
-      Age,
-      City,
-      Experience_Years,
-      Average_Rating,
-      active_days,
-      total_rides_all_days,
-      total_duration_min_all_days,
-      min_fare,
-      max_fare,
-      stddev_fare
-    ),
-    connection_id => 'projects/{project_id}/locations/us/connections/{connection_id}',
-    endpoint => 'gemini-2.0-flash'
-  ).result AS stress_reason
+  {get_ai_function_sql(DRIVER_STRESS_REASON_PROMPT, project_id, connection_id)} AS stress_reason
 FROM drivers_metrics
 """
 
 
-def get_driver_reason_tags_query(project_id, dataset_id, connection_id):
+def get_driver_reason_tags_query(project_id, dataset_id, connection_id, prompt_cache_table_id=None):
     """Generate SQL to tag driver stress reasons with keywords."""
+    source = f"`{project_id}.{dataset_id}.drivers_metrics`"
+    if prompt_cache_table_id:
+        return get_cached_prompts_sql(prompt_cache_table_id, source,
+                                      [DRIVER_REASON_TAGS_PROMPT], ["driver_ID"])
+
     return f"""
 SELECT driver_ID,
-  AI.GENERATE(
-    prompt => FORMAT(\"""
-Given the stress reason described by the driver, return 2 to 3 keywords that reflect the health state of the driver.
-Return like example below on a limit of 2 words by keyword.
+  {get_ai_function_sql(DRIVER_REASON_TAGS_PROMPT, project_id, connection_id)} AS stress_report_tags
+FROM {source}
+"""
 
-Keyword1, Keyword2, Keyword3
 
-Please see the stress text below:
-%s
-\""",
-      stress_reason
-    ),
-    connection_id => 'projects/{project_id}/locations/us/connections/{connection_id}',
-    endpoint => 'gemini-2.0-flash'
-  ).result AS stress_report_tags
-FROM `{project_id}.{dataset_id}.drivers_metrics`
+def get_prompt_cache_fill_query(cache_table_id, source_query, prompt, stage,
+                                project_id, connection_id, ttl_hours):
+    """
+    Generate a MERGE that calls the model only for prompts missing from the cache.
+
+    Prompts whose key is absent or older than ttl_hours are generated once per
+    distinct key; results the model failed to produce (NULL) are not cached so
+    they are retried on the next refresh.
+
+    Parameters:
+    - cache_table_id: str. Full path of the prompt cache table.
+    - source_query: str. SQL returning the columns referenced by prompt.args.
+    - prompt: PromptSpec. Prompt to evaluate.
+    - stage: str. Pipeline stage name stored alongside the results.
+    - project_id: str. Google Cloud project identifier.
+    - connection_id: str. Vertex AI connection used for AI.GENERATE functions.
+    - ttl_hours: int. Age after which cached results are regenerated.
+    """
+    return f"""
+MERGE `{cache_table_id}` cache
+USING (
+  SELECT cache_key, result
+  FROM (
+    SELECT cache_key,
+           CAST({get_ai_function_sql(prompt, project_id, connection_id, prompt_sql="prompt")} AS STRING) AS result
+    FROM ({get_prompt_keys_sql(source_query, prompt)})
+    WHERE cache_key NOT IN (
+      SELECT cache_key
+      FROM `{cache_table_id}`
+      WHERE created_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(ttl_hours)} HOUR)
+    )
+  )
+  WHERE result IS NOT NULL
+) fresh
+ON cache.cache_key = fresh.cache_key
+WHEN MATCHED THEN
+  UPDATE SET result = fresh.result,
+             created_at = CURRENT_TIMESTAMP(),
+             last_used_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN
+  INSERT (cache_key, stage, prompt_name, endpoint, result, created_at, last_used_at)
+  VALUES (fresh.cache_key, '{stage}', '{prompt.name}', '{prompt.endpoint}', fresh.result,
+          CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP())
+"""
+
+
+def get_prompt_cache_stats_query(cache_table_id, source_query, prompt, ttl_hours):
+    """
+    Generate SQL counting cache hits and misses over the distinct prompts of a stage.
+
+    Parameters:
+    - cache_table_id: str. Full path of the prompt cache table.
+    - source_query: str. SQL returning the columns referenced by prompt.args.
+    - prompt: PromptSpec. Prompt whose keys are looked up.
+    - ttl_hours: int. Age after which a cached result no longer counts as a hit.
+    """
+    return f"""
+SELECT COUNTIF(cache.cache_key IS NOT NULL) AS hits,
+       COUNTIF(cache.cache_key IS NULL) AS misses
+FROM ({get_prompt_keys_sql(source_query, prompt)}) prompts
+LEFT JOIN (
+  SELECT cache_key
+  FROM `{cache_table_id}`
+  WHERE created_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(ttl_hours)} HOUR)
+) cache
+ON prompts.cache_key = cache.cache_key
+"""
+
+
+def get_prompt_cache_touch_query(cache_table_id, source_query, prompt):
+    """Generate SQL marking the cached results used by a stage as recently used."""
+    return f"""
+UPDATE `{cache_table_id}`
+SET last_used_at = CURRENT_TIMESTAMP()
+WHERE cache_key IN (
+  SELECT cache_key FROM ({get_prompt_keys_sql(source_query, prompt)})
+)
+"""
+
+
+def get_prompt_cache_misses_query(cache_table_id, source_query, prompt, ttl_hours):
+    """
+    Generate SQL listing the distinct prompts of a stage missing from the cache.
+
+    Returns cache_key and the formatted prompt text, for prompts generated
+    client-side instead of through the AI functions.
+
+    Parameters:
+    - cache_table_id: str. Full path of the prompt cache table.
+    - source_query: str. SQL returning the columns referenced by prompt.args.
+    - prompt: PromptSpec. Prompt whose keys are looked up.
+    - ttl_hours: int. Age after which a cached result counts as missing.
+    """
+    return f"""
+SELECT prompts.cache_key, prompts.prompt
+FROM ({get_prompt_keys_sql(source_query, prompt)}) prompts
+WHERE prompts.cache_key NOT IN (
+  SELECT cache_key
+  FROM `{cache_table_id}`
+  WHERE created_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(ttl_hours)} HOUR)
+)
+"""
+
+
+def get_prompt_cache_load_query(cache_table_id, load_table_id, stage, prompt):
+    """
+    Generate a MERGE storing bulk-loaded prompt results in the cache.
+
+    Parameters:
+    - cache_table_id: str. Full path of the prompt cache table.
+    - load_table_id: str. Table holding the loaded cache_key and result columns.
+    - stage: str. Pipeline stage name stored alongside the results.
+    - prompt: PromptSpec. Prompt the results belong to.
+    """
+    return f"""
+MERGE `{cache_table_id}` cache
+USING (
+  SELECT cache_key, ANY_VALUE(result) AS result
+  FROM `{load_table_id}`
+  WHERE result IS NOT NULL
+  GROUP BY cache_key
+) fresh
+ON cache.cache_key = fresh.cache_key
+WHEN MATCHED THEN
+  UPDATE SET result = fresh.result,
+             created_at = CURRENT_TIMESTAMP(),
+             last_used_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN
+  INSERT (cache_key, stage, prompt_name, endpoint, result, created_at, last_used_at)
+  VALUES (fresh.cache_key, '{stage}', '{prompt.name}', '{prompt.endpoint}', fresh.result,
+          CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP())
+"""
+
+
+def get_prompt_cache_evict_query(cache_table_id, ttl_hours, max_entries):
+    """
+    Generate SQL deleting expired entries and the least recently used overflow.
+
+    Parameters:
+    - cache_table_id: str. Full path of the prompt cache table.
+    - ttl_hours: int. Entries created before this many hours ago are removed.
+    - max_entries: int. Maximum number of entries kept, by most recent use.
+    """
+    return f"""
+DELETE FROM `{cache_table_id}`
+WHERE created_at < TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(ttl_hours)} HOUR)
+   OR cache_key IN (
+     SELECT cache_key
+     FROM (
+       SELECT cache_key,
+              ROW_NUMBER() OVER (ORDER BY last_used_at DESC) AS recency_rank
+       FROM `{cache_table_id}`
+     )
+     WHERE recency_rank > {int(max_entries)}
+   )
+"""
+
+
+def get_fingerprint_merge_query(target_table_id, changed_query, key_column, columns):
+    """
+    Generate a MERGE upserting rows whose input fingerprint changed.
+
+    Parameters:
+    - target_table_id: str. Full path of the materialized mart.
+    - changed_query: str. SQL returning only new or changed rows, with the mart
+      columns plus input_fingerprint.
+    - key_column: str. Column identifying a row of the mart.
+    - columns: list[str]. Mart columns written from the source.
+    """
+    all_columns = columns + ["input_fingerprint"]
+    updates = ",\n             ".join(f"{column} = source.{column}"
+                                      for column in all_columns if column != key_column)
+    inserted = ", ".join(all_columns + ["refreshed_at"])
+    values = ", ".join([f"source.{column}" for column in all_columns] + ["CURRENT_TIMESTAMP()"])
+    return f"""
+MERGE `{target_table_id}` target
+USING (
+{changed_query}
+) source
+ON target.{key_column} = source.{key_column}
+WHEN MATCHED THEN
+  UPDATE SET {updates},
+             refreshed_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN
+  INSERT ({inserted})
+  VALUES ({values})"""
+
+
+def get_refreshed_rows_count_query(target_table_id, refreshed_since, condition="TRUE"):
+    """
+    Generate SQL counting the rows of a mart written by a refresh.
+
+    Parameters:
+    - target_table_id: str. Full path of the materialized mart.
+    - refreshed_since: datetime.datetime. Start time of the refresh script.
+    - condition: str. SQL predicate restricting the count, e.g. to rows the model produced.
+    """
+    return f"""
+SELECT COUNT(*) AS refreshed_rows
+FROM `{target_table_id}`
+WHERE refreshed_at >= TIMESTAMP('{refreshed_since.isoformat()}')
+  AND ({condition})
+"""
+
+
+def get_materialized_drivers_metrics_query(project_id, dataset_id, connection_id, target_table_id,
+                                           watermark_table_id=None, daily_table_id=None,
+                                           rides_table_id=None, prompt_cache_table_id=None,
+                                           prescores_table_id=None):
+    """
+    Generate a script refreshing the drivers_metrics table for changed drivers only.
+
+    A driver's input fingerprint combines its attributes, an order-independent
+    hash of its rides (kept per day in the daily aggregate table) and the prompt
+    templates, so the AI functions only run for drivers that are new or whose
+    inputs changed since the last refresh. Raw rides are never read. The
+    prompt templates hash is also stored per driver (prompts_hash), so a pruned
+    refresh can find the drivers published with older templates.
+
+    Parameters:
+    - project_id: str. Google Cloud project identifier.
+    - dataset_id: str. BigQuery dataset containing driver and ride tables.
+    - connection_id: str. Vertex AI connection used for AI.GENERATE functions.
+    - target_table_id: str. Full path of the materialized drivers_metrics table.
+    - watermark_table_id: str or None. Load watermark table of an incrementally
+      loaded rides_data. When set, only drivers with days in partitions loaded
+      since the last refresh, new drivers, drivers published with other prompt
+      templates or another triage decision, and (if drivers_data changed) every
+      driver are re-aggregated, instead of scanning the whole daily table.
+    - daily_table_id: str or None. Driver x day aggregate table, by default
+      driver_daily_rides in dataset_id.
+    - rides_table_id: str or None. Rides table the watermark tracks, by default
+      rides_data in dataset_id.
+    - prompt_cache_table_id: str or None. When set, stress_score and stress_reason
+      are read from this prompt cache table (filled beforehand, e.g. client-side)
+      instead of calling the model; drivers whose results are not cached are
+      left for the next refresh.
+    - prescores_table_id: str or None. Local triage table (driver_ID, prescore,
+      send_to_llm). Changed drivers with send_to_llm FALSE take the local
+      prescore and a templated reason instead of calling the model.
+    """
+    prompts_hash = DRIVER_STRESS_SCORE_PROMPT.template_hash + DRIVER_STRESS_REASON_PROMPT.template_hash
+    daily_table_id = daily_table_id or f"{project_id}.{dataset_id}.driver_daily_rides"
+    rides_table_id = rides_table_id or f"{project_id}.{dataset_id}.rides_data"
+    driver_ids_sql = None
+    daily_source = f"`{daily_table_id}`"
+    declarations = ""
+    if watermark_table_id is not None:
+        driver_ids_sql = "candidate_driver_ids"
+        daily_source = f"(SELECT * FROM `{daily_table_id}` WHERE Driver_ID IN UNNEST({driver_ids_sql}))"
+        declarations = get_candidate_drivers_declarations(project_id, dataset_id, target_table_id,
+                                                          watermark_table_id, daily_table_id,
+                                                          rides_table_id, prompts_hash=prompts_hash,
+                                                          prescores_table_id=prescores_table_id)
+    prescore_columns = ""
+    prescore_join = ""
+    prescore_fingerprint = ""
+    if prescores_table_id is not None:
+        prescore_columns = ",\n         prescores.prescore,\n         IFNULL(prescores.send_to_llm, TRUE) AS send_to_llm"
+        prescore_join = (f"\n  LEFT JOIN `{prescores_table_id}` prescores"
+                         f"\n  ON drivers.Driver_ID = prescores.driver_ID")
+        # Drivers sent to the LLM keep the fingerprint they had without triage
+        prescore_fingerprint = ", IF(prescores.send_to_llm IS FALSE, '|prescored', '')"
+    changed_query = f"""
+{get_drivers_summary_ctes(project_id, dataset_id, driver_ids_sql=driver_ids_sql,
+                          daily_table_id=daily_table_id)},
+
+rides_fingerprints AS (
+  SELECT Driver_ID,
+         SUM(total_rides) AS ride_rows,
+         BIT_XOR(rides_fingerprint) AS rides_fingerprint
+  FROM {daily_source} daily
+  GROUP BY Driver_ID
+),
+
+fingerprints AS (
+  SELECT drivers.Driver_ID AS driver_ID,
+         FARM_FINGERPRINT(CONCAT(
+           TO_JSON_STRING(drivers), '|',
+           CAST(IFNULL(rides_fingerprints.ride_rows, 0) AS STRING), '|',
+           CAST(IFNULL(rides_fingerprints.rides_fingerprint, 0) AS STRING), '|',
+           '{prompts_hash}'{prescore_fingerprint}
+         )) AS input_fingerprint{prescore_columns}
+  FROM `{project_id}.{dataset_id}.drivers_data` drivers
+  LEFT JOIN rides_fingerprints
+  ON drivers.Driver_ID = rides_fingerprints.Driver_ID{prescore_join}
+),
+
+changed_drivers AS (
+  SELECT drivers_metrics.*, fingerprints.* EXCEPT (driver_ID)
+  FROM drivers_metrics
+  JOIN fingerprints
+  ON drivers_metrics.driver_ID = fingerprints.driver_ID
+  LEFT JOIN `{target_table_id}` target
+  ON drivers_metrics.driver_ID = target.driver_ID
+  WHERE target.driver_ID IS NULL
+     OR target.input_fingerprint != fingerprints.input_fingerprint
+)
+
+SELECT *, '{prompts_hash}' AS prompts_hash
+FROM (
+{get_changed_drivers_results_sql(project_id, connection_id, prompt_cache_table_id,
+                                 prescored=prescores_table_id is not None)}
+)"""
+
+    merge = get_fingerprint_merge_query(target_table_id, changed_query, "driver_ID",
+                                        ["driver_ID", "City", "Age", "stress_score", "stress_reason",
+                                         "stress_score_source", "prompts_hash"])
+    script = f"""{declarations}{merge};
+
+DELETE FROM `{target_table_id}`
+WHERE driver_ID NOT IN (SELECT Driver_ID FROM `{project_id}.{dataset_id}.drivers_data`);
+"""
+    if watermark_table_id is not None:
+        script += f"""
+UPDATE `{watermark_table_id}`
+SET dirty_since = NULL
+WHERE table_id = '{rides_table_id}' AND loaded_at <= refresh_started_at;
+"""
+    return script
+
+
+def get_changed_drivers_results_sql(project_id, connection_id, prompt_cache_table_id=None,
+                                    prescored=False):
+    """
+    Render the final SELECT of the drivers_metrics refresh over the changed_drivers CTE.
+
+    With prescored, only rows with send_to_llm go to the model (or the prompt
+    cache); the others publish their local prescore and a templated reason.
+    """
+    prompts = [DRIVER_STRESS_SCORE_PROMPT, DRIVER_STRESS_REASON_PROMPT]
+    source = "(SELECT * FROM changed_drivers WHERE send_to_llm)" if prescored else "changed_drivers"
+    if prompt_cache_table_id:
+        llm_results = get_cached_prompts_sql(prompt_cache_table_id, source, prompts,
+                                             ["driver_ID", "City", "Age", "input_fingerprint"],
+                                             require_cached=True)
+    else:
+        llm_results = f"""SELECT driver_ID,
+       City,
+       Age,
+       {get_ai_function_sql(DRIVER_STRESS_SCORE_PROMPT, project_id, connection_id)} AS stress_score,
+       {get_ai_function_sql(DRIVER_STRESS_REASON_PROMPT, project_id, connection_id)} AS stress_reason,
+       input_fingerprint
+FROM {source}"""
+    results = f"""SELECT driver_ID, City, Age, stress_score, stress_reason, input_fingerprint,
+       'llm' AS stress_score_source
+FROM (
+{llm_results}
+)"""
+    if prescored:
+        results += f"""
+
+UNION ALL
+
+SELECT driver_ID,
+       City,
+       Age,
+       prescore AS stress_score,
+       {get_format_sql(PRESCORED_STRESS_REASON_TEMPLATE, PRESCORED_STRESS_REASON_ARGS)} AS stress_reason,
+       input_fingerprint,
+       'prescore' AS stress_score_source
+FROM changed_drivers
+WHERE NOT send_to_llm"""
+    return results
+
+
+def get_materialized_driver_reason_tags_query(project_id, connection_id, source_table_id, target_table_id,
+                                              prompt_cache_table_id=None, prescored=False):
+    """
+    Generate a script refreshing drivers_reason_tags for drivers whose stress_reason changed.
+
+    Parameters:
+    - project_id: str. Google Cloud project identifier.
+    - connection_id: str. Vertex AI connection used for AI.GENERATE functions.
+    - source_table_id: str. Full path of the materialized drivers_metrics table.
+    - target_table_id: str. Full path of the materialized drivers_reason_tags table.
+    - prompt_cache_table_id: str or None. When set, tags are read from this prompt
+      cache table instead of calling the model; drivers whose tags are not cached
+      are left for the next refresh.
+    - prescored: bool. Drivers whose stress score came from the local prescorer
+      get PRESCORED_STRESS_TAGS instead of calling the model.
+    """
+    changed_source = f"""(
+  SELECT fingerprints.*
+  FROM fingerprints
+  LEFT JOIN `{target_table_id}` target
+  ON fingerprints.driver_ID = target.driver_ID
+  WHERE target.driver_ID IS NULL
+     OR target.input_fingerprint != fingerprints.input_fingerprint
+)"""
+    if prescored:
+        changed_source = f"(SELECT * FROM {changed_source} WHERE stress_score_source = 'llm')"
+    if prompt_cache_table_id:
+        results = get_cached_prompts_sql(prompt_cache_table_id, changed_source,
+                                         [DRIVER_REASON_TAGS_PROMPT],
+                                         ["driver_ID", "input_fingerprint"], require_cached=True)
+    else:
+        results = f"""SELECT driver_ID,
+       {get_ai_function_sql(DRIVER_REASON_TAGS_PROMPT, project_id, connection_id)} AS stress_report_tags,
+       input_fingerprint
+FROM {changed_source}"""
+    if prescored:
+        results = f"""SELECT driver_ID, stress_report_tags, input_fingerprint
+FROM (
+{results}
+)
+
+UNION ALL
+
+SELECT fingerprints.driver_ID,
+       '{PRESCORED_STRESS_TAGS}' AS stress_report_tags,
+       fingerprints.input_fingerprint
+FROM fingerprints
+LEFT JOIN `{target_table_id}` target
+ON fingerprints.driver_ID = target.driver_ID
+WHERE fingerprints.stress_score_source = 'prescore'
+  AND (target.driver_ID IS NULL OR target.input_fingerprint != fingerprints.input_fingerprint)"""
+    changed_query = f"""
+WITH fingerprints AS (
+  SELECT driver_ID,
+         stress_reason,
+         {"IFNULL(stress_score_source, 'llm') AS stress_score_source," if prescored else ""}
+         FARM_FINGERPRINT(CONCAT(IFNULL(stress_reason, ''), '|',
+                                 '{DRIVER_REASON_TAGS_PROMPT.template_hash}')) AS input_fingerprint
+  FROM `{source_table_id}`
+)
+
+{results}"""
+
+    merge = get_fingerprint_merge_query(target_table_id, changed_query, "driver_ID",
+                                        ["driver_ID", "stress_report_tags"])
+    return f"""{merge};
+
+DELETE FROM `{target_table_id}`
+WHERE driver_ID NOT IN (SELECT driver_ID FROM `{source_table_id}`);
+"""
+
+
+def get_candidate_drivers_declarations(project_id, dataset_id, target_table_id, watermark_table_id,
+                                       daily_table_id, rides_table_id, prompts_hash=None,
+                                       prescores_table_id=None):
+    """
+    Declare the script variables selecting the drivers a pruned refresh re-aggregates.
+
+    candidate_driver_ids holds drivers with days in partitions changed since the
+    last refresh (dirty_since of the rides watermark), drivers missing from the
+    target, drivers published with other prompt templates than prompts_hash,
+    drivers whose triage decision in prescores_table_id differs from the source
+    of their published score and, when drivers_data was modified after the
+    last refresh, every driver. Filtering on script variables lets BigQuery
+    prune partitions and clusters of the daily aggregate table.
+    """
+    drivers_table = f"`{project_id}.{dataset_id}.drivers_data`"
+    other_candidates = ""
+    if prompts_hash is not None:
+        other_candidates += f"""
+    UNION ALL
+    SELECT driver_ID FROM `{target_table_id}`
+    WHERE prompts_hash IS DISTINCT FROM '{prompts_hash}'"""
+    if prescores_table_id is not None:
+        other_candidates += f"""
+    UNION ALL
+    SELECT target.driver_ID
+    FROM `{target_table_id}` target
+    LEFT JOIN `{prescores_table_id}` prescores
+    ON target.driver_ID = prescores.driver_ID
+    WHERE IFNULL(prescores.send_to_llm, TRUE) != (IFNULL(target.stress_score_source, 'llm') = 'llm')"""
+    return f"""DECLARE refresh_started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP();
+DECLARE dirty_since DATE DEFAULT (
+  SELECT dirty_since FROM `{watermark_table_id}` WHERE table_id = '{rides_table_id}'
+);
+DECLARE drivers_changed BOOL DEFAULT IFNULL((
+  SELECT MAX(last_modified_time)
+  FROM `{project_id}.{dataset_id}.INFORMATION_SCHEMA.PARTITIONS`
+  WHERE table_name = 'drivers_data'
+) > (SELECT MAX(refreshed_at) FROM `{target_table_id}`), TRUE);
+DECLARE candidate_driver_ids ARRAY<INT64> DEFAULT (
+  SELECT ARRAY_AGG(DISTINCT Driver_ID IGNORE NULLS)
+  FROM (
+    SELECT Driver_ID FROM {drivers_table} WHERE drivers_changed
+    UNION ALL
+    SELECT Driver_ID FROM `{daily_table_id}` WHERE Date >= dirty_since
+    UNION ALL
+    SELECT Driver_ID FROM {drivers_table}
+    WHERE Driver_ID NOT IN (SELECT driver_ID FROM `{target_table_id}`){other_candidates}
+  )
+);
+
+"""
+
+
+def get_rides_watermark_query(watermark_table_id, rides_table_id):
+    """Generate SQL reading the high-water mark of an incrementally loaded rides table."""
+    return f"""
+SELECT max_ride_id, max_date
+FROM `{watermark_table_id}`
+WHERE table_id = '{rides_table_id}'
+"""
+
+
+def get_rides_stored_dates_query(rides_table_id, delta_table_id):
+    """Generate SQL reading the date range of the stored rides a delta will overwrite."""
+    return f"""
+SELECT MIN(target.Date) AS min_date, MAX(target.Date) AS max_date
+FROM `{rides_table_id}` target
+JOIN (SELECT DISTINCT Ride_ID FROM `{delta_table_id}`) source
+USING (Ride_ID)
+"""
+
+
+def get_rides_incremental_merge_query(rides_table_id, delta_table_id, watermark_table_id,
+                                      min_date, max_date, columns, daily_table_id=None):
+    """
+    Generate a transaction merging a delta of rides and advancing the watermark.
+
+    Rides are keyed by Ride_ID, so replaying a delta is a no-op and a corrected
+    ride (even one moved to another day) overwrites the stored one. The ON
+    clause restricts the target to the date range, plus rides without a date,
+    so only those partitions are read; the range must cover both the delta's
+    dates and the stored dates of its rides (get_rides_stored_dates_query).
+
+    Parameters:
+    - rides_table_id: str. Full path of the partitioned rides table.
+    - delta_table_id: str. Full path of the table holding the new rides.
+    - watermark_table_id: str. Full path of the load watermark table.
+    - min_date, max_date: datetime.date or None. Date range of the rides
+      touched by the delta; every partition is read when None (a delta
+      without dates).
+    - columns: list[str]. Rides columns.
+    - daily_table_id: str or None. When set, the days of this driver x day
+      aggregate table within the date range are recomputed in the same
+      transaction.
+    """
+    daily_refresh = ""
+    if daily_table_id is not None:
+        daily_refresh = get_driver_daily_rides_refresh_query(rides_table_id, daily_table_id,
+                                                             min_date, max_date) + ";\n"
+    date_filter = ""
+    dirty_since = "MIN(Date)"
+    if min_date is not None and max_date is not None:
+        date_filter = (f"\n   AND (target.Date BETWEEN DATE '{min_date.isoformat()}'"
+                       f" AND DATE '{max_date.isoformat()}' OR target.Date IS NULL)")
+        dirty_since = f"DATE '{min_date.isoformat()}'"
+    updates = ",\n             ".join(f"{column} = source.{column}" for column in columns
+                                      if column != "Ride_ID")
+    target_row = ", ".join(f"target.{column}" for column in columns)
+    source_row = ", ".join(f"source.{column}" for column in columns)
+    inserted = ", ".join(columns)
+    return f"""
+BEGIN TRANSACTION;
+
+MERGE `{rides_table_id}` target
+USING `{delta_table_id}` source
+ON target.Ride_ID = source.Ride_ID{date_filter}
+WHEN MATCHED AND FARM_FINGERPRINT(TO_JSON_STRING(STRUCT({target_row})))
+              != FARM_FINGERPRINT(TO_JSON_STRING(STRUCT({source_row}))) THEN
+  UPDATE SET {updates}
+WHEN NOT MATCHED THEN
+  INSERT ({inserted})
+  VALUES ({source_row});
+{daily_refresh}
+MERGE `{watermark_table_id}` watermark
+USING (
+  SELECT '{rides_table_id}' AS table_id,
+         MAX(Ride_ID) AS max_ride_id,
+         MAX(Date) AS max_date,
+         {dirty_since} AS min_date
+  FROM `{delta_table_id}`
+) delta
+ON watermark.table_id = delta.table_id
+WHEN MATCHED THEN
+  UPDATE SET max_ride_id = GREATEST(IFNULL(watermark.max_ride_id, delta.max_ride_id), delta.max_ride_id),
+             max_date = GREATEST(IFNULL(watermark.max_date, delta.max_date), delta.max_date),
+             dirty_since = LEAST(IFNULL(watermark.dirty_since, delta.min_date), delta.min_date),
+             loaded_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN
+  INSERT (table_id, max_ride_id, max_date, dirty_since, loaded_at)
+  VALUES (delta.table_id, delta.max_ride_id, delta.max_date, delta.min_date, CURRENT_TIMESTAMP());
+
+COMMIT TRANSACTION;
+"""
+
+
+DRIVER_DAILY_RIDES_COLUMNS = ["Driver_ID", "Date", "total_rides", "fare_sum", "fare_sum_sq",
+                              "fare_count", "duration_sum", "duration_count", "rides_fingerprint"]
+
+
+def get_driver_daily_rides_refresh_query(rides_table_id, daily_table_id, min_date=None, max_date=None):
+    """
+    Generate a MERGE recomputing the driver x day aggregates of a date range from raw rides.
+
+    Each row holds counts, sums and sums of squares, so any set of days can be
+    merged into means and standard deviations without going back to the rides,
+    plus an order-independent hash of the day's rides. Only the partitions of
+    the range are read and written; days whose rides disappeared are deleted.
+
+    Parameters:
+    - rides_table_id: str. Full path of the rides table.
+    - daily_table_id: str. Full path of the aggregate table, partitioned by Date.
+    - min_date, max_date: datetime.date or None. Range of days to recompute;
+      every day (a full rebuild) when omitted.
+    """
+    date_filter = "TRUE"
+    if min_date is not None and max_date is not None:
+        date_filter = (f"(Date BETWEEN DATE '{min_date.isoformat()}' AND DATE '{max_date.isoformat()}'"
+                       f" OR Date IS NULL)")
+    target_filter = date_filter.replace("Date", "target.Date")
+    updates = ",\n             ".join(f"{column} = source.{column}"
+                                      for column in DRIVER_DAILY_RIDES_COLUMNS[2:])
+    inserted = ", ".join(DRIVER_DAILY_RIDES_COLUMNS + ["updated_at"])
+    values = ", ".join([f"source.{column}" for column in DRIVER_DAILY_RIDES_COLUMNS]
+                       + ["CURRENT_TIMESTAMP()"])
+    return f"""
+MERGE `{daily_table_id}` target
+USING (
+  SELECT Driver_ID,
+         Date,
+         COUNT(Ride_ID) AS total_rides,
+         SUM(Fare) AS fare_sum,
+         SUM(Fare * Fare) AS fare_sum_sq,
+         COUNT(Fare) AS fare_count,
+         SUM(Duration_min) AS duration_sum,
+         COUNT(Duration_min) AS duration_count,
+         BIT_XOR(FARM_FINGERPRINT(TO_JSON_STRING(rides))) AS rides_fingerprint
+  FROM `{rides_table_id}` rides
+  WHERE Driver_ID IS NOT NULL AND {date_filter}
+  GROUP BY Driver_ID, Date
+) source
+ON target.Driver_ID = source.Driver_ID
+   AND target.Date IS NOT DISTINCT FROM source.Date
+   AND {target_filter}
+WHEN MATCHED AND (target.rides_fingerprint != source.rides_fingerprint
+                  OR target.total_rides != source.total_rides) THEN
+  UPDATE SET {updates},
+             updated_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED BY TARGET THEN
+  INSERT ({inserted})
+  VALUES ({values})
+WHEN NOT MATCHED BY SOURCE AND {target_filter} THEN
+  DELETE"""
+
+
+# Rolling windows of the driver window metrics: column suffix -> days (None for lifetime)
+DRIVER_METRICS_WINDOWS = {"lifetime": None, "7d": 7, "30d": 30}
+
+
+def get_driver_window_metrics_query(daily_table_id, windows=None, as_of_sql="CURRENT_DATE()"):
+    """
+    Generate SQL deriving lifetime and rolling-window metrics per driver from the daily aggregates.
+
+    Every window is computed in a single pass over the driver x day table by
+    conditional aggregation. Per-ride fare deviations are merged from the daily
+    sums of squares; daily-fare deviations are taken over the day totals.
+
+    Parameters:
+    - daily_table_id: str. Full path of the driver x day aggregate table.
+    - windows: dict or None. Column suffix -> window length in days (None for
+      lifetime); DRIVER_METRICS_WINDOWS by default.
+    - as_of_sql: str. SQL DATE expression the windows end on (inclusive).
+    """
+    windows = windows or DRIVER_METRICS_WINDOWS
+    flags, sums, metrics = [], [], []
+    for suffix, days in windows.items():
+        in_window = f"in_{suffix}"
+        if days is None:
+            flags.append(f"TRUE AS {in_window}")
+        else:
+            flags.append(f"Date BETWEEN DATE_SUB({as_of_sql}, INTERVAL {int(days) - 1} DAY) "
+                         f"AND {as_of_sql} AS {in_window}")
+        sums.append(f"""SUM(IF({in_window}, total_rides, 0)) AS rides_{suffix},
+         COUNT(DISTINCT IF({in_window}, Date, NULL)) AS active_days_{suffix},
+         SUM(IF({in_window}, fare_sum, NULL)) AS fare_sum_{suffix},
+         SUM(IF({in_window}, fare_sum_sq, NULL)) AS fare_sum_sq_{suffix},
+         SUM(IF({in_window}, fare_count, 0)) AS fare_count_{suffix},
+         STDDEV(IF({in_window} AND fare_count > 0, ROUND(fare_sum, 2), NULL)) AS stddev_daily_fare_{suffix},
+         SUM(IF({in_window}, duration_sum, NULL)) AS total_duration_min_{suffix}""")
+        metrics.append(f"""rides_{suffix},
+       active_days_{suffix},
+       ROUND(fare_sum_{suffix}, 2) AS total_fare_{suffix},
+       SAFE_DIVIDE(fare_sum_{suffix}, fare_count_{suffix}) AS avg_ride_fare_{suffix},
+       SQRT(GREATEST(SAFE_DIVIDE(
+         fare_sum_sq_{suffix} - fare_sum_{suffix} * fare_sum_{suffix} / NULLIF(fare_count_{suffix}, 0),
+         fare_count_{suffix} - 1), 0)) AS stddev_ride_fare_{suffix},
+       stddev_daily_fare_{suffix},
+       total_duration_min_{suffix}""")
+    flags = ",\n         ".join(flags)
+    sums = ",\n         ".join(sums)
+    metrics = ",\n       ".join(metrics)
+    return f"""
+WITH daily AS (
+  SELECT *,
+         {flags}
+  FROM `{daily_table_id}`
+),
+
+window_sums AS (
+  SELECT Driver_ID,
+         {sums}
+  FROM daily
+  GROUP BY Driver_ID
+)
+
+SELECT Driver_ID AS driver_ID,
+       {metrics}
+FROM window_sums
 """
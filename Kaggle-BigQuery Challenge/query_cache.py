@@ -0,0 +1,266 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import pyarrow as pa
+import pyarrow.ipc
+
+from instrumentation import instrumentation
+
+# Strings and quoted identifiers are kept verbatim, comments dropped, whitespace collapsed
+_SQL_TOKENS = re.compile(r"""
+    (?P<string>'''.*?'''|\"\"\".*?\"\"\"|'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*"|`[^`]*`)
+  | (?P<gap>(?:\s+|--[^\n]*|\#[^\n]*|/\*.*?\*/)+)
+""", re.S | re.X)
+
+_QUOTED_TABLE = re.compile(r"`([\w-]+\.[\w-]+\.[\w$-]+)`")
+_BARE_TABLE = re.compile(r"\b(?:FROM|JOIN)\s+([a-zA-Z][\w-]*\.\w+\.\w+)\b", re.I)
+# Any name read by FROM/JOIN, and the names defined by WITH
+_TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+(`[^`]*`|[a-zA-Z_][\w.-]*)", re.I)
+_CTE_NAME = re.compile(r"\b(\w+)\s+AS\s*\(", re.I)
+# FROM that is not a table clause: EXTRACT(part FROM x), IS [NOT] DISTINCT FROM
+_NOT_A_TABLE = re.compile(r"\bEXTRACT\s*\(\s*\w+\s+FROM\b|\bDISTINCT\s+FROM\b", re.I)
+
+# Results of these depend on when or how the query runs, not only on its tables
+_NONDETERMINISTIC = re.compile(
+    r"\b(?:CURRENT_(?:DATE|DATETIME|TIME|TIMESTAMP)|NOW|RAND|GENERATE_UUID|SESSION_USER"
+    r"|AI\.\w+|ML\.\w+)\s*\(", re.I)
+
+
+def normalize_sql(sql):
+    """Return sql without comments, with whitespace collapsed outside literals and no trailing ';'."""
+    def replace(match):
+        if match.group("string") is not None:
+            return match.group("string")
+        return " "
+    return _SQL_TOKENS.sub(replace, sql).strip().rstrip(";").strip()
+
+
+def referenced_tables(sql):
+    """Return the sorted project.dataset.table ids a query reads."""
+    sql = normalize_sql(sql)
+    return sorted(set(_QUOTED_TABLE.findall(sql)) | set(_BARE_TABLE.findall(sql)))
+
+
+def unresolved_tables(sql):
+    """
+    Return the names a query reads that are not project.dataset.table ids.
+
+    Such names (dataset.table, or a table of the default dataset) depend on
+    the job's defaults, so their freshness cannot be looked up. Names defined
+    by WITH and UNNEST are not tables and are skipped.
+    """
+    sql = _NOT_A_TABLE.sub(" ", normalize_sql(sql))
+    defined = {name.lower() for name in _CTE_NAME.findall(sql)} | {"unnest"}
+    unresolved = set()
+    for name in _TABLE_REFERENCE.findall(sql):
+        if name.startswith("`"):
+            if not _QUOTED_TABLE.fullmatch(name):
+                unresolved.add(name)
+        elif name.lower() not in defined and not _BARE_TABLE.match(f"FROM {name}"):
+            unresolved.add(name)
+    return sorted(unresolved)
+
+
+def is_cacheable(sql):
+    """Return whether a query's result only depends on the fully qualified tables it reads."""
+    return (bool(referenced_tables(sql)) and not unresolved_tables(sql)
+            and not _NONDETERMINISTIC.search(normalize_sql(sql)))
+
+
+def _depends_on(version, table_id):
+    """Return whether a table version (a view's, recursively) was derived from table_id."""
+    if not isinstance(version, dict):
+        return False
+    return any(source == table_id or _depends_on(source_version, table_id)
+               for source, source_version in version["sources"].items())
+
+
+class QueryResultCache:
+    """
+    Local disk cache of query results, keyed by SQL and the freshness of its tables.
+
+    The key hashes the normalized SQL with the last-modified time and row count
+    of every table the query reads (through views, recursively), so a change to
+    any of them misses the cache and replaces the stale entry. Results are
+    stored as uncompressed Arrow IPC files and memory-mapped on a hit, without
+    any query job. Entries are evicted least recently used first once they
+    exceed max_bytes. Queries reading no table, tables without a full
+    project.dataset.table id (or views over them) or using nondeterministic
+    functions (CURRENT_DATE(), RAND(), AI.*) always run remotely.
+
+    Table versions are looked up again after metadata_ttl, or as soon as the
+    table is written through the client when it is an InstrumentedClient;
+    writes by other clients are only seen once the TTL expires.
+
+    Parameters:
+    - client: bigquery.Client. Client running misses and table lookups.
+    - cache_dir: str. Directory holding index.json and the result files.
+    - max_bytes: int. Total size of result files kept.
+    - metadata_ttl: float. Seconds a table's freshness is trusted before it is
+      looked up again; within it, hits make no API call at all.
+    """
+
+    def __init__(self, client, cache_dir, max_bytes=2 * 1024 ** 3, metadata_ttl=30.0):
+        self.client = client
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.metadata_ttl = metadata_ttl
+        self._lock = threading.Lock()
+        self._table_versions = {}
+        self._generation = 0
+        self.index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                self.index = json.load(f)
+            # Drop entries whose file is gone, e.g. after a manual cleanup
+            self.index = {key: entry for key, entry in self.index.items()
+                          if os.path.exists(self._result_path(key))}
+        if hasattr(client, "add_write_listener"):
+            client.add_write_listener(self.invalidate)
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.cache_dir, "index.json")
+
+    def _result_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.arrow")
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self._index_path)
+
+    @property
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self.index.values())
+
+    def invalidate(self, table_id=None):
+        """Forget the cached version of a table and the views over it; of every table when None."""
+        with self._lock:
+            self._generation += 1
+            if table_id is None:
+                self._table_versions = {}
+                return
+            self._table_versions = {
+                cached_id: cached for cached_id, cached in self._table_versions.items()
+                if cached_id != table_id and not _depends_on(cached[1], table_id)}
+
+    def _table_version(self, table_id, depth=0):
+        cached = self._table_versions.get(table_id)
+        if cached and time.monotonic() - cached[0] < self.metadata_ttl:
+            return cached[1]
+        generation = self._generation
+        table = self.client.get_table(table_id)
+        if table.table_type == "VIEW":
+            # A view's own metadata does not change with its data; use its sources'
+            if depth >= 8:
+                raise ValueError(f"Views nested too deeply under {table_id}")
+            unresolved = unresolved_tables(table.view_query)
+            if unresolved:
+                raise ValueError(f"View {table_id} reads tables without a full id: {unresolved}")
+            version = {"view_query": hashlib.sha256(table.view_query.encode("utf-8")).hexdigest(),
+                       "sources": {source: self._table_version(source, depth + 1)
+                                   for source in referenced_tables(table.view_query)}}
+        else:
+            version = f"{table.modified.isoformat()}/{table.num_rows}"
+        with self._lock:
+            # A write finished during the lookup: do not trust what it returned beyond this query
+            if generation == self._generation:
+                self._table_versions[table_id] = (time.monotonic(), version)
+        return version
+
+    def cache_key(self, sql):
+        """Return (key, sql_key) of a query: with and without its tables' current versions."""
+        normalized = normalize_sql(sql)
+        sql_key = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        versions = {table_id: self._table_version(table_id)
+                    for table_id in referenced_tables(normalized)}
+        payload = json.dumps({"sql": normalized, "tables": versions}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest(), sql_key
+
+    def _read(self, key):
+        with pa.memory_map(self._result_path(key)) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def _write(self, key, sql_key, sql, table):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._result_path(key)
+        tmp_path = f"{path}.tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+        with self._lock:
+            # Entries of the same SQL over older table versions can never hit again
+            for stale_key in [k for k, entry in self.index.items()
+                              if entry["sql_key"] == sql_key and k != key]:
+                self._remove(stale_key)
+            self.index[key] = {"sql_key": sql_key, "bytes": os.path.getsize(path),
+                               "last_used": time.time(), "rows": table.num_rows,
+                               "sql": normalize_sql(sql)[:200]}
+            self._evict()
+            self._save_index()
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        try:
+            os.remove(self._result_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        total = self.total_bytes
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= entry["bytes"]
+            self._remove(key)
+
+    def query_arrow(self, sql, bqstorage_client=None):
+        """
+        Return the result of sql as a pyarrow.Table, from the cache when it is fresh.
+
+        Parameters:
+        - sql: str. Query to run.
+        - bqstorage_client: BigQueryReadClient or None. Used to download misses.
+        """
+        start = time.perf_counter()
+        if not is_cacheable(sql):
+            return self.client.query(sql).result().to_arrow(bqstorage_client=bqstorage_client)
+
+        try:
+            key, sql_key = self.cache_key(sql)
+        except Exception as e:
+            print(f"Query cache bypassed, table lookup failed: {e}")
+            return self.client.query(sql).result().to_arrow(bqstorage_client=bqstorage_client)
+
+        if key in self.index:
+            table = self._read(key)
+            with self._lock:
+                if key in self.index:
+                    self.index[key]["last_used"] = time.time()
+                    self._save_index()
+            instrumentation.record_call("query_cache.hit", time.perf_counter() - start)
+            return table
+
+        table = self.client.query(sql).result().to_arrow(bqstorage_client=bqstorage_client)
+        self._write(key, sql_key, sql, table)
+        instrumentation.record_call("query_cache.miss", time.perf_counter() - start)
+        return table
+
+    def query_dataframe(self, sql, bqstorage_client=None):
+        """Return the result of sql as a pandas DataFrame, from the cache when it is fresh."""
+        return self.query_arrow(sql, bqstorage_client=bqstorage_client).to_pandas()
+
+    def clear(self):
+        """Remove every cached result."""
+        with self._lock:
+            for key in list(self.index):
+                self._remove(key)
+            self._save_index()
@@ -0,0 +1,242 @@
+import time
+
+import numpy as np
+
+
+def normalize(vectors):
+    """Return float32 copies of the rows scaled to unit length (zero rows stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores, k):
+    """Return (indices, scores) of the k largest entries of each row, best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(np.float32)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+def kmeans(vectors, n_clusters, n_iter=20, seed=42, batch_size=65536):
+    """
+    Spherical k-means over unit vectors, returning (centroids, labels).
+
+    Parameters:
+    - vectors: np.ndarray. (n, dim) matrix, normalized by the caller.
+    - n_clusters: int. Number of clusters.
+    - n_iter: int. Lloyd iterations.
+    - seed: int. Seed of the random initial centroids.
+    - batch_size: int. Rows scored against the centroids at a time.
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    labels = np.zeros(len(vectors), dtype=np.int64)
+
+    for _ in range(n_iter):
+        for start in range(0, len(vectors), batch_size):
+            batch = vectors[start:start + batch_size]
+            labels[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+        counts = np.bincount(labels, minlength=n_clusters)
+        order = np.argsort(labels, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        empty = counts == 0
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(vectors[order], starts[~empty], axis=0)
+        # Re-seed empty clusters on random points so every list stays usable
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids, labels
+
+
+class ExactIndex:
+    """
+    Brute-force cosine similarity index; the reference for approximate indexes.
+
+    Queries are scored against every stored vector with batched matrix products.
+    """
+
+    kind = "exact"
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, vectors):
+        """Append vectors (normalized here) with their integer ids."""
+        vectors = normalize(vectors)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.vectors = vectors if self.vectors is None else np.vstack([self.vectors, vectors])
+
+    def bulk_query(self, queries, k=10, batch_size=1024):
+        """Return (ids, scores) arrays of shape (len(queries), k) for many queries."""
+        queries = normalize(queries)
+        all_ids, all_scores = [], []
+        for start in range(0, len(queries), batch_size):
+            rows, scores = _top_k(queries[start:start + batch_size] @ self.vectors.T, k)
+            all_ids.append(self.ids[rows])
+            all_scores.append(scores)
+        return np.vstack(all_ids), np.vstack(all_scores)
+
+    def query(self, vector, k=10):
+        """Return (ids, scores) of the k most similar stored vectors."""
+        ids, scores = self.bulk_query(np.asarray(vector)[None, :], k)
+        return ids[0], scores[0]
+
+    def _state(self):
+        return {"ids": self.ids, "vectors": self.vectors}
+
+    def _set_state(self, state):
+        self.ids = state["ids"]
+        self.vectors = state["vectors"]
+
+    def save(self, path):
+        """Write the index to a single .npz file."""
+        np.savez(path, kind=self.kind, **self._state())
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted-file approximate index over k-means cells.
+
+    Vectors are assigned to the nearest of n_lists centroids; a query only scores
+    the vectors of its n_probe closest cells. New vectors are assigned to the
+    existing cells, so add() never retrains.
+
+    Parameters:
+    - n_lists: int. Number of k-means cells; around sqrt(n) is a good start.
+    - n_probe: int. Cells scanned per query; higher trades speed for recall.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, n_lists=256, n_probe=8):
+        super().__init__()
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = None
+        self.assignments = np.empty(0, dtype=np.int64)
+        self._lists = None
+
+    def train(self, vectors, n_iter=10, seed=42, points_per_list=64):
+        """Fit the cell centroids on a sample of points_per_list vectors per cell."""
+        vectors = normalize(vectors)
+        sample_size = points_per_list * self.n_lists
+        if len(vectors) > sample_size:
+            rng = np.random.default_rng(seed)
+            vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        self.centroids, _ = kmeans(vectors, self.n_lists, n_iter=n_iter, seed=seed)
+        self.n_lists = len(self.centroids)
+
+    def add(self, ids, vectors):
+        """Assign vectors to their nearest cell and append them, training first if needed."""
+        if self.centroids is None:
+            self.train(vectors)
+        vectors = normalize(vectors)
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        super().add(ids, vectors)
+        self.assignments = np.concatenate([self.assignments, assignments])
+        self._lists = None
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            bounds = np.searchsorted(self.assignments[order], np.arange(self.n_lists + 1))
+            self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.n_lists)]
+        return self._lists
+
+    def bulk_query(self, queries, k=10, batch_size=1024):
+        queries = normalize(queries)
+        lists = self._inverted_lists()
+        n_probe = min(self.n_probe, self.n_lists)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            probes, _ = _top_k(batch @ self.centroids.T, n_probe)
+            rows_out = best_rows[start:start + batch_size]
+            scores_out = best_scores[start:start + batch_size]
+            # Score each probed cell once against all the queries that probe it
+            for cell in np.unique(probes):
+                members = lists[cell]
+                if len(members) == 0:
+                    continue
+                query_rows = np.nonzero((probes == cell).any(axis=1))[0]
+                scores = batch[query_rows] @ self.vectors[members].T
+                merged_scores = np.hstack([scores_out[query_rows], scores])
+                merged_rows = np.hstack([rows_out[query_rows],
+                                         np.broadcast_to(members, scores.shape)])
+                top, top_scores = _top_k(merged_scores, k)
+                rows_out[query_rows] = np.take_along_axis(merged_rows, top, axis=1)
+                scores_out[query_rows] = top_scores
+
+        ids = np.where(best_rows >= 0, self.ids[np.maximum(best_rows, 0)], -1)
+        return ids, best_scores
+
+    def _state(self):
+        state = super()._state()
+        state.update(centroids=self.centroids, assignments=self.assignments,
+                     n_lists=self.n_lists, n_probe=self.n_probe)
+        return state
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        self.centroids = state["centroids"]
+        self.assignments = state["assignments"]
+        self.n_lists = int(state["n_lists"])
+        self.n_probe = int(state["n_probe"])
+        self._lists = None
+
+
+INDEX_KINDS = {ExactIndex.kind: ExactIndex, IVFIndex.kind: IVFIndex}
+
+
+def load_index(path):
+    """Load an index of any kind written by its save method."""
+    with np.load(path, allow_pickle=False) as data:
+        index = INDEX_KINDS[str(data["kind"])]()
+        index._set_state({name: data[name] for name in data.files if name != "kind"})
+    return index
+
+
+def benchmark_index(index, exact, queries, k=10):
+    """
+    Measure recall@k and per-query latency of an index against the exact baseline.
+
+    Parameters:
+    - index: Approximate index to evaluate.
+    - exact: ExactIndex holding the same vectors.
+    - queries: np.ndarray. (n, dim) query vectors.
+    - k: int. Neighbours retrieved per query.
+    """
+    start = time.perf_counter()
+    expected, _ = exact.bulk_query(queries, k)
+    exact_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    found, _ = index.bulk_query(queries, k)
+    index_seconds = time.perf_counter() - start
+
+    hits = sum(len(np.intersect1d(e, f)) for e, f in zip(expected, found))
+    results = {
+        "kind": index.kind,
+        "k": k,
+        "queries": len(queries),
+        f"recall_at_{k}": hits / expected.size,
+        "exact_ms_per_query": 1000 * exact_seconds / len(queries),
+        "index_ms_per_query": 1000 * index_seconds / len(queries),
+    }
+    print(f"{index.kind} index: recall@{k}={results[f'recall_at_{k}']:.3f}, "
+          f"{results['index_ms_per_query']:.3f} ms/query "
+          f"(exact {results['exact_ms_per_query']:.3f} ms/query)")
+    return results
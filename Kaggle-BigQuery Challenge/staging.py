@@ -0,0 +1,254 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y"]
+
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "NUMERIC": pa.float64(),
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "DATE": pa.date32(),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+}
+
+TRUE_VALUES = {"true", "t", "yes", "y", "1"}
+FALSE_VALUES = {"false", "f", "no", "n", "0"}
+
+
+class SchemaValidationError(ValueError):
+    """Raised when a CSV does not match its BigQuery schema; carries the offending rows."""
+
+    def __init__(self, csv_path, errors):
+        self.csv_path = csv_path
+        self.errors = errors
+        details = "\n".join(f"  row {e['row']}, {e['column']}: {e['reason']} ({e['value']!r})"
+                            for e in errors[:20])
+        super().__init__(f"{len(errors)} invalid values in {csv_path}:\n{details}")
+
+
+def arrow_schema(schema):
+    """Convert a list of bigquery.SchemaField to a pyarrow schema."""
+    return pa.schema([
+        pa.field(field.name, ARROW_TYPES[field.field_type], nullable=field.mode != "REQUIRED")
+        for field in schema
+    ])
+
+
+def _parse_dates(values, date_formats):
+    """Parse date strings with the first format that fits every distinct value."""
+    categories = values.astype("category").cat
+    distinct = categories.categories
+    parsed = None
+    for date_format in date_formats:
+        attempt = pd.to_datetime(distinct, format=date_format, errors="coerce")
+        if parsed is None or attempt.notna().sum() > parsed.notna().sum():
+            parsed = attempt
+        if parsed.notna().all():
+            break
+    codes = categories.codes.to_numpy()
+    return pd.Series(np.where(codes >= 0, parsed.to_numpy()[codes], np.datetime64("NaT")),
+                     index=values.index)
+
+
+def _coerce_column(values, field_type, date_formats):
+    """Convert a column of raw strings to the pandas values of a BigQuery type."""
+    if field_type == "STRING":
+        return values
+    if field_type in ("INTEGER", "INT64"):
+        numbers = pd.to_numeric(values, errors="coerce")
+        return numbers.where(numbers == np.floor(numbers)).astype("Int64")
+    if field_type in ("FLOAT", "FLOAT64", "NUMERIC"):
+        return pd.to_numeric(values, errors="coerce")
+    if field_type in ("BOOLEAN", "BOOL"):
+        lowered = values.str.strip().str.lower()
+        return lowered.map(lambda v: True if v in TRUE_VALUES else False if v in FALSE_VALUES else None)
+    if field_type == "DATE":
+        return _parse_dates(values, date_formats).dt.date
+    if field_type == "TIMESTAMP":
+        return pd.to_datetime(values, errors="coerce", utc=True)
+    raise ValueError(f"Unsupported field type for staging: {field_type}")
+
+
+def validate_chunk(chunk, schema, first_row=0, date_formats=DATE_FORMATS, max_errors=1000):
+    """
+    Coerce a chunk of raw CSV strings to the schema types.
+
+    Returns (typed DataFrame, list of errors); an error is a value that could not
+    be converted or a missing value in a REQUIRED column. Row numbers count data
+    rows from 1, excluding the header.
+    """
+    typed = {}
+    errors = []
+    for field in schema:
+        raw = chunk[field.name]
+        present = raw.notna()
+        values = _coerce_column(raw, field.field_type, date_formats)
+        invalid = present & values.isna()
+        missing = ~present if field.mode == "REQUIRED" else pd.Series(False, index=raw.index)
+        for position in np.nonzero((invalid | missing).to_numpy())[0][:max_errors]:
+            errors.append({
+                "row": first_row + int(position) + 1,
+                "column": field.name,
+                "value": raw.iloc[position],
+                "reason": f"not a valid {field.field_type}" if invalid.iloc[position]
+                          else "missing value in REQUIRED column",
+            })
+        typed[field.name] = values
+    return pd.DataFrame(typed), errors
+
+
+def _stage_with_arrow(csv_path, schema, writer, block_size, date_formats):
+    """
+    Stream typed record batches with the Arrow CSV reader.
+
+    Numeric columns are parsed natively by Arrow and DATE columns are parsed
+    once per distinct value. Raises pyarrow.ArrowInvalid on the first value that
+    does not convert and ValueError on bad dates or missing REQUIRED values.
+    """
+    target_schema = writer.schema
+    column_types = {field.name: (pa.string() if field.field_type == "DATE"
+                                 else ARROW_TYPES[field.field_type])
+                    for field in schema}
+    reader = pacsv.open_csv(
+        csv_path,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        convert_options=pacsv.ConvertOptions(column_types=column_types,
+                                             include_columns=target_schema.names,
+                                             strings_can_be_null=True,
+                                             null_values=[""]),
+    )
+    rows = 0
+    for batch in reader:
+        arrays = []
+        for field in schema:
+            column = batch.column(field.name)
+            if field.field_type == "DATE":
+                encoded = column.dictionary_encode()
+                distinct = encoded.dictionary.to_pandas()
+                parsed = _parse_dates(distinct, date_formats)
+                if parsed.isna().any():
+                    raise ValueError(f"invalid DATE values in {field.name}")
+                dates = pa.array(parsed.dt.date, type=pa.date32())
+                column = dates.take(encoded.indices)
+            if field.mode == "REQUIRED" and column.null_count:
+                raise ValueError(f"missing values in REQUIRED column {field.name}")
+            arrays.append(column)
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=target_schema))
+        rows += batch.num_rows
+    return rows
+
+
+def _stage_with_pandas(csv_path, schema, writer, chunksize, date_formats, max_errors):
+    """Validate and coerce the CSV value by value, collecting every error found."""
+    expected = [field.name for field in schema]
+    errors = []
+    rows = 0
+    for chunk in pd.read_csv(csv_path, dtype=str, keep_default_na=False,
+                             na_values=[""], chunksize=chunksize):
+        typed, chunk_errors = validate_chunk(chunk, schema, first_row=rows,
+                                             date_formats=date_formats,
+                                             max_errors=max_errors)
+        rows += len(chunk)
+        errors.extend(chunk_errors)
+        if len(errors) >= max_errors:
+            break
+        if not errors:
+            writer.write_table(pa.Table.from_pandas(typed[expected], schema=writer.schema,
+                                                    preserve_index=False))
+    if errors:
+        raise SchemaValidationError(csv_path, errors)
+    return rows
+
+
+def stage_csv_to_parquet(csv_path, schema, parquet_path, chunksize=500_000,
+                         block_size=64 * 1024 * 1024, compression="zstd",
+                         date_formats=DATE_FORMATS, max_errors=1000):
+    """
+    Validate a CSV against a BigQuery schema and write it as typed Parquet.
+
+    The CSV is streamed in bounded-memory batches through the Arrow CSV reader.
+    If any value fails to convert, the file is re-read value by value to report
+    every offending row (and to accept values Arrow is stricter about, such as
+    "3.0" in an INTEGER column). Nothing is written when the file is invalid.
+
+    Parameters:
+    - csv_path: str. Local path to the CSV file, with a header row.
+    - schema: list[bigquery.SchemaField]. Expected columns, types and modes.
+    - parquet_path: str. Destination Parquet file.
+    - chunksize: int. CSV rows per batch on the value-by-value path.
+    - block_size: int. Bytes of CSV read per Arrow record batch.
+    - compression: str. Parquet compression codec.
+    - date_formats: list[str]. strptime formats accepted for DATE columns.
+    - max_errors: int. Stop scanning once this many errors were collected.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns.tolist()
+    expected = [field.name for field in schema]
+    if sorted(header) != sorted(expected):
+        raise SchemaValidationError(csv_path, [{
+            "row": 0, "column": ", ".join(sorted(set(header) ^ set(expected))),
+            "value": header, "reason": "header does not match the schema columns",
+        }])
+
+    target_schema = arrow_schema(schema)
+    tmp_path = f"{parquet_path}.tmp"
+    os.makedirs(os.path.dirname(parquet_path) or ".", exist_ok=True)
+    try:
+        try:
+            with pq.ParquetWriter(tmp_path, target_schema, compression=compression) as writer:
+                rows = _stage_with_arrow(csv_path, schema, writer, block_size, date_formats)
+        except (pa.ArrowInvalid, ValueError):
+            with pq.ParquetWriter(tmp_path, target_schema, compression=compression) as writer:
+                rows = _stage_with_pandas(csv_path, schema, writer, chunksize,
+                                          date_formats, max_errors)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, parquet_path)
+    print(f"Staged {rows} rows from {csv_path} to {parquet_path} "
+          f"({os.path.getsize(csv_path)} -> {os.path.getsize(parquet_path)} bytes)")
+    return parquet_path
+
+
+def select_new_rows(parquet_path, delta_path, key_column, date_column,
+                    max_key=None, since_date=None, compression="zstd"):
+    """
+    Write the rows of a staged Parquet file that are past a load high-water mark.
+
+    A row is new when its key is above max_key, or its date is on or after
+    since_date (to pick up late or corrected rows). Returns (rows, min_date,
+    max_date) of the delta; rows is 0 and no file is written when nothing is new,
+    and the dates are None when no new row has one.
+
+    Parameters:
+    - parquet_path: str. Staged Parquet file holding the full export.
+    - delta_path: str. Destination of the new rows.
+    - key_column: str. Monotonically increasing row id, e.g. Ride_ID.
+    - date_column: str. DATE column the destination table is partitioned by.
+    - max_key: int or None. Highest key already loaded; None selects every row.
+    - since_date: datetime.date or None. Rows from this date on are always selected.
+    """
+    filters = None
+    if max_key is not None:
+        filters = [[(key_column, ">", max_key)]]
+        if since_date is not None:
+            filters.append([(date_column, ">=", since_date)])
+    table = pq.read_table(parquet_path, filters=filters)
+    if table.num_rows == 0:
+        return 0, None, None
+    dates = table.column(date_column)
+    min_date, max_date = pc.min(dates).as_py(), pc.max(dates).as_py()
+    pq.write_table(table, delta_path, compression=compression)
+    return table.num_rows, min_date, max_date
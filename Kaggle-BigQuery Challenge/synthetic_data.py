@@ -0,0 +1,186 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+DRIVERS_COLUMNS = ["Driver_ID", "Name", "Age", "City", "Experience_Years",
+                   "Average_Rating", "Active_Status"]
+RIDES_COLUMNS = ["Ride_ID", "Driver_ID", "City", "Date", "Distance_km", "Duration_min",
+                 "Fare", "Rating", "Promo_Code"]
+
+# Per-city profile: share of drivers, base fare, fare per km, minutes per km
+# (traffic) and mean rider rating.
+CITY_PROFILES = {
+    "Los Angeles": {"share": 0.26, "base_fare": 2.5, "per_km": 1.65, "min_per_km": 2.1, "rating": 4.28},
+    "New York": {"share": 0.20, "base_fare": 3.0, "per_km": 1.90, "min_per_km": 2.4, "rating": 4.25},
+    "Chicago": {"share": 0.20, "base_fare": 2.2, "per_km": 1.70, "min_per_km": 1.9, "rating": 4.22},
+    "San Francisco": {"share": 0.18, "base_fare": 2.8, "per_km": 1.85, "min_per_km": 2.0, "rating": 4.28},
+    "Miami": {"share": 0.16, "base_fare": 2.0, "per_km": 1.55, "min_per_km": 1.8, "rating": 4.23},
+}
+PROMO_CODES = np.array(["SAVE20", "DISCOUNT10", "WELCOME5"], dtype=object)
+FIRST_NAMES = ["James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael", "Linda",
+               "William", "Elizabeth", "David", "Barbara", "Richard", "Susan", "Joseph", "Jessica",
+               "Carlos", "Maria", "Luis", "Ana", "Wei", "Mei", "Ahmed", "Fatima", "Holly"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis",
+              "Rodriguez", "Martinez", "Hernandez", "Lopez", "Wilson", "Anderson", "Thomas",
+              "Taylor", "Moore", "Black", "Sherman", "Nguyen", "Chen", "Khan", "Silva"]
+
+
+def _city_arrays():
+    names = np.array(list(CITY_PROFILES), dtype=object)
+    columns = {key: np.array([profile[key] for profile in CITY_PROFILES.values()])
+               for key in ("share", "base_fare", "per_km", "min_per_km", "rating")}
+    columns["share"] = columns["share"] / columns["share"].sum()
+    return names, columns
+
+
+def generate_drivers(n_drivers, seed=42, first_id=101):
+    """
+    Return a DataFrame of drivers with the columns of drivers_data_schema.
+
+    Parameters:
+    - n_drivers: int. Number of drivers.
+    - seed: int. Random seed; the same seed always yields the same drivers.
+    - first_id: int. Driver_ID of the first driver, as in Drivers_Data.csv.
+    """
+    rng = np.random.default_rng(seed)
+    names, profiles = _city_arrays()
+    city = rng.choice(len(names), n_drivers, p=profiles["share"])
+    age = rng.integers(21, 61, n_drivers)
+    experience = np.minimum(rng.integers(1, 21, n_drivers), age - 18)
+    rating = np.clip(np.round(rng.normal(profiles["rating"][city] + 0.3, 0.25), 1), 3.0, 5.0)
+    full_names = (np.array(FIRST_NAMES, dtype=object)[rng.integers(0, len(FIRST_NAMES), n_drivers)]
+                  + " " + np.array(LAST_NAMES, dtype=object)[rng.integers(0, len(LAST_NAMES), n_drivers)])
+    return pd.DataFrame({
+        "Driver_ID": np.arange(first_id, first_id + n_drivers, dtype=np.int64),
+        "Name": full_names,
+        "Age": age,
+        "City": names[city],
+        "Experience_Years": experience,
+        "Average_Rating": rating,
+        "Active_Status": np.where(rng.random(n_drivers) < 0.55, "Active", "Inactive"),
+    })
+
+
+def generate_ride_chunks(drivers, n_rides, chunksize=1_000_000, seed=42,
+                         start_date="2024-11-01", n_days=30, date_format="%m/%d/%Y"):
+    """
+    Yield DataFrames of rides with the columns of rides_data_schema.
+
+    Drivers get a heavy-tailed activity level, most rides happen in the driver's
+    own city, and distance, duration, fare and rating follow that city's
+    profile. Dates are formatted like Rides_Data.csv (None keeps datetime64).
+
+    Parameters:
+    - drivers: pandas.DataFrame. Output of generate_drivers.
+    - n_rides: int. Total number of rides.
+    - chunksize: int. Rides per yielded chunk.
+    - seed: int. Random seed.
+    - start_date: str. First ride date.
+    - n_days: int. Number of days the rides span.
+    - date_format: str or None. strftime format of the Date column.
+    """
+    rng = np.random.default_rng(seed)
+    names, profiles = _city_arrays()
+    city_index = {name: i for i, name in enumerate(names)}
+    driver_ids = drivers["Driver_ID"].to_numpy()
+    driver_city = drivers["City"].map(city_index).to_numpy()
+    activity = rng.lognormal(0.0, 1.0, len(drivers))
+    activity /= activity.sum()
+    dates = pd.date_range(start_date, periods=n_days, freq="D")
+    date_values = (np.array(dates.strftime(date_format), dtype=object) if date_format
+                   else dates.to_numpy())
+
+    for first in range(0, n_rides, chunksize):
+        size = min(chunksize, n_rides - first)
+        driver = rng.choice(len(drivers), size, p=activity)
+        city = np.where(rng.random(size) < 0.8, driver_city[driver],
+                        rng.choice(len(names), size, p=profiles["share"]))
+        distance = np.round(np.clip(rng.lognormal(2.9, 0.7, size), 0.5, 50.0), 1)
+        duration = np.maximum(1, np.round(distance * profiles["min_per_km"][city]
+                                          * rng.normal(1.0, 0.15, size))).astype(np.int64)
+        surge = np.where(rng.random(size) < 0.15, rng.uniform(1.2, 2.0, size), 1.0)
+        fare = np.round((profiles["base_fare"][city] + distance * profiles["per_km"][city])
+                        * surge * rng.uniform(0.6, 1.4, size), 2)
+        rating = np.clip(np.round(rng.normal(profiles["rating"][city], 0.45, size), 1), 1.0, 5.0)
+        promo = np.where(rng.random(size) < 0.27, None,
+                         PROMO_CODES[rng.integers(0, len(PROMO_CODES), size)])
+        yield pd.DataFrame({
+            "Ride_ID": np.arange(first + 1, first + size + 1, dtype=np.int64),
+            "Driver_ID": driver_ids[driver],
+            "City": names[city],
+            "Date": date_values[rng.integers(0, n_days, size)],
+            "Distance_km": distance,
+            "Duration_min": duration,
+            "Fare": fare,
+            "Rating": rating,
+            "Promo_Code": promo,
+        })
+
+
+def _write_chunks(chunks, path, file_format):
+    """Stream DataFrame chunks to a single CSV or Parquet file with Arrow writers."""
+    tmp_path = f"{path}.tmp"
+    rows = 0
+    sink = None
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            # The schemas only use DATE, never TIMESTAMP
+            table = table.cast(pa.schema([
+                pa.field(f.name, pa.date32()) if pa.types.is_timestamp(f.type) else f
+                for f in table.schema
+            ]))
+            if writer is None and file_format == "csv":
+                # Generated values never contain commas or quotes, so write them bare
+                # like the bundled CSVs
+                sink = pa.OSFile(tmp_path, "wb")
+                sink.write((",".join(table.column_names) + "\n").encode("utf-8"))
+                writer = pacsv.CSVWriter(sink, table.schema, write_options=pacsv.WriteOptions(
+                    include_header=False, quoting_style="none"))
+            elif writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression="zstd")
+            writer.write_table(table)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+    os.replace(tmp_path, path)
+    return rows
+
+
+def write_dataset(out_dir, n_drivers, n_rides, file_format="csv", chunksize=1_000_000, seed=42):
+    """
+    Generate drivers and rides and stream them to out_dir, returning both paths.
+
+    CSV output reproduces the layout of the bundled data files; Parquet output
+    stores typed columns (Date as DATE).
+
+    Parameters:
+    - out_dir: str. Output directory.
+    - n_drivers: int. Number of drivers.
+    - n_rides: int. Number of rides.
+    - file_format: str. "csv" or "parquet".
+    - chunksize: int. Rides generated and written per chunk.
+    - seed: int. Random seed.
+    """
+    if file_format not in ("csv", "parquet"):
+        raise ValueError(f"Unsupported format: {file_format}")
+    os.makedirs(out_dir, exist_ok=True)
+    drivers = generate_drivers(n_drivers, seed=seed)
+    drivers_path = os.path.join(out_dir, f"Drivers_Data.{file_format}")
+    rides_path = os.path.join(out_dir, f"Rides_Data.{file_format}")
+
+    _write_chunks([drivers], drivers_path, file_format)
+    date_format = "%m/%d/%Y" if file_format == "csv" else None
+    rides = _write_chunks(generate_ride_chunks(drivers, n_rides, chunksize=chunksize,
+                                               seed=seed + 1, date_format=date_format),
+                          rides_path, file_format)
+    print(f"Generated {n_drivers} drivers and {rides} rides in {out_dir}")
+    return drivers_path, rides_path
@@ -0,0 +1,207 @@
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from similarity import normalize
+
+_SEPARATORS = re.compile(r"[,;\n]+")
+_LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+")
+_NOISE = re.compile(r"[^\w\s&/+'-]+")
+_SPACES = re.compile(r"[\s_-]+")
+
+
+def split_tags(tag_string):
+    """Split a stress_report_tags string ("Fatigue, Financial Stress") into raw tags."""
+    if not isinstance(tag_string, str):
+        return []
+    return [tag for tag in _SEPARATORS.split(tag_string) if tag.strip()]
+
+
+def canonicalize_tag(tag):
+    """
+    Return the vocabulary key of a raw tag, or "" if nothing is left.
+
+    Keys are case-folded with punctuation, list markers and repeated
+    whitespace, dashes or underscores removed, so "Financial-stress." and
+    " financial  Stress" intern to the same tag.
+    """
+    tag = _NOISE.sub(" ", _LIST_MARKER.sub("", tag))
+    return _SPACES.sub(" ", tag).strip().casefold()
+
+
+class TagVocabulary:
+    """
+    Interns canonical tags into stable integer ids.
+
+    Ids are assigned in first-seen order and never reused, so a saved
+    vocabulary keeps the columns of earlier driver x tag matrices valid. Each
+    tag keeps the surface form it was first seen with as its label.
+
+    Parameters:
+    - labels: list[str] or None. Labels of ids 0..n-1, e.g. from a saved vocabulary.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = []
+        self._ids = {}
+        for label in labels or []:
+            self.intern(label)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def intern(self, tag):
+        """Return the id of a raw tag, adding it to the vocabulary if needed (-1 if empty)."""
+        key = canonicalize_tag(tag)
+        if not key:
+            return -1
+        if key not in self._ids:
+            self._ids[key] = len(self.labels)
+            self.labels.append(" ".join(_LIST_MARKER.sub("", tag).strip(" .").split()))
+        return self._ids[key]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"labels": self.labels}, f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Return the vocabulary saved at path, or an empty one if there is none."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f)["labels"])
+
+
+class TagMatrix:
+    """
+    Sparse CSR driver x tag matrix.
+
+    Row i holds the tag ids of ids[i] in indices[indptr[i]:indptr[i + 1]], in
+    the order they were listed, with their weights in data.
+
+    Parameters:
+    - ids: np.ndarray. Driver ID of each row.
+    - indptr: np.ndarray. (n_rows + 1,) row offsets into indices and data.
+    - indices: np.ndarray. Tag id of each stored entry.
+    - data: np.ndarray. Weight of each stored entry.
+    - n_tags: int. Number of columns (vocabulary size).
+    """
+
+    def __init__(self, ids, indptr, indices, data, n_tags):
+        self.ids = np.asarray(ids)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data, dtype=np.float32)
+        self.n_tags = int(n_tags)
+
+    @property
+    def shape(self):
+        return len(self.ids), self.n_tags
+
+    @property
+    def row_lengths(self):
+        return np.diff(self.indptr)
+
+    @classmethod
+    def from_tag_strings(cls, ids, tag_strings, vocabulary):
+        """
+        Build the matrix of drivers from their stress_report_tags strings.
+
+        Each distinct string is split and interned once; rows are then
+        gathered from the distinct strings without touching Python per driver.
+        Duplicate tags within a string are kept once.
+
+        Parameters:
+        - ids: array-like. Driver ID of each string.
+        - tag_strings: array-like. stress_report_tags of each driver (None allowed).
+        - vocabulary: TagVocabulary. Interns new tags in place.
+        """
+        codes, uniques = pd.factorize(pd.Series(tag_strings, dtype=object), use_na_sentinel=True)
+        unique_indptr = [0]
+        unique_indices = []
+        for tag_string in uniques:
+            tag_ids = [vocabulary.intern(tag) for tag in split_tags(tag_string)]
+            tag_ids = list(dict.fromkeys(tag_id for tag_id in tag_ids if tag_id >= 0))
+            unique_indices.extend(tag_ids)
+            unique_indptr.append(len(unique_indices))
+        unique_indptr = np.array(unique_indptr, dtype=np.int64)
+        unique_indices = np.array(unique_indices, dtype=np.int32)
+
+        # Missing strings (code -1) become empty rows
+        unique_lengths = np.append(np.diff(unique_indptr), 0)
+        unique_starts = np.append(unique_indptr[:-1], 0)
+        lengths = unique_lengths[codes]
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        offsets = np.arange(indptr[-1]) - np.repeat(indptr[:-1], lengths)
+        indices = unique_indices[np.repeat(unique_starts[codes], lengths) + offsets]
+        return cls(ids, indptr, indices, np.ones(len(indices), dtype=np.float32), len(vocabulary))
+
+    def dot(self, dense, batch_size=65536):
+        """
+        Return the (n_rows, dim) product of the matrix with a (n_tags, dim) dense matrix.
+
+        Rows hold a handful of tags, so the product is accumulated one tag
+        position at a time over every row having it, batch_size rows at a time
+        to bound the gathered tag vectors held in memory.
+        """
+        dense = np.asarray(dense)
+        out = np.zeros((len(self.ids), dense.shape[1]), dtype=np.result_type(dense, np.float32))
+        for start in range(0, len(self.ids), batch_size):
+            stop = min(start + batch_size, len(self.ids))
+            starts = self.indptr[start:stop]
+            lengths = self.indptr[start + 1:stop + 1] - starts
+            batch = out[start:stop]
+            for position in range(int(lengths.max(initial=0))):
+                rows = np.nonzero(lengths > position)[0]
+                entries = starts[rows] + position
+                batch[rows] += dense[self.indices[entries]] * self.data[entries, None]
+        return out
+
+    def tag_counts(self):
+        """Return the summed weight of every tag over all rows."""
+        return np.bincount(self.indices, weights=self.data, minlength=self.n_tags)
+
+    def first_tags(self):
+        """Return the first tag id of every row, -1 for rows without tags."""
+        first = np.full(len(self.ids), -1, dtype=np.int32)
+        non_empty = self.row_lengths > 0
+        first[non_empty] = self.indices[self.indptr[:-1][non_empty]]
+        return first
+
+    def row_labels(self, vocabulary, separator=", "):
+        """Return the canonical tag string of every row, e.g. for display."""
+        labels = np.array(vocabulary.labels, dtype=object)
+        return [separator.join(labels[self.indices[start:end]])
+                for start, end in zip(self.indptr[:-1], self.indptr[1:])]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, ids=self.ids, indptr=self.indptr, indices=self.indices,
+                 data=self.data, n_tags=self.n_tags)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            return cls(f["ids"], f["indptr"], f["indices"], f["data"], int(f["n_tags"]))
+
+
+def compose_driver_vectors(matrix, tag_vectors):
+    """
+    Return one unit vector per row: the normalized mean of its tags' vectors.
+
+    Rows without tags get a zero vector.
+
+    Parameters:
+    - matrix: TagMatrix. Driver x tag matrix.
+    - tag_vectors: np.ndarray. (n_tags, dim) vectors indexed by tag id.
+    """
+    return normalize(matrix.dot(normalize(tag_vectors)))
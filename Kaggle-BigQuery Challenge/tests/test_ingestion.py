@@ -0,0 +1,180 @@
+"""BulkInsertSink batching and retries against a fake insert_rows_json."""
+
+import threading
+
+import pytest
+
+import ingestion
+from ingestion import BulkInsertSink, RowError, insert_rows
+from instrumentation import InstrumentedClient, instrumentation
+
+TABLE_ID = "project.dataset.rows"
+
+
+class FakeBigQuery:
+    """
+    insert_rows_json of a bigquery.Client, failing rows as respond(row, attempt) says.
+
+    respond returns None to accept the row or the reason of its error; attempt
+    counts the requests that already carried the same row. Every request is
+    logged as (rows, row_ids).
+    """
+
+    def __init__(self, respond=lambda row, attempt: None):
+        self.respond = respond
+        self.requests = []
+        self.rows = []
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def insert_rows_json(self, table, rows, row_ids=None):
+        assert table == TABLE_ID
+        errors = []
+        with self._lock:
+            self.requests.append((list(rows), row_ids))
+            for index, row in enumerate(rows):
+                attempt = self._attempts.get(row["name"], 0)
+                self._attempts[row["name"]] = attempt + 1
+                reason = self.respond(row, attempt)
+                if reason is None:
+                    self.rows.append(row)
+                else:
+                    errors.append({"index": index,
+                                   "errors": [{"reason": reason, "message": f"{reason} row"}]})
+        return errors
+
+    def batch_sizes(self):
+        return [len(rows) for rows, _ in self.requests]
+
+
+def make_rows(count, payload=""):
+    return [{"name": f"row{i}", "payload": payload} for i in range(count)]
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the backoff delays instead of sleeping, without jitter."""
+    delays = []
+    monkeypatch.setattr(ingestion.time, "sleep", delays.append)
+    monkeypatch.setattr(ingestion.random, "uniform", lambda low, high: 0.0)
+    return delays
+
+
+def test_batches_are_cut_by_rows(sleeps):
+    client = FakeBigQuery()
+
+    report = insert_rows(client, TABLE_ID, make_rows(10), id_column_name="name",
+                         max_batch_rows=4, max_workers=1)
+
+    assert client.batch_sizes() == [4, 4, 2]
+    assert client.requests[0][1] == ["row0", "row1", "row2", "row3"]
+    assert report == ingestion.InsertReport(table_id=TABLE_ID, rows_submitted=10,
+                                            rows_inserted=10, requests_sent=3)
+    assert report.ok and sleeps == []
+
+
+def test_batches_are_cut_by_bytes():
+    client = FakeBigQuery()
+    rows = make_rows(7, payload="x" * 1000)
+    row_size = ingestion._row_size(rows[0])
+
+    # Two rows fit under the limit, a third would exceed it
+    report = insert_rows(client, TABLE_ID, rows, max_batch_rows=100,
+                         max_batch_bytes=3 * row_size - 1, max_workers=1)
+
+    assert client.batch_sizes() == [2, 2, 2, 1]
+    assert all(row_ids is None for _, row_ids in client.requests)
+    assert report.rows_inserted == 7 and report.requests_sent == 4
+
+
+def test_rows_without_id_are_sent_without_insert_id():
+    client = FakeBigQuery()
+    rows = [{"name": "a", "id": 1}, {"name": "b", "id": None}, {"name": "c"}]
+
+    insert_rows(client, TABLE_ID, rows, id_column_name="id")
+
+    assert client.requests == [(rows, ["1", None, None])]
+
+
+def test_rejected_rows_are_retried_one_by_one_with_backoff(sleeps):
+    # row1 fails twice before it goes through
+    client = FakeBigQuery(lambda row, attempt: "backendError"
+                          if row["name"] == "row1" and attempt < 2 else None)
+
+    report = insert_rows(client, TABLE_ID, make_rows(4), max_batch_rows=4,
+                         backoff_seconds=0.1, max_retries=3)
+
+    assert report.ok
+    assert (report.rows_submitted, report.rows_inserted, report.requests_sent) == (4, 4, 3)
+    assert client.batch_sizes() == [4, 1, 1]
+    assert sleeps == pytest.approx([0.1, 0.2])
+    assert sorted(row["name"] for row in client.rows) == ["row0", "row1", "row2", "row3"]
+
+
+def test_rows_failing_every_retry_are_reported(sleeps):
+    client = FakeBigQuery(lambda row, attempt: "backendError" if row["name"] == "row2" else None)
+
+    report = insert_rows(client, TABLE_ID, make_rows(3), id_column_name="name",
+                         backoff_seconds=0.1, max_retries=3)
+
+    assert not report.ok
+    assert report.rows_inserted == 2 and report.requests_sent == 4
+    assert sleeps == pytest.approx([0.1, 0.2, 0.4])
+    assert report.failed_rows == [RowError(
+        row_index=2, row_id="row2", attempts=4,
+        errors=[{"reason": "backendError", "message": "backendError row"}])]
+
+
+def test_invalid_rows_are_not_retried(sleeps):
+    client = FakeBigQuery(lambda row, attempt: "invalid" if row["name"] in ("row1", "row3")
+                          else None)
+
+    report = insert_rows(client, TABLE_ID, make_rows(5), id_column_name="name", max_batch_rows=2,
+                         max_workers=1)
+
+    assert client.batch_sizes() == [2, 2, 1]
+    assert sleeps == []
+    assert (report.rows_submitted, report.rows_inserted) == (5, 3)
+    assert [(error.row_index, error.row_id, error.attempts) for error in report.failed_rows] == [
+        (1, "row1", 1), (3, "row3", 1)]
+    assert report.failed_rows[0].errors == [{"reason": "invalid", "message": "invalid row"}]
+
+
+def test_failed_requests_are_retried_per_row(sleeps):
+    client = FakeBigQuery()
+    insert_rows_json = client.insert_rows_json
+    calls = []
+
+    def flaky_insert(table, rows, row_ids=None):
+        calls.append(len(rows))
+        if len(calls) == 1:
+            raise ConnectionError("connection reset")
+        return insert_rows_json(table, rows, row_ids=row_ids)
+
+    client.insert_rows_json = flaky_insert
+    report = insert_rows(client, TABLE_ID, make_rows(3), backoff_seconds=0.1)
+
+    assert report.ok and report.rows_inserted == 3
+    assert calls == [3, 1, 1, 1]
+    assert sleeps == pytest.approx([0.1, 0.1, 0.1])
+
+
+def test_requests_are_recorded_under_the_submitting_stage():
+    client = InstrumentedClient(FakeBigQuery())
+    unstaged_rows = instrumentation.stages["unstaged"]["rows"]
+
+    sink = BulkInsertSink(client, TABLE_ID, max_batch_rows=2, max_workers=2)
+    with instrumentation.stage("test_ingestion_first"):
+        sink.extend(make_rows(4))
+        sink.flush()
+    with instrumentation.stage("test_ingestion_second"):
+        sink.extend(make_rows(3))
+    report = sink.close()
+
+    assert report.rows_inserted == 7
+    first = instrumentation.stages["test_ingestion_first"]
+    second = instrumentation.stages["test_ingestion_second"]
+    assert first["calls"]["client.insert_rows_json"]["count"] == 2 and first["rows"] == 4
+    # The last row was flushed by close(), outside any stage: it goes to the sink's creator
+    assert second["calls"]["client.insert_rows_json"]["count"] == 1 and second["rows"] == 2
+    assert instrumentation.stages["unstaged"]["rows"] == unstaged_rows + 1
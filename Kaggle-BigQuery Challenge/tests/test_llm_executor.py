@@ -0,0 +1,191 @@
+"""PromptExecutor runs against a local fake of the generateContent REST method."""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import llm_executor
+from llm_executor import GenerateContentEndpoint, PromptExecutor, format_prompt
+from queries import PromptSpec, prompt_cache_key
+
+SCORE_PROMPT = PromptSpec(name="stress_score", function="AI.GENERATE_DOUBLE",
+                          template="Driver %s: what is the stress level?", args=("driver_ID",))
+
+
+class GenerateContentServer:
+    """
+    Answers generateContent requests with respond(text, attempt) -> (status, answer).
+
+    attempt counts the requests already received for the same prompt text.
+    Every request is logged as (time, text, status).
+    """
+
+    def __init__(self, respond, delay=0.0):
+        self.respond = respond
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                text = body["contents"][0]["parts"][0]["text"]
+                with server._lock:
+                    attempt = sum(logged == text for _, logged, _ in server.requests)
+                status, answer = server.respond(text, attempt)
+                with server._lock:
+                    server.requests.append((time.monotonic(), text, status))
+                time.sleep(server.delay)
+                if status == 200:
+                    payload = json.dumps({
+                        "candidates": [{"content": {"parts": [{"text": answer}]}}],
+                        "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 1},
+                    }).encode("utf-8")
+                else:
+                    payload = json.dumps({"error": {"code": status, "message": answer}}).encode(
+                        "utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if status == 429:
+                    self.send_header("Retry-After", "0.2")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def texts(self):
+        return [text for _, text, _ in self.requests]
+
+
+def make_executor(url, **options):
+    endpoint = GenerateContentEndpoint(url + "/models/{model}:generateContent", timeout=5)
+    options = {"requests_per_minute": 60_000, "base_delay": 0.01, "max_delay": 0.05,
+               "progress_every": 10 ** 6, **options}
+    return PromptExecutor(endpoint, **options)
+
+
+def drivers(count):
+    return pd.DataFrame({"driver_ID": [f"D{i}" for i in range(count)]})
+
+
+def test_throttling_backs_off_and_shrinks_concurrency(serve, monkeypatch):
+    server = GenerateContentServer(lambda text, attempt: (429, "slow down") if attempt == 0
+                                   else (200, "0.5"))
+    url = serve(server.handler())
+    limits = []
+    on_throttle = llm_executor.AdaptiveConcurrency.on_throttle
+
+    def record_throttle(concurrency, generation):
+        before = concurrency.limit
+        on_throttle(concurrency, generation)
+        limits.append((before, concurrency.limit))
+
+    monkeypatch.setattr(llm_executor.AdaptiveConcurrency, "on_throttle", record_throttle)
+    executor = make_executor(url, initial_concurrency=4, max_concurrency=8)
+
+    output, report = executor.execute(SCORE_PROMPT, drivers(8))
+
+    assert report.ok and report.rows_completed == 8
+    assert output["stress_score"].tolist() == [0.5] * 8
+    assert report.throttled == 8 and report.retries == 8
+    # The limit was halved on the first 429, and once per window rather than per 429
+    halvings = [(before, after) for before, after in limits if after < before]
+    assert halvings[0] == (4.0, 2.0)
+    assert len(halvings) < report.throttled
+    # Every retry waited at least the Retry-After of its 429
+    for text in set(server.texts()):
+        throttled_at, retried_at = [at for at, logged, _ in server.requests if logged == text]
+        assert retried_at - throttled_at >= 0.2
+
+
+def test_permanent_failures_are_reported_not_retried(serve):
+    def respond(text, attempt):
+        if "D1:" in text:
+            return 400, "invalid argument"
+        if "D2:" in text:
+            return 503, "unavailable"
+        return 200, "0.25"
+
+    server = GenerateContentServer(respond)
+    url = serve(server.handler())
+    executor = make_executor(url, max_attempts=3)
+
+    output, report = executor.execute(SCORE_PROMPT, drivers(4))
+
+    invalid = format_prompt(SCORE_PROMPT, {"driver_ID": "D1"})
+    unavailable = format_prompt(SCORE_PROMPT, {"driver_ID": "D2"})
+    invalid_key = prompt_cache_key(SCORE_PROMPT, invalid)
+    assert set(report.failed_rows) == {invalid_key, prompt_cache_key(SCORE_PROMPT, unavailable)}
+    assert "PermanentError" in report.failed_rows[invalid_key]
+    # A 400 is sent once; a 503 until max_attempts is exhausted
+    assert server.texts().count(invalid) == 1
+    assert server.texts().count(unavailable) == 3
+    assert report.rows_completed == 2
+    assert output["stress_score"].tolist() == [0.25, None, None, 0.25]
+
+
+def test_interrupted_run_resumes_from_checkpoint(serve, tmp_path):
+    hang = threading.Event()
+
+    def respond(text, attempt):
+        if "D3:" in text and not hang.is_set():
+            time.sleep(1.0)
+        return 200, "0.75"
+
+    server = GenerateContentServer(respond)
+    url = serve(server.handler())
+    executor = make_executor(url, initial_concurrency=1, max_concurrency=1,
+                             checkpoint_dir=str(tmp_path))
+    texts = [format_prompt(SCORE_PROMPT, row) for row in drivers(6).to_dict("records")]
+    items = [(prompt_cache_key(SCORE_PROMPT, text), text) for text in texts]
+
+    async def interrupted_run():
+        await asyncio.wait_for(executor.run_async(SCORE_PROMPT, items), timeout=0.5)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(interrupted_run())
+    assert set(executor.load_checkpoint(SCORE_PROMPT)) == {key for key, _ in items[:3]}
+    # A run killed while writing leaves a truncated last line
+    with open(executor.checkpoint_path(SCORE_PROMPT), "a") as f:
+        f.write('{"key": "trunc')
+
+    hang.set()
+    sent_before = len(server.requests)
+    results, report = executor.run(SCORE_PROMPT, items)
+
+    assert report.rows_from_checkpoint == 3 and report.rows_completed == 3
+    assert server.texts()[sent_before:] == texts[3:]
+    assert results == {key: 0.75 for key, _ in items}
+
+
+def test_format_prompt_renders_nulls_like_bigquery_format():
+    prompt = PromptSpec(name="summary", function="AI.GENERATE",
+                        template="A %d-year-old driver from %s rated %.1f, %d%% of days active.",
+                        args=("Age", "City", "Average_Rating", "active_share"))
+
+    # FORMAT renders NULL for every NULL argument, whatever its format specifier
+    assert format_prompt(prompt, {"Age": None, "City": None, "Average_Rating": np.nan,
+                                  "active_share": 40}) == (
+        "A NULL-year-old driver from NULL rated NULL, 40% of days active.")
+    assert format_prompt(prompt, {"Age": 44, "City": "Chicago", "Average_Rating": 4.9,
+                                  "active_share": 75}) == (
+        "A 44-year-old driver from Chicago rated 4.9, 75% of days active.")
+
+    rows = pd.DataFrame({"Age": pd.array([31, None], dtype="Int64"), "City": ["Austin", None],
+                         "Average_Rating": [4.5, np.nan], "active_share": [10, 20]})
+    texts = [format_prompt(prompt, row) for row in rows.to_dict("records")]
+    assert texts == ["A 31-year-old driver from Austin rated 4.5, 10% of days active.",
+                     "A NULL-year-old driver from NULL rated NULL, 20% of days active."]
@@ -0,0 +1,195 @@
+"""NewsCollector polls against RSS feeds served by a local http.server."""
+
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from news_collector import NewsCollector, collect
+
+TABLE_ID = "project.dataset.news"
+
+
+def rss(*links):
+    items = "".join(f"<item><title>Story {link}</title><link>{link}</link>"
+                    f"<description>About {link}</description>"
+                    f"<pubDate>Mon, 06 Oct 2025 10:00:00 GMT</pubDate></item>"
+                    for link in links)
+    return (f'<?xml version="1.0"?><rss version="2.0"><channel><title>Feed</title>{items}'
+            f"</channel></rss>").encode("utf-8")
+
+
+class FeedServer:
+    """
+    Feeds by path, answered with 304 when the request's validators still match.
+
+    A feed is a dict with body and optionally etag and last_modified. Every
+    request's path and validator headers are logged, and the largest number
+    of requests served at once is tracked.
+    """
+
+    def __init__(self, feeds, delay=0.0):
+        self.feeds = feeds
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                    server.requests.append((self.path, self.headers.get("If-None-Match"),
+                                            self.headers.get("If-Modified-Since")))
+                try:
+                    time.sleep(server.delay)
+                    feed = server.feeds[self.path]
+                    etag, last_modified = feed.get("etag"), feed.get("last_modified")
+                    if ((etag and self.headers.get("If-None-Match") == etag)
+                            or (last_modified
+                                and self.headers.get("If-Modified-Since") == last_modified)):
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/rss+xml")
+                    if etag:
+                        self.send_header("ETag", etag)
+                    if last_modified:
+                        self.send_header("Last-Modified", last_modified)
+                    self.send_header("Content-Length", str(len(feed["body"])))
+                    self.end_headers()
+                    self.wfile.write(feed["body"])
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def requests_for(self, path):
+        return [request for request in self.requests if request[0] == path]
+
+
+class FakeBigQuery:
+    """insert_rows_json of a bigquery.Client, rejecting the rows whose link is in failing."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def insert_rows_json(self, table, rows, row_ids=None):
+        errors = []
+        with self._lock:
+            for index, row in enumerate(rows):
+                if row["link"] in self.failing:
+                    errors.append({"index": index,
+                                   "errors": [{"reason": "invalid", "message": "rejected"}]})
+                else:
+                    self.rows.append(row)
+        return errors
+
+    def links(self):
+        return sorted(row["link"] for row in self.rows)
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / "news_state.json")
+
+
+def poll(collector, client):
+    return asyncio.run(collect(collector, client, TABLE_ID))
+
+
+def test_unchanged_feeds_answer_304_and_store_nothing(serve, state_path):
+    feeds = FeedServer({
+        "/etag": {"body": rss("https://a.example/1", "https://a.example/2"), "etag": '"v1"'},
+        "/modified": {"body": rss("https://b.example/1"),
+                      "last_modified": "Mon, 06 Oct 2025 10:00:00 GMT"},
+    })
+    url = serve(feeds.handler())
+    client = FakeBigQuery()
+    collector = NewsCollector([f"{url}/etag", f"{url}/modified"], state_path)
+
+    first = poll(collector, client)
+    assert first.rows_inserted == 3
+
+    # A new collector reads the validators back from the state file
+    second = poll(NewsCollector([f"{url}/etag", f"{url}/modified"], state_path), client)
+    assert second.rows_inserted == 0
+    assert feeds.requests_for("/etag")[-1][1] == '"v1"'
+    assert feeds.requests_for("/modified")[-1][2] == "Mon, 06 Oct 2025 10:00:00 GMT"
+    assert client.links() == ["https://a.example/1", "https://a.example/2", "https://b.example/1"]
+
+
+def test_entries_shared_by_feeds_are_stored_once(serve, state_path):
+    feeds = FeedServer({
+        "/one": {"body": rss("https://a.example/shared", "https://a.example/1")},
+        "/two": {"body": rss("https://a.example/shared", "https://a.example/2")},
+    })
+    url = serve(feeds.handler())
+    client = FakeBigQuery()
+    collector = NewsCollector([f"{url}/one", f"{url}/two"], state_path)
+
+    poll(collector, client)
+    assert client.links() == ["https://a.example/1", "https://a.example/2",
+                              "https://a.example/shared"]
+
+    # Without validators both feeds are downloaded again, but nothing is stored twice
+    feeds.feeds["/two"]["body"] = rss("https://a.example/shared", "https://a.example/2",
+                                      "https://a.example/3")
+    report = poll(collector, client)
+    assert report.rows_inserted == 1
+    assert client.links() == ["https://a.example/1", "https://a.example/2",
+                              "https://a.example/3", "https://a.example/shared"]
+
+
+def test_requests_to_one_host_are_limited(serve, state_path):
+    paths = [f"/feed{i}" for i in range(6)]
+    feeds = FeedServer({path: {"body": rss(f"https://a.example{path}")} for path in paths},
+                       delay=0.2)
+    url = serve(feeds.handler())
+    collector = NewsCollector([f"{url}{path}" for path in paths], state_path,
+                              per_host_limit=2, max_concurrency=16)
+
+    report = poll(collector, FakeBigQuery())
+    assert report.rows_inserted == 6
+    assert feeds.max_in_flight == 2
+
+
+def test_failed_insert_is_retried_on_next_poll(serve, state_path):
+    feeds = FeedServer({
+        "/flaky": {"body": rss("https://a.example/ok", "https://a.example/rejected"),
+                   "etag": '"v1"'},
+        "/steady": {"body": rss("https://b.example/1"), "etag": '"v1"'},
+    })
+    url = serve(feeds.handler())
+    client = FakeBigQuery(failing={"https://a.example/rejected"})
+    collector = NewsCollector([f"{url}/flaky", f"{url}/steady"], state_path)
+
+    first = poll(collector, client)
+    assert [error.row_id for error in first.failed_rows] == ["https://a.example/rejected"]
+
+    client.failing.clear()
+    second = poll(collector, client)
+    assert second.rows_inserted == 1
+    assert client.links() == ["https://a.example/ok", "https://a.example/rejected",
+                              "https://b.example/1"]
+    # The feed with a failed row was fetched again in full; the other one answered 304
+    assert feeds.requests_for("/flaky")[-1][1] is None
+    assert feeds.requests_for("/steady")[-1][1] == '"v1"'
+
+    third = poll(collector, client)
+    assert third.rows_inserted == 0
+    assert feeds.requests_for("/flaky")[-1][1] == '"v1"'